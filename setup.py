@@ -25,5 +25,6 @@ setup(
     entry_points="""
     [console_scripts]
     mailpost = nous.mailpost:main
+    mailpost-replay = nous.mailpost.benchmarks.replay:main
     """,
 )
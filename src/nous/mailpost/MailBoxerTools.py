@@ -17,7 +17,7 @@
 ###  Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
 #####
 
-import StringIO, re, rfc822, mimetools, warnings
+import StringIO, re, rfc822, mimetools, warnings, binascii, string
 
 warnings.simplefilter('ignore', DeprecationWarning)
 import multifile, mimify
@@ -77,6 +77,12 @@ def getPlainBodyFromMail(mailString):
     """ get content-type and body from mail given as string
     """
     (textBody, contentType, htmlBody, attachments) = unpackMail(mailString)
+    return getPlainBody(textBody, contentType, htmlBody)
+
+
+def getPlainBody(textBody, contentType, htmlBody):
+    """ get content-type and body from the results of unpackMail
+    """
     if contentType:
         return (contentType, textBody)
     else:
@@ -94,6 +100,14 @@ def headersAsString(mailString, customHeaders={}):
 
     """
     msg = mimetools.Message(StringIO.StringIO(mailString))
+    return messageHeadersAsString(msg, customHeaders)
+
+
+def messageHeadersAsString(msg, customHeaders={}):
+    """ returns the headers of a mimetools.Message as a string, patching
+        msg with the custom headers.
+
+    """
     # patch the headers with our custom headers
     for hdr in customHeaders.keys():
         msg[hdr] = customHeaders[hdr]
@@ -101,20 +115,107 @@ def headersAsString(mailString, customHeaders={}):
     return str(msg).strip()
 
 
+class Attachment(object):
+    """ an attachment found in a mail.
+
+    Holds the file name, mime type, size and digest of the attachment,
+    but its decoded body only until it is stored: from then on the body
+    is read from the file at path.
+
+        >>> attachment = Attachment('a.txt', 'text', 'plain', 'Hello')
+        >>> attachment
+        <Attachment 'a.txt' text/plain, 5 bytes>
+        >>> attachment.open().read()
+        'Hello'
+    """
+
+    __slots__ = ('filename', 'maintype', 'subtype', 'size', 'digest',
+                 'body', 'path')
+
+    def __init__(self, filename, maintype, subtype, body=None, path=None,
+                 size=None, digest=None):
+        self.filename = filename
+        self.maintype = maintype
+        self.subtype = subtype
+        if size is None and body is not None:
+            size = len(body)
+        self.size = size
+        self.digest = digest
+        self.body = body
+        self.path = path
+
+    def getMimeType(self):
+        return '%s/%s' % (self.maintype, self.subtype)
+
+    mime_type = property(getMimeType)
+
+    def open(self):
+        """ returns a file reading the decoded body.
+        """
+        if self.body is not None:
+            return StringIO.StringIO(self.body)
+        if self.path is not None:
+            return open(self.path, 'rb')
+        raise ValueError('the body of %s was not kept' % self.filename)
+
+    def release(self, path):
+        """ drops the body from memory, it is read from path from now on.
+        """
+        self.path = path
+        self.body = None
+
+    def __eq__(self, other):
+        if not isinstance(other, Attachment):
+            return NotImplemented
+        for name in self.__slots__:
+            if getattr(self, name) != getattr(other, name):
+                return False
+        return True
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return equal
+        return not equal
+
+    def __repr__(self):
+        if self.size is None:
+            return '<Attachment %r %s>' % (self.filename, self.mime_type)
+        return '<Attachment %r %s, %d bytes>' % (self.filename,
+                                                 self.mime_type, self.size)
+
+
 def unpackMail(mailString):
     """ returns body, content-type, html-body and attachments for mail-string.
     """
-    return unpackMultifile(multifile.MultiFile(StringIO.StringIO(mailString)))
+    return unpackMultifile(multifile.MultiFile(StringIO.StringIO(mailString)),
+                           data=mailString)
 
 
-def unpackMultifile(multifile, attachments=None):
+def parseMailString(mailString, keepBodies=True):
+    """ returns headers (a mimetools.Message), body, content-type, html-body
+        and attachments for mail-string, parsing the mail only once.
+    """
+    mailFile = multifile.MultiFile(StringIO.StringIO(mailString))
+    msg = mimetools.Message(mailFile)
+    return (msg,) + unpackMultifile(mailFile, msg=msg, data=mailString,
+                                    keepBodies=keepBodies)
+
+
+def unpackMultifile(multifile, attachments=None, msg=None, data=None,
+                    keepBodies=True):
     """ Unpack multifile into plainbody, content-type, htmlbody and attachments.
+
+    If multifile reads the string data, bodies are decoded from it in bulk
+    (see decodePart).  Unless keepBodies is true, the bodies of named
+    attachments are skipped without being decoded.
     """
     if attachments is None:
         attachments=[]
     textBody = htmlBody = contentType = ''
 
-    msg = mimetools.Message(multifile)
+    if msg is None:
+        msg = mimetools.Message(multifile)
     maintype = msg.getmaintype()
     subtype = msg.getsubtype()
 
@@ -137,7 +238,8 @@ def unpackMultifile(multifile, attachments=None):
             multifile.next()
 
             (tmpTextBody, tmpContentType, tmpHtmlBody, tmpAttachments) = \
-                                       unpackMultifile(multifile, attachments)
+                                unpackMultifile(multifile, attachments, data=data,
+                                                keepBodies=keepBodies)
 
             # Return ContentType only for the plain-body of a mail
             if tmpContentType and not textBody:
@@ -153,20 +255,20 @@ def unpackMultifile(multifile, attachments=None):
         multifile.pop()
         return (textBody, contentType, htmlBody, attachments)
 
-    # Process MIME-encoded data
-    plainfile = StringIO.StringIO()
+    isPlain = maintype == 'text' and subtype == 'plain' and not name
 
-    try:
-        mimetools.decode(multifile,plainfile,msg.getencoding())
-    # unknown or no encoding? 7bit, 8bit or whatever... copy literal
-    except ValueError:
-        mimetools.copyliteral(multifile,plainfile)
-
-    body = plainfile.getvalue()
-    plainfile.close()
+    # Process MIME-encoded data
+    if isPlain or not name or keepBodies:
+        plainfile = StringIO.StringIO()
+        decodePart(msg, multifile, plainfile, data)
+        body = plainfile.getvalue()
+        plainfile.close()
+    else:
+        skipPart(multifile, data)
+        body = None
 
     # Get plain text
-    if maintype == 'text' and subtype == 'plain' and not name:
+    if isPlain:
         textBody = body
         contentType = msg.get('content-type', 'text/plain')
     else:
@@ -175,14 +277,155 @@ def unpackMultifile(multifile, attachments=None):
             name = '%s.%s' % (maintype,subtype)
             htmlBody = body
 
-        attachments.append({'filename' : mime_decode_header(name),
-                            'filebody' : body,
-                            'maintype' : maintype,
-                            'subtype' : subtype})
+        attachments.append(Attachment(mime_decode_header(name),
+                                      maintype, subtype, body))
 
     return (textBody, contentType, htmlBody, attachments)
 
 
+# Bulk decoding.  multifile.MultiFile reads a body line by line, checking
+# every line for a boundary, and mimetools.decode decodes it line by line
+# as well.  When the mail is available as a string (or mmap), the end of
+# the body is found with find() instead and the body is decoded in blocks
+# of lines, giving the same result.
+
+# Bodies are decoded in blocks of about this many bytes
+DECODE_BLOCK_SIZE = 1 << 20
+
+BASE64_CHARACTERS = string.ascii_letters + string.digits + '+/'
+
+UU_ENCODINGS = ('uuencode', 'x-uuencode', 'uue', 'x-uue')
+
+
+def findBoundary(data, start, boundaries):
+    r""" returns the offset of the first line from start on that a MultiFile
+        would take for one of boundaries, or the length of data.
+
+        >>> data = 'body\n--b-not\n--b  \nrest'
+        >>> findBoundary(data, 0, ['b'])
+        13
+        >>> findBoundary(data, 0, ['a']) == len(data)
+        True
+    """
+    end = len(data)
+    if not boundaries:
+        return end
+    markers = set()
+    for boundary in boundaries:
+        markers.add('--' + boundary)
+        markers.add('--' + boundary + '--')
+    pos = start
+    while pos < end:
+        if data[pos:pos + 2] != '--':
+            pos = data.find('\n--', pos, end)
+            if pos < 0:
+                return end
+            pos += 1
+        eol = data.find('\n', pos, end)
+        if eol < 0:
+            eol = end
+        else:
+            eol += 1
+        if data[pos:eol].rstrip() in markers:
+            return pos
+        pos = eol
+    return end
+
+
+def decodeBase64(block):
+    r""" returns a block of base64 lines decoded, like base64.decode decodes
+        them line by line.
+
+    Padding ends the data decoded from a line, so the block is decoded at
+    once only if all lines but the last are of the same width, holding
+    whole groups of four base64 characters and nothing else.
+
+        >>> decodeBase64('SGVs\nbG8g\nd29ybGQ=\n')
+        'Hello world'
+        >>> decodeBase64('SGk=\nSGk=\n')
+        'HiHi'
+    """
+    last = block.rfind('\n', 0, len(block) - 1) + 1
+    width = block.find('\n') + 1
+    if last and last % width == 0:
+        lines = last // width
+        content = width - 1
+        if block[width - 2:width] == '\r\n':
+            content -= 1
+        if (content % 4 == 0 and
+            block.count('\n', 0, last) == lines and
+            block[width - 1:last:width] == '\n' * lines and
+            (content == width - 1 or
+             block[width - 2:last:width] == '\r' * lines) and
+            not block[:last].translate(None, BASE64_CHARACTERS + '\r\n')):
+            return (binascii.a2b_base64(block[:last]) +
+                    binascii.a2b_base64(block[last:]))
+    return ''.join(map(binascii.a2b_base64, block.split('\n')))
+
+
+def decodeRange(data, start, end, encoding, output):
+    """ writes data[start:end], encoded with encoding, decoded to output,
+        in blocks of whole lines.
+    """
+    if encoding == 'base64':
+        decode = decodeBase64
+    elif encoding == 'quoted-printable':
+        decode = binascii.a2b_qp
+    else:
+        # copied literally, like mimetools.copyliteral does
+        decode = None
+    while start < end:
+        stop = min(start + DECODE_BLOCK_SIZE, end)
+        if stop < end:
+            stop = data.find('\n', stop - 1, end) + 1 or end
+        block = data[start:stop]
+        if decode is not None:
+            block = decode(block)
+        output.write(block)
+        start = stop
+
+
+def decodePart(msg, multifile, output, data=None):
+    """ decodes the body of the part described by msg into output.
+
+    If data is given, it is what the file multifile reads holds: the body
+    is then located in data and decoded in bulk, and the file is moved
+    past it.
+    """
+    encoding = msg.getencoding()
+    if (data is not None and multifile.level == 0 and
+        encoding not in UU_ENCODINGS):
+        start = multifile.fp.tell()
+        end = findBoundary(data, start, multifile.stack)
+        decodeRange(data, start, end, encoding, output)
+        multifile.fp.seek(end)
+        # read the boundary line, so multifile ends up where it would have
+        multifile.readline()
+        return
+    if encoding in ('7bit', '8bit'):
+        # mimetools.decode would read the whole body into memory
+        mimetools.copyliteral(multifile, output)
+        return
+    try:
+        mimetools.decode(multifile, output, encoding)
+    # unknown or no encoding? 7bit, 8bit or whatever... copy literal
+    except ValueError:
+        mimetools.copyliteral(multifile, output)
+
+
+def skipPart(multifile, data=None):
+    """ moves multifile past the body of the current part, without decoding
+        it.  data is what decodePart takes.
+    """
+    if data is not None and multifile.level == 0:
+        multifile.fp.seek(findBoundary(data, multifile.fp.tell(),
+                                       multifile.stack))
+        multifile.readline()
+        return
+    while multifile.readline():
+        pass
+
+
 def convertHTML2Text(html):
     """ converts given html to plain text.
     """
@@ -11,21 +11,34 @@
 # You should have received a copy of the GNU General Public License
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
-import email
 import os
 import sys
+import mmap
+import atexit
 import urllib
 import urllib2
 import base64
+import string
 import hashlib
+import optparse
+import time
+import tempfile
 from StringIO import StringIO
 
-from nous.mailpost.mailboxer_tools import unpackMail
-from nous.mailpost.MailBoxerTools import getPlainBodyFromMail
+from nous.mailpost.mailboxer_tools import unpackMail, parseMail, ParsedMail
+from nous.mailpost.formdata import MultipartBody, SegmentedBody, QuotedFile
+from nous.mailpost.index import AttachmentIndex
+from nous.mailpost.storepool import StoreError, StorePool, PooledWriter
+from nous.mailpost.limits import SizeLimit, SizeLimitExceeded, LimitedReader
+from nous.mailpost.metrics import StatsdSink
+from nous.mailpost.trace import Trace, SlowMessageLog, NULL_SPAN
+from nous.mailpost.trace import getTrace, setTrace, startStage, bindTrace
+from nous.mailpost.MailBoxerTools import Attachment, getPlainBodyFromMail
 from nous.mailpost.MailBoxerTools import headersAsString
 
 
 # Meaningful exit-codes for a smtp-server
+EXIT_OK = 0
 EXIT_USAGE = 64
 EXIT_NOUSER = 67
 EXIT_NOPERM = 77
@@ -70,17 +83,349 @@ def installBrokenRedirectHandler():
     urllib2.install_opener(opener)
 
 
-def postEmail(callURL, mailString, authorization, attachments):
-    req = urllib2.Request(callURL)
+def getUmask():
+    """Return the umask of the process, leaving it unchanged."""
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+# Mode of stored attachments, the one open() would create them with.
+# The umask is read once, changing it is not safe while threads run.
+attachment_mode = 0666 & ~getUmask()
+
+# Persistent connections used by postEmail instead of urllib2, if set
+connection_pool = None
+
+# Post multipart/form-data instead of urlencoded forms
+multipart_post = False
+
+# Record stored attachments in the index of the upload directory
+index_attachments = True
+
+# Algorithm hashing attachments into the keys they are stored under
+hash_algorithm = 'md5'
+
+# Threads hashing and writing attachments, if set
+store_pool = None
+
+# Biggest mail and total of decoded attachment bytes accepted, 0 for any
+max_mail_size = 0
+max_attachment_bytes = 0
+
+# Counters and histograms of the pipeline (see metrics.py), if set
+metrics = None
+
+# Receives the events of delivering messages (see trace.py), if set
+tracer = None
+
+
+def installConnectionPool(pool):
+    """Make postEmail reuse the connections of pool.
+
+    Used by long running processes that post many messages to the same
+    hosts.  Pass None to go back to a new urllib2 request per message.
+    """
+    global connection_pool
+    connection_pool = pool
+
+
+def setMultipartPost(enabled):
+    """Make postEmail send multipart/form-data instead of urlencoded forms.
+
+    The field names stay the same, so the receiving side can accept
+    either format.
+    """
+    global multipart_post
+    multipart_post = enabled
+
+
+def setAttachmentIndex(enabled):
+    """Turn recording stored attachments in the index (see index.py) on
+    or off.
+    """
+    global index_attachments
+    index_attachments = enabled
+
+
+def installStorePool(pool):
+    """Make attachments hashed and written by the threads of pool.
+
+    pool is a nous.mailpost.storepool.StorePool.  Pass None to store
+    attachments in the delivering thread again.
+    """
+    global store_pool
+    store_pool = pool
+
+
+def setHashAlgorithm(algorithm):
+    """Make attachments stored from now on keyed by algorithm.
+
+    Attachments stored with other algorithms before stay where they are,
+    their keys tell them apart.  Raises ValueError if the algorithm is
+    not available.
+    """
+    global hash_algorithm
+    getHash(algorithm)
+    hash_algorithm = algorithm
+
+
+def installMetrics(registry):
+    """Make the pipeline count what it does in registry.
+
+    registry is a nous.mailpost.metrics.Registry or StatsdSink.  Pass
+    None to stop counting.
+    """
+    global metrics
+    metrics = registry
+
+
+def countMetric(name, value=1, **labels):
+    if metrics is not None:
+        metrics.inc(name, value, **labels)
+
+
+def observeMetric(name, value, **labels):
+    if metrics is not None:
+        metrics.observe(name, value, **labels)
+
+
+def recordExitCode(code):
+    """Count a message delivered with the exit code, return the code."""
+    countMetric('exit_codes_total', code=code)
+    return code
+
+
+def getMailSize(mail):
+    """Return the size of the mail a ParsedMail was parsed from."""
+    if mail.original is not None:
+        return len(mail.original)
+    return mail.recorder.offset
+
+
+def recordMessage(mail, parse_seconds, store_seconds):
+    """Count a processed ParsedMail and its attachments, and note them in
+    the trace of the message."""
+    trace = getTrace()
+    if trace is not None:
+        trace.size = getMailSize(mail)
+        trace.setMail(mail)
+    if metrics is None:
+        return
+    size = getMailSize(mail)
+    metrics.inc('messages_total')
+    metrics.inc('received_bytes_total', size)
+    metrics.observe('parse_seconds', parse_seconds)
+    metrics.observe('store_seconds', store_seconds)
+    metrics.inc('attachments_total', len(mail.attachments))
+    metrics.inc('attachment_bytes_total',
+                sum([attachment.size or 0 for attachment in mail.attachments]))
+
+
+def installTracer(hook):
+    """Send the events of delivering messages to hook, a
+    nous.mailpost.trace.Tracer.  Pass None to stop tracing.
+    """
+    global tracer
+    tracer = hook
+
+
+def startTrace(callURLs):
+    """Start tracing the delivery of a message to callURLs in this thread.
+
+    Returns the Trace to set the exit codes on, or None when no tracer is
+    installed.
+    """
+    if tracer is None:
+        return None
+    trace = Trace(tracer, callURLs)
+    setTrace(trace)
+    return trace
+
+
+def setSizeLimits(max_size=0, max_attachments=0):
+    """Refuse mails bigger than max_size bytes, or with attachments that
+    decode to more than max_attachments bytes altogether.
+
+    Mails are refused with EXIT_NOPERM as soon as a limit is passed.  0
+    turns a limit off.
+    """
+    global max_mail_size, max_attachment_bytes
+    max_mail_size = max_size
+    max_attachment_bytes = max_attachments
+
+
+def limitInput(fp):
+    """Return a file reading fp that refuses to read past the size limit.
+    """
+    if not max_mail_size or isinstance(fp, LimitedReader):
+        return fp
+    return LimitedReader(fp, SizeLimit(max_mail_size, 'mail'))
+
+
+def checkMailSize(mailString):
+    """Refuse a mail given as string or mmap if it is too big."""
+    if max_mail_size and len(mailString) > max_mail_size:
+        raise SizeLimitExceeded('mail', max_mail_size)
+
+
+def getAttachmentLimit():
+    """Return the SizeLimit the attachments of a mail are counted against,
+    or None.
+    """
+    if not max_attachment_bytes:
+        return None
+    return SizeLimit(max_attachment_bytes, 'attachment')
+
+
+def getHash(algorithm):
+    """Return a new hash object of algorithm.
+
+    BLAKE2 comes with hashlib on Python 3, the pyblake2 package provides
+    it on Python 2.
+    """
+    if algorithm in ('blake2b', 'blake2s'):
+        constructor = getattr(hashlib, algorithm, None)
+        if constructor is None:
+            try:
+                import pyblake2
+            except ImportError:
+                raise ValueError('%s needs the pyblake2 package' % algorithm)
+            constructor = getattr(pyblake2, algorithm)
+        return constructor()
+    try:
+        return hashlib.new(algorithm)
+    except ValueError:
+        raise ValueError('unknown hash algorithm: %s' % algorithm)
+
+
+def makeAttachmentKey(algorithm, hexdigest):
+    """Return the key an attachment with the digest is stored under.
+
+    MD5 keys are the bare digest, as they always were, the keys of other
+    algorithms are prefixed with the name of the algorithm:
+
+        >>> makeAttachmentKey('md5', 'd41d8cd98f00b204e9800998ecf8427e')
+        'd41d8cd98f00b204e9800998ecf8427e'
+        >>> makeAttachmentKey('sha256', 'e3b0c442')
+        'sha256-e3b0c442'
+
+    """
+    if algorithm == 'md5':
+        return hexdigest
+    return '%s-%s' % (algorithm, hexdigest)
+
+
+def splitAttachmentKey(key):
+    """Return the algorithm and the digest of an attachment key.
+
+        >>> splitAttachmentKey('d41d8cd98f00b204e9800998ecf8427e')
+        ('md5', 'd41d8cd98f00b204e9800998ecf8427e')
+        >>> splitAttachmentKey('sha256-e3b0c442')
+        ('sha256', 'e3b0c442')
+
+    """
+    if '-' in key:
+        return tuple(key.split('-', 1))
+    return 'md5', key
+
+
+def getPostFields(mailString, attachments):
+    """Return the (name, value) pairs postEmail sends.
+
+    Attachments keyed by MD5 are posted in the md5[] fields the Zope side
+    always knew.  If any key is of another algorithm, all keys are posted
+    in digest[] fields instead, each followed by its algorithm:
+
+        >>> for field in getPostFields('mail', [Attachment('a.txt', 'text',
+        ...         'plain', digest='sha256-e3b0c442')]):
+        ...     print field
+        ('Mail', 'mail')
+        ('digest[]', 'sha256-e3b0c442')
+        ('digest-algorithm[]', 'sha256')
+        ('mime-type[]', 'text/plain')
+        ('filename[]', 'a.txt')
+
+    """
+    fields = [('Mail', mailString)]
+    keys = [getAttachmentFilename(attachment) for attachment in attachments]
+    legacy = not [key for key in keys
+                  if splitAttachmentKey(key)[0] != 'md5']
+    for attachment, key in zip(attachments, keys):
+        if legacy:
+            fields.append(('md5[]', key))
+        else:
+            fields.append(('digest[]', key))
+            fields.append(('digest-algorithm[]', splitAttachmentKey(key)[0]))
+        fields.append(('mime-type[]', attachment.mime_type))
+        fields.append(('filename[]', attachment.filename))
+    return fields
+
+
+def encodePostFields(fields):
+    """Encode fields as application/x-www-form-urlencoded.
+
+    Only the mail is quoted, the attachment fields are passed as is.
+    If the mail is given as a file, a SegmentedBody quoting it while it
+    is read is returned instead of a string.
+    """
+    segments = []
+    for name, value in fields:
+        if segments:
+            segments.append('&')
+        if name.startswith('Mail'):
+            if isinstance(value, str):
+                value = urllib.quote(value)
+            else:
+                value = QuotedFile(value)
+        segments.append('%s=' % name)
+        segments.append(value)
+    for segment in segments:
+        if not isinstance(segment, str):
+            return SegmentedBody(segments,
+                                 'application/x-www-form-urlencoded')
+    return ''.join(segments)
+
+
+def postForm(callURL, fields, authorization):
+    """Post the (name, value) pairs to callURL, return the response."""
+    headers = {}
     if authorization:
         auth = base64.encodestring(authorization).strip()
-        req.add_header('Authorization', 'Basic %s' % auth)
-    data = 'Mail='+urllib.quote(mailString)
-    for attachment in attachments:
-        data += '&md5[]=' + getAttachmentFilename(attachment)
-        data += '&mime-type[]=%s/%s' % (attachment['maintype'], attachment['subtype'])
-        data += '&filename[]=' + attachment['filename']
-    urllib2.urlopen(req, data=data)
+        headers['Authorization'] = 'Basic %s' % auth
+    if multipart_post:
+        data = MultipartBody(fields)
+        headers['Content-Type'] = data.content_type
+    else:
+        data = encodePostFields(fields)
+    started = time.time()
+    status = 'error'
+    span = startStage('post', url=callURL)
+    try:
+        if connection_pool is not None:
+            status, body = connection_pool.request(callURL, data, headers)
+            return StringIO(body)
+        req = urllib2.Request(callURL)
+        for header, value in headers.items():
+            req.add_header(header, value)
+        if not isinstance(data, str):
+            if data.length is None:
+                data = data.read()
+            else:
+                req.add_header('Content-Length', str(data.length))
+        response = urllib2.urlopen(req, data=data)
+        status = getattr(response, 'code', 200)
+        return response
+    except urllib2.HTTPError, e:
+        status = e.code
+        raise
+    finally:
+        observeMetric('post_seconds', time.time() - started, status=status)
+        span.end(status=status)
+
+
+def postEmail(callURL, mailString, authorization, attachments):
+    postForm(callURL, getPostFields(mailString, attachments), authorization)
 
 
 def getAuthorization(url):
@@ -95,7 +440,21 @@ def stripAuthentication(url):
 
 
 def getAttachmentFilename(attachment):
-    return hashlib.md5(attachment['filebody']).hexdigest()
+    # remember the key, so big bodies are hashed only once
+    if attachment.digest is None:
+        digest = getHash(hash_algorithm)
+        if attachment.body is not None:
+            digest.update(attachment.body)
+        else:
+            body = attachment.open()
+            try:
+                for chunk in iter(lambda: body.read(65536), ''):
+                    digest.update(chunk)
+            finally:
+                body.close()
+        attachment.digest = makeAttachmentKey(hash_algorithm,
+                                              digest.hexdigest())
+    return attachment.digest
 
 
 def copy_chunked(source, dest, chunk_size):
@@ -118,9 +477,97 @@ def copy_chunked(source, dest, chunk_size):
     return size
 
 
-def storeAttacment(attachment, upload_dir):
-    filename = getAttachmentFilename(attachment)
+# The layout of upload directories without a .layout file
+LEGACY_LAYOUT = 'legacy'
+
+# Layouts read from .layout files, by upload directory: (mtime, layout)
+layouts = {}
+
+
+def parseLayout(spec):
+    """Return the layout described by spec.
+
+    A layout is either LEGACY_LAYOUT, which splits the digest into
+    directories of 8 characters, or a fan-out: directories named after
+    the first characters of the digest, holding files named after the
+    full digest.
+
+        >>> parseLayout('2/2')
+        (2, 2)
+        >>> parseLayout('legacy\\n')
+        'legacy'
+        >>> parseLayout('2/x')
+        Traceback (most recent call last):
+        ...
+        ValueError: invalid layout: '2/x'
+
+    """
+    spec = spec.strip()
+    if spec == LEGACY_LAYOUT:
+        return LEGACY_LAYOUT
+    try:
+        fanout = tuple([int(width) for width in spec.split('/')])
+    except ValueError:
+        fanout = ()
+    if not fanout or [width for width in fanout if width < 1]:
+        raise ValueError('invalid layout: %r' % spec)
+    return fanout
+
+
+def formatLayout(layout):
+    if layout == LEGACY_LAYOUT:
+        return LEGACY_LAYOUT
+    return '/'.join([str(width) for width in layout])
+
+
+def getLayout(upload_dir):
+    """Return the layout of upload_dir, as set in its .layout file.
+
+    The file is read again when it changes, so a running server follows
+    `mailpost migrate`.
+    """
+    path = os.path.join(upload_dir, '.layout')
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        return LEGACY_LAYOUT
+    cached = layouts.get(upload_dir)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    layout = parseLayout(open(path).read())
+    layouts[upload_dir] = (mtime, layout)
+    return layout
+
+
+def getAttachmentPath(filename, upload_dir, layout=None):
+    """Return the path in upload_dir where the attachment is stored.
+
+    Without a layout, the one of upload_dir is used.  Keys of algorithms
+    other than MD5 are kept in a directory of their own.
+
+        >>> getAttachmentPath('d41d8cd98f00b204e9800998ecf8427e', '/upload')
+        '/upload/d41d8cd9/8f00b204/e9800998/ecf8427e'
+        >>> getAttachmentPath('d41d8cd98f00b204e9800998ecf8427e', '/upload',
+        ...                   (2, 2))
+        '/upload/d4/1d/d41d8cd98f00b204e9800998ecf8427e'
+        >>> getAttachmentPath('sha256-e3b0c44298fc1c14', '/upload', (2, 2))
+        '/upload/sha256/e3/b0/e3b0c44298fc1c14'
+
+    """
+    if layout is None:
+        layout = getLayout(upload_dir)
     dir_path = [upload_dir]
+    algorithm, filename = splitAttachmentKey(filename)
+    if algorithm != 'md5':
+        dir_path.append(algorithm)
+    if layout != LEGACY_LAYOUT:
+        start = 0
+        for width in layout:
+            dir_path.append(filename[start:start + width])
+            start += width
+        dir_path.append(filename)
+        return os.path.join(*dir_path)
+
     segment = ''
     for c in list(filename):
         segment += c
@@ -129,34 +576,328 @@ def storeAttacment(attachment, upload_dir):
             segment = ''
     if segment:
         dir_path.append(segment)
-    filename = os.path.join(*dir_path)
-    if os.path.exists(filename):
+    return os.path.join(*dir_path)
+
+
+def getAttachmentDigest(path, upload_dir):
+    """Return the key of the attachment stored at path, in any layout.
+
+        >>> getAttachmentDigest('/upload/d4/1d/d41d8cd98f00b204e9800998ecf8427e',
+        ...                     '/upload')
+        'd41d8cd98f00b204e9800998ecf8427e'
+        >>> getAttachmentDigest('/upload/d41d8cd9/8f00b204/e9800998/ecf8427e',
+        ...                     '/upload')
+        'd41d8cd98f00b204e9800998ecf8427e'
+        >>> getAttachmentDigest('/upload/sha256/e3/b0/e3b0c44298fc1c14',
+        ...                     '/upload')
+        'sha256-e3b0c44298fc1c14'
+
+    """
+    parts = path[len(upload_dir):].strip(os.sep).split(os.sep)
+    algorithm = 'md5'
+    if parts[0].strip(string.hexdigits):
+        algorithm = parts.pop(0)
+    if parts[-1].startswith(''.join(parts[:-1])):
+        return makeAttachmentKey(algorithm, parts[-1])
+    return makeAttachmentKey(algorithm, ''.join(parts))
+
+
+class AttachmentWriter(object):
+    """Temporary file in the upload directory that hashes its contents.
+
+    The digest is updated with every chunk written, so an attachment is
+    hashed in the same pass that writes it.  commit() then atomically
+    renames the file to its content addressed path, or removes it if an
+    identical attachment is stored already.
+    """
+
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        fd, self.tmp_path = tempfile.mkstemp(dir=upload_dir,
+                                             prefix='.incoming-')
+        # mkstemp creates the file 0600, readable by nobody else
+        os.fchmod(fd, attachment_mode)
+        self.file = os.fdopen(fd, 'wb')
+        self.algorithm = hash_algorithm
+        self.digest = getHash(self.algorithm)
+        self.size = 0
+        self.stored_already = False
+        self.span = NULL_SPAN
+
+    def write(self, data):
+        self.digest.update(data)
+        self.size += len(data)
+        self.file.write(data)
+
+    def close(self):
+        self.file.close()
+
+    def hexdigest(self):
+        return self.digest.hexdigest()
+
+    def key(self):
+        return makeAttachmentKey(self.algorithm, self.hexdigest())
+
+    def commit(self):
+        """Move the file into the store, return its path."""
+        self.close()
+        filename = getAttachmentPath(self.key(), self.upload_dir)
+        if os.path.exists(filename):
+            countMetric('store_dedup_hits_total')
+            self.stored_already = True
+            os.unlink(self.tmp_path)
+            return filename
+
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:
+                # somebody else might have created it meanwhile
+                if not os.path.isdir(dirname):
+                    raise
+        os.rename(self.tmp_path, filename)
+        return filename
+
+    def discard(self):
+        self.close()
+        if os.path.exists(self.tmp_path):
+            os.unlink(self.tmp_path)
+
+
+def lockIndex(upload_dir):
+    """Return the AttachmentIndex of upload_dir with its log locked shared,
+    or None if attachments are not indexed.
+
+    Hold it from finding or putting an attachment in the store until
+    indexAttachment recorded the reference, so `mailpost gc` can't
+    remove the attachment in between.
+    """
+    if not index_attachments:
+        return None
+    index = AttachmentIndex(upload_dir)
+    try:
+        index.lockShared()
+    except EnvironmentError, e:
+        log_warning('Could not lock attachment index in %s: %s'
+                    % (upload_dir, e))
+        return None
+    return index
+
+
+def indexAttachment(attachment, index):
+    """Record in the index returned by lockIndex that a message references
+    the attachment.  The caller unlocks the index."""
+    if index is None:
         return
+    try:
+        index.add(getAttachmentFilename(attachment), attachment.size,
+                  attachment.mime_type)
+    except EnvironmentError, e:
+        # the attachment is stored, only its reference count is off
+        log_warning('Could not index attachment in %s: %s'
+                    % (index.upload_dir, e))
 
-    os.makedirs(os.path.dirname(filename))
-    f = open(filename, 'w')
-    size = copy_chunked(StringIO(attachment['filebody']), f, 4096)
-    f.close()
+
+def storeAttacment(attachment, upload_dir):
+    """Store the attachment, its body is read from the store afterwards.
+
+    Bodies are hashed while they are written, unless their key is known
+    already and they are found in the store.
+    """
+    span = startStage('attachment', filename=attachment.filename,
+                      type=attachment.mime_type)
+    stored_already = False
+    index = lockIndex(upload_dir)
+    try:
+        if attachment.digest is not None:
+            filename = getAttachmentPath(attachment.digest, upload_dir)
+            stored_already = os.path.exists(filename)
+        if stored_already:
+            countMetric('store_dedup_hits_total')
+            if attachment.size is None:
+                attachment.size = os.path.getsize(filename)
+        else:
+            writer = AttachmentWriter(upload_dir)
+            try:
+                body = attachment.open()
+                try:
+                    attachment.size = copy_chunked(body, writer, 65536)
+                finally:
+                    body.close()
+                attachment.digest = writer.key()
+                filename = writer.commit()
+                stored_already = writer.stored_already
+            finally:
+                writer.discard()
+        attachment.release(filename)
+        indexAttachment(attachment, index)
+    finally:
+        if index is not None:
+            index.unlock()
+    span.end(size=attachment.size, stored_already=stored_already)
+
+
+def storeAttachments(attachments, upload_dir):
+    """Store the attachments, in the threads of the store pool if set.
+
+    All attachments are tried, the ones that could not be stored are
+    reported together in a StoreError.
+    """
+    errors = []
+    jobs = []
+    for attachment in attachments:
+        if (store_pool is not None and
+            attachment.size >= store_pool.min_size):
+            jobs.append((attachment, store_pool.submit(
+                bindTrace(storeAttacment), attachment, upload_dir)))
+            continue
+        try:
+            storeAttacment(attachment, upload_dir)
+        except EnvironmentError, e:
+            errors.append((attachment, e))
+    for attachment, job in jobs:
+        error = job.wait()
+        if error is not None:
+            errors.append((attachment, error))
+    if errors:
+        raise StoreError(errors)
+
+
+def commitAttachments(writers, upload_dir):
+    """Move the attachments written into the store.
+
+    writers holds (attachment, AttachmentWriter, output) triples, where
+    output is what the attachment was written to.  Like
+    storeAttachments, errors are collected in a StoreError.
+    """
+    errors = []
+    for attachment, writer, output in writers:
+        try:
+            if output is not writer:
+                output.wait()
+            attachment.digest = writer.key()
+            attachment.size = writer.size
+            index = lockIndex(upload_dir)
+            try:
+                attachment.release(writer.commit())
+                indexAttachment(attachment, index)
+            finally:
+                if index is not None:
+                    index.unlock()
+            writer.span.end(size=writer.size,
+                            stored_already=writer.stored_already)
+        except EnvironmentError, e:
+            errors.append((attachment, e))
+    if errors:
+        raise StoreError(errors)
+
+
+def processAttachmentsStream(fp, upload_dir, original=None):
+    """Like processAttachments, but reads the mail incrementally from fp.
+
+    Attachment bodies are hashed while they are decoded into temporary
+    files in upload_dir and renamed into place afterwards, so they are
+    never held in memory.  With a store pool installed, they are hashed
+    and written by its threads while the next ones are decoded.  If fp
+    reads a buffer that can be sliced, like an mmap, pass it as original:
+    the mail to post is then returned as a file reading it from there.
+    """
+    writers = []
+    def openAttachment(attachment):
+        writer = output = AttachmentWriter(upload_dir)
+        # from decoding it to storing it
+        writer.span = startStage('attachment', filename=attachment.filename,
+                                 type=attachment.mime_type)
+        if store_pool is not None:
+            output = PooledWriter(store_pool, writer)
+        writers.append((attachment, writer, output))
+        return output
+
+    try:
+        started = time.time()
+        span = startStage('parse')
+        mail = ParsedMail(fp, openAttachment, original, getAttachmentLimit())
+        parsed = time.time()
+        span.end(attachments=len(mail.attachments))
+        span = startStage('store')
+        commitAttachments(writers, upload_dir)
+        span.end()
+        recordMessage(mail, parsed - started, time.time() - parsed)
+    finally:
+        for attachment, writer, output in writers:
+            if output is not writer:
+                # the pool may still be writing after an error
+                output.idle.wait()
+            writer.discard()
+
+    if original is not None:
+        return mail.mailFile(), mail.attachments
+    return mail.mailString(), mail.attachments
 
 
 def processAttachments(mailString, upload_dir):
-    # check to see if we have attachments
-    text_body, content_type, html_body, attachments = unpackMail(mailString)
+    if isinstance(mailString, mmap.mmap):
+        checkMailSize(mailString)
+        mailString.seek(0)
+        return processAttachmentsStream(mailString, upload_dir,
+                                        original=mailString)
+    if not isinstance(mailString, str):
+        return processAttachmentsStream(limitInput(mailString), upload_dir)
+    checkMailSize(mailString)
 
-    num_attachments = len(attachments)
-    if num_attachments or html_body:
-        mail = email.message_from_string(mailString)
-        mail.set_payload(mail.get_payload()[0])
-        mailString = mail.as_string()
+    # the mail is parsed only once, if it has attachments the mail to
+    # post is cut from the same pass
+    started = time.time()
+    span = startStage('parse')
+    mail = parseMail(mailString, attachmentLimit=getAttachmentLimit())
+    parsed = time.time()
+    span.end(attachments=len(mail.attachments))
 
     # store attachment on the filesystem
-    for attachment in attachments:
-        storeAttacment(attachment, upload_dir)
+    span = startStage('store')
+    storeAttachments(mail.attachments, upload_dir)
+    span.end()
+    recordMessage(mail, parsed - started, time.time() - parsed)
+
+    return mail.mailString(), mail.attachments
 
-    return mailString, attachments
+
+def mapMail(f):
+    """Return a read-only mmap of the mail in the open file f.
+
+    Empty files can't be mapped, they give an empty string.
+    """
+    if not os.fstat(f.fileno()).st_size:
+        return ''
+    return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def spillInput(fp, threshold, spill_dir=None):
+    """Read the mail from fp.
+
+    Mails of up to threshold bytes are returned as a string.  Bigger
+    ones are copied to an anonymous temporary file in spill_dir and
+    returned as an mmap of it, so they are not held in memory.
+    """
+    data = fp.read(threshold + 1)
+    if len(data) <= threshold:
+        return data
+    spill = tempfile.TemporaryFile(prefix='.incoming-mail-', dir=spill_dir)
+    try:
+        spill.write(data)
+        del data
+        copy_chunked(fp, spill, 65536)
+        spill.flush()
+        return mapMail(spill)
+    finally:
+        # the mapping stays valid after the file is closed
+        spill.close()
 
 
 def processEmailAndPost(callURL, mailString, upload_dir):
+    """Process and post the mail given as a string, an mmap or a file to
+    read."""
     # XXX refactor and test
     urlParts = urllib2.urlparse.urlparse(callURL)
     urlPath = '/'.join(filter(None, list(urlParts)[2].split('/'))[:-1])
@@ -171,8 +912,155 @@ def processEmailAndPost(callURL, mailString, upload_dir):
     postEmail(callURL, mailString, authorization, attachments)
 
 
+def getExitCode(e, callURL):
+    """Log the error e of posting to callURL, return the exit code for it."""
+    # Too big? Refuse it for good, the MTA bounces it to the sender.
+    if isinstance(e, SizeLimitExceeded):
+        log_error('Refused email for %s: %s' % (callURL, e))
+        return EXIT_NOPERM
+    # If MailBoxer doesn't exist, bounce message with EXIT_NOUSER,
+    # so the sender will receive a "user-doesn't-exist"-mail from MTA.
+    if hasattr(e, 'code'):
+        if e.code == 404:
+            log_error("URL at %s doesn't exist (%s)" % (callURL, e))
+            return EXIT_NOUSER
+        else:
+            # Server down? EXIT_TEMPFAIL causes the MTA to try again later.
+            log_error('A problem, "%s", occurred uploading email to URL %s (error code was %s)' % (e, callURL, e.code))
+            return EXIT_TEMPFAIL
+    else:
+        # Server down? EXIT_TEMPFAIL causes the MTA to try again later.
+        log_error('A problem, "%s", occurred uploading email to server %s' % (e, callURL))
+        return EXIT_TEMPFAIL
+
+
+def deliverEmail(callURL, mailString, upload_dir):
+    """Process and post the email, return the exit code for the MTA."""
+    trace = startTrace([stripAuthentication(callURL)])
+    try:
+        processEmailAndPost(callURL, mailString, upload_dir)
+    except Exception, e:
+        code = getExitCode(e, callURL)
+    else:
+        code = EXIT_OK
+    if trace is not None:
+        setTrace(None)
+        try:
+            trace.setExitCode(stripAuthentication(callURL), code)
+        except Exception, e:
+            # tracing never changes the exit code
+            log_warning('Could not trace email for %s: %s'
+                        % (stripAuthentication(callURL), e))
+    return recordExitCode(code)
+
+
 def main():
     args = list(sys.argv)
+    if len(args) > 1 and args[1] == 'serve':
+        from nous.mailpost.lmtp import serve
+        serve(args[2:])
+        return
+    if len(args) > 1 and args[1] == 'drain':
+        from nous.mailpost.spool import drain
+        drain(args[2:])
+        return
+    if len(args) > 1 and args[1] == 'gc':
+        from nous.mailpost.index import gc
+        gc(args[2:])
+        return
+    if len(args) > 1 and args[1] == 'migrate':
+        from nous.mailpost.layout import migrate
+        migrate(args[2:])
+        return
+
+    parser = optparse.OptionParser(
+        usage='%prog [options] URL UPLOAD_DIR SENDER RECIPIENT')
+    # options go before the URL, the rest is passed on by the MTA
+    parser.disable_interspersed_args()
+    parser.add_option('--multipart', dest='multipart', action='store_true',
+                      default=False,
+                      help='post multipart/form-data instead of urlencoded'
+                      ' forms')
+    parser.add_option('--spool', dest='spool', default=None,
+                      help='accept the mail into this spool directory and'
+                      ' leave posting it to `mailpost drain`')
+    parser.add_option('--no-index', dest='index', action='store_false',
+                      default=True,
+                      help='do not record stored attachments in the index'
+                      ' of the upload directory')
+    parser.add_option('--hash', dest='hash', default='md5',
+                      help='hash attachments with this algorithm, like'
+                      ' sha256 or blake2b (default: md5)')
+    parser.add_option('--store-threads', dest='store_threads', type='int',
+                      default=0,
+                      help='hash and write attachments in this many threads'
+                      ' (default: 0, in the delivering thread)')
+    parser.add_option('--file', dest='mail_file', default=None,
+                      help='read the mail from this file instead of stdin')
+    parser.add_option('--max-size', dest='max_size', type='int', default=0,
+                      metavar='BYTES',
+                      help='refuse mails bigger than this while they are'
+                      ' read (default: 0, no limit)')
+    parser.add_option('--max-attachment-bytes', dest='max_attachments',
+                      type='int', default=0, metavar='BYTES',
+                      help='refuse mails with attachments that decode to'
+                      ' more than this altogether (default: 0, no limit)')
+    parser.add_option('--statsd', dest='statsd', default=None,
+                      metavar='HOST:PORT',
+                      help='send metrics to this statsd server on exit')
+    parser.add_option('--metrics-file', dest='metrics_file', default=None,
+                      metavar='PATH',
+                      help='append metrics to this file on exit, in the'
+                      ' statsd line format')
+    parser.add_option('--slow-log', dest='slow_log', default=None,
+                      metavar='PATH',
+                      help='append a line of JSON describing the message to'
+                      ' this file if it is slow to deliver')
+    parser.add_option('--slow-threshold', dest='slow_threshold',
+                      type='float', default=1.0, metavar='SECONDS',
+                      help='messages taking longer than this to deliver are'
+                      ' slow (default: 1)')
+    parser.add_option('--profile', dest='profile', default=None,
+                      metavar='DIR',
+                      help='profile the delivery into this directory')
+    parser.add_option('--profile-report', dest='profile_report', type='int',
+                      default=100, metavar='N',
+                      help='aggregate the profiles in a report once there'
+                      ' are this many (default: 100, 0 to never do so)')
+    parser.add_option('--spill', dest='spill', type='int', default=1048576,
+                      metavar='BYTES',
+                      help='copy mails bigger than this from stdin to a'
+                      ' temporary file in the upload directory and work'
+                      ' on a memory map of it (default: 1MB, 0 to never'
+                      ' do so)')
+    options, positional = parser.parse_args(args[1:])
+    args = args[:1] + positional
+    setMultipartPost(options.multipart)
+    setAttachmentIndex(options.index)
+    setSizeLimits(options.max_size, options.max_attachments)
+    try:
+        setHashAlgorithm(options.hash)
+    except ValueError, e:
+        log_critical(str(e))
+        sys.exit(EXIT_USAGE)
+    if options.store_threads > 0:
+        installStorePool(StorePool(options.store_threads))
+    if options.statsd or options.metrics_file:
+        address = None
+        if options.statsd:
+            host, _, port = options.statsd.rpartition(':')
+            try:
+                address = (host or 'localhost', int(port))
+            except ValueError:
+                log_critical('statsd address (%s) is invalid' % options.statsd)
+                sys.exit(EXIT_USAGE)
+        sink = StatsdSink(address, options.metrics_file)
+        installMetrics(sink)
+        # sent however the script exits
+        atexit.register(sink.flush)
+    if options.slow_log:
+        installTracer(SlowMessageLog(options.slow_log, options.slow_threshold))
+
     args = args[:-2]
     # Check if we have at least one parameter
     if len(args) == 1:
@@ -199,22 +1087,61 @@ def main():
         log_critical('File upload directory (%s) is invalid' % upload_dir)
         sys.exit(EXIT_USAGE)
 
-    mailString = sys.stdin.read()
-    installBrokenRedirectHandler()
+    if options.profile:
+        from nous.mailpost.profiling import Profiler
+        try:
+            profiler = Profiler(options.profile, options.profile_report)
+        except EnvironmentError, e:
+            log_critical('Profile directory (%s) is invalid: %s'
+                         % (options.profile, e))
+            sys.exit(EXIT_USAGE)
+        profiler.run(deliverInput, options, callURL, upload_dir)
+    else:
+        deliverInput(options, callURL, upload_dir)
+
+
+def deliverInput(options, callURL, upload_dir):
+    """Read the mail as main's options say and deliver it, exit with the
+    exit code for the MTA."""
     try:
-        processEmailAndPost(callURL, mailString, upload_dir)
-    except Exception, e:
-        # If MailBoxer doesn't exist, bounce message with EXIT_NOUSER,
-        # so the sender will receive a "user-doesn't-exist"-mail from MTA.
-        if hasattr(e, 'code'):
-            if e.code == 404:
-                log_error("URL at %s doesn't exist (%s)" % (callURL, e))
-                sys.exit(EXIT_NOUSER)
-            else:
-                # Server down? EXIT_TEMPFAIL causes the MTA to try again later.
-                log_error('A problem, "%s", occurred uploading email to URL %s (error code was %s)' % (e, callURL, e.code))
-                sys.exit(EXIT_TEMPFAIL)
+        if options.mail_file:
+            mail = mapMail(open(options.mail_file, 'rb'))
         else:
-            # Server down? EXIT_TEMPFAIL causes the MTA to try again later.
-            log_error('A problem, "%s", occurred uploading email to server %s' % (e, callURL))
-            sys.exit(EXIT_TEMPFAIL)
+            mail = sys.stdin
+    except EnvironmentError, e:
+        log_critical('Could not read the mail from %s: %s'
+                     % (options.mail_file, e))
+        sys.exit(EXIT_USAGE)
+    if mail is sys.stdin:
+        # refused while it is read, before it is spooled or spilled
+        mail = limitInput(mail)
+    else:
+        try:
+            checkMailSize(mail)
+        except SizeLimitExceeded, e:
+            sys.exit(recordExitCode(getExitCode(e, callURL)))
+
+    if options.spool:
+        from nous.mailpost.spool import Spool
+        try:
+            spool = Spool(options.spool, replay=False)
+            spool.enqueue(callURL, mail, upload_dir)
+            spool.close()
+        except SizeLimitExceeded, e:
+            sys.exit(recordExitCode(getExitCode(e, callURL)))
+        except EnvironmentError, e:
+            log_error('Could not spool email for %s: %s' % (callURL, e))
+            sys.exit(recordExitCode(EXIT_TEMPFAIL))
+        sys.exit(recordExitCode(EXIT_OK))
+
+    if not isinstance(mail, (str, mmap.mmap)) and options.spill > 0:
+        try:
+            mail = spillInput(mail, options.spill, upload_dir)
+        except SizeLimitExceeded, e:
+            sys.exit(recordExitCode(getExitCode(e, callURL)))
+        except EnvironmentError, e:
+            log_error('Could not spill email for %s: %s' % (callURL, e))
+            sys.exit(recordExitCode(EXIT_TEMPFAIL))
+
+    installBrokenRedirectHandler()
+    sys.exit(deliverEmail(callURL, mail, upload_dir))
@@ -0,0 +1,218 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Posting many messages to the same URL in one request.
+
+A batch is posted as one form with the fields of every message suffixed
+with its index:
+
+    batch=2&Mail[0]=...&md5[0][]=...&Mail[1]=...
+
+The receiving side answers with one line per message, holding the index
+of the message and an HTTP status code for it:
+
+    0 200
+    1 404
+
+Each message gets the exit code the status would have given if it was
+posted alone; messages missing from the answer are retried later.
+"""
+import time
+import urllib2
+import threading
+
+import nous.mailpost
+from nous.mailpost import EXIT_OK
+from nous.mailpost import getPostFields, getExitCode, recordExitCode
+from nous.mailpost import getAuthorization, stripAuthentication
+from nous.mailpost.trace import setTrace, NULL_SPAN
+
+
+def getBatchFields(messages):
+    """Return the fields posting the (mailString, attachments) pairs.
+
+        >>> from nous.mailpost import Attachment
+        >>> getBatchFields([('first', []),
+        ...                 ('second', [Attachment('a.txt', 'text', 'plain',
+        ...                                        digest='abc')])])
+        [('batch', '2'), ('Mail[0]', 'first'), ('Mail[1]', 'second'),
+         ('md5[1][]', 'abc'), ('mime-type[1][]', 'text/plain'),
+         ('filename[1][]', 'a.txt')]
+
+    """
+    fields = [('batch', str(len(messages)))]
+    for index, (mailString, attachments) in enumerate(messages):
+        for name, value in getPostFields(mailString, attachments):
+            if name.endswith('[]'):
+                name = '%s[%d][]' % (name[:-2], index)
+            else:
+                name = '%s[%d]' % (name, index)
+            fields.append((name, value))
+    return fields
+
+
+def parseBatchResponse(body, count):
+    """Return the status codes for count messages from the response body.
+
+        >>> parseBatchResponse('0 200\\n1 404\\n', 2)
+        [200, 404]
+
+    Messages without a status are reported as 503 so they are retried:
+
+        >>> parseBatchResponse('1 200\\ngarbage\\n', 3)
+        [503, 200, 503]
+
+    """
+    statuses = [503] * count
+    for line in body.splitlines():
+        try:
+            index, status = [int(part) for part in line.split()]
+        except ValueError:
+            continue
+        if 0 <= index < count:
+            statuses[index] = status
+    return statuses
+
+
+class PendingMessage(object):
+    """A message waiting in a batch for its exit code."""
+
+    def __init__(self, callURL, mailString, attachments, trace=None):
+        self.callURL = callURL
+        self.mailString = mailString
+        self.attachments = attachments
+        self.trace = trace
+        self.exit_code = None
+        self.done = threading.Event()
+
+    def setExitCode(self, code):
+        self.exit_code = recordExitCode(code)
+        if self.trace is not None:
+            self.trace.setExitCode(self.callURL, code)
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        return self.exit_code
+
+
+class BatchPoster(object):
+    """Collects messages for the same URL and posts them together.
+
+    A batch is posted as soon as it holds max_messages messages, or when
+    its first message has waited for max_delay seconds.
+    """
+
+    def __init__(self, max_messages=20, max_delay=0.1):
+        self.max_messages = max_messages
+        self.max_delay = max_delay
+        self.batches = {}
+        self.condition = threading.Condition()
+        self.running = True
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def deliver(self, callURL, mailString, upload_dir):
+        """Process the mail and post it in a batch, return the exit code."""
+        authorization = getAuthorization(callURL)
+        url = stripAuthentication(callURL)
+        trace = nous.mailpost.startTrace([url])
+        try:
+            mailString, attachments = nous.mailpost.processAttachments(
+                mailString, upload_dir)
+        except Exception, e:
+            code = getExitCode(e, url)
+            if trace is not None:
+                trace.setExitCode(url, code)
+            return recordExitCode(code)
+        finally:
+            setTrace(None)
+
+        message = PendingMessage(url, mailString, attachments, trace)
+        self.condition.acquire()
+        try:
+            started, messages = self.batches.setdefault(
+                (url, authorization), (time.time(), []))
+            messages.append(message)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        return message.wait()
+
+    def run(self):
+        self.condition.acquire()
+        try:
+            while self.running:
+                timeout = None
+                now = time.time()
+                for key, (started, messages) in self.batches.items():
+                    wait = started + self.max_delay - now
+                    if len(messages) >= self.max_messages or wait <= 0:
+                        del self.batches[key]
+                        self.startPosting(key, messages)
+                    elif timeout is None or wait < timeout:
+                        timeout = wait
+                self.condition.wait(timeout)
+        finally:
+            self.condition.release()
+
+    def startPosting(self, key, messages):
+        # Post in a thread of its own, so a slow URL does not hold back
+        # the batches of the others.
+        thread = threading.Thread(target=self.post, args=key + (messages,))
+        thread.daemon = True
+        thread.start()
+
+    def post(self, url, authorization, messages):
+        # the request is a stage of every message in it
+        spans = []
+        for message in messages:
+            span = NULL_SPAN
+            if message.trace is not None:
+                span = message.trace.start('post', url=url,
+                                           batch=len(messages))
+            spans.append(span)
+        try:
+            fields = getBatchFields([(message.mailString, message.attachments)
+                                     for message in messages])
+            response = nous.mailpost.postForm(url, fields, authorization)
+            statuses = parseBatchResponse(response.read(), len(messages))
+        except Exception, e:
+            code = getExitCode(e, url)
+            for message, span in zip(messages, spans):
+                span.end(status=getattr(e, 'code', 'error'))
+                message.setExitCode(code)
+            return
+
+        for message, span, status in zip(messages, spans, statuses):
+            span.end(status=status)
+            if 200 <= status < 300:
+                message.setExitCode(EXIT_OK)
+            else:
+                error = urllib2.HTTPError(url, status, 'batched message failed',
+                                          {}, None)
+                message.setExitCode(getExitCode(error, url))
+
+    def close(self):
+        """Stop the batching thread, posting what is still waiting."""
+        self.condition.acquire()
+        try:
+            self.running = False
+            batches, self.batches = self.batches, {}
+            self.condition.notify()
+        finally:
+            self.condition.release()
+        self.thread.join()
+        for key, (started, messages) in batches.items():
+            self.post(*key + (messages,))
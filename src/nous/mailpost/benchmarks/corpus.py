@@ -0,0 +1,152 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Synthetic mails for the benchmarks.
+
+Every kind of mail the pipeline handles differently has a generator
+here.  The contents come from a seeded random generator, so the same
+scale and seed always give the same mails:
+
+    >>> mail = generate('many_small', scale=0.01)
+    >>> mail == generate('many_small', scale=0.01)
+    True
+    >>> mail.count('Content-Disposition: attachment')
+    50
+
+"""
+import random
+import binascii
+from email import encoders
+from email.mime.base import MIMEBase
+from email.mime.message import MIMEMessage
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do'
+         ' eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+
+
+def randomBytes(rng, size):
+    if not size:
+        return ''
+    return binascii.unhexlify('%0*x' % (size * 2, rng.getrandbits(size * 8)))
+
+
+def randomText(rng, size):
+    lines = []
+    length = 0
+    while length < size:
+        line = ' '.join([rng.choice(WORDS) for i in range(12)])
+        lines.append(line)
+        length += len(line) + 1
+    return '\n'.join(lines) + '\n'
+
+
+def addHeaders(msg, rng, subject):
+    msg['From'] = 'sender%d@example.com' % rng.randint(1, 1000)
+    msg['To'] = 'list@example.com'
+    msg['Subject'] = subject
+    msg['Message-Id'] = '<%x@example.com>' % rng.getrandbits(64)
+    return msg
+
+
+def multipart(rng, subtype='mixed'):
+    # the email package picks random boundaries, which would make the
+    # mails differ from run to run
+    boundary = '=====%032x==' % rng.getrandbits(128)
+    return MIMEMultipart(subtype, boundary=boundary)
+
+
+def attachment(rng, size, filename, maintype='application',
+               subtype='octet-stream'):
+    part = MIMEBase(maintype, subtype)
+    part.set_payload(randomBytes(rng, size))
+    encoders.encode_base64(part)
+    part.add_header('Content-Disposition', 'attachment', filename=filename)
+    return part
+
+
+def plainMail(rng, scale):
+    msg = MIMEText(randomText(rng, int(20000 * scale) + 200))
+    return addHeaders(msg, rng, 'Plain text')
+
+
+def alternativeMail(rng, scale):
+    text = randomText(rng, int(20000 * scale) + 200)
+    msg = multipart(rng, 'alternative')
+    msg.attach(MIMEText(text))
+    html = '<html><body><p>%s</p></body></html>' % text.replace(
+        '\n', '</p>\n<p>')
+    msg.attach(MIMEText(html, 'html'))
+    return addHeaders(msg, rng, 'HTML and text')
+
+
+def nestedMail(rng, scale):
+    body = multipart(rng, 'alternative')
+    text = randomText(rng, int(5000 * scale) + 200)
+    body.attach(MIMEText(text))
+    body.attach(MIMEText('<html><body><pre>%s</pre></body></html>' % text,
+                         'html'))
+    forwarded = multipart(rng)
+    forwarded.attach(MIMEText(randomText(rng, 1000)))
+    forwarded.attach(attachment(rng, int(50000 * scale) + 100,
+                                'forwarded.bin'))
+    addHeaders(forwarded, rng, 'Forwarded')
+
+    msg = multipart(rng)
+    msg.attach(body)
+    msg.attach(MIMEMessage(forwarded))
+    related = multipart(rng, 'related')
+    related.attach(MIMEText('<img src="cid:logo">', 'html'))
+    related.attach(attachment(rng, int(20000 * scale) + 100, 'logo.png',
+                              'image', 'png'))
+    msg.attach(related)
+    return addHeaders(msg, rng, 'Nested multiparts')
+
+
+def manySmallMail(rng, scale):
+    msg = multipart(rng)
+    msg.attach(MIMEText(randomText(rng, 1000)))
+    for i in range(50):
+        msg.attach(attachment(rng, int(200000 * scale) + 100,
+                              'small-%02d.bin' % i))
+    return addHeaders(msg, rng, 'Many small attachments')
+
+
+def hugeMail(rng, scale):
+    msg = multipart(rng)
+    msg.attach(MIMEText(randomText(rng, 1000)))
+    for i in range(2):
+        msg.attach(attachment(rng, int(20000000 * scale) + 100,
+                              'huge-%d.bin' % i))
+    return addHeaders(msg, rng, 'Huge attachments')
+
+
+GENERATORS = [('plain', plainMail),
+              ('html_text', alternativeMail),
+              ('nested', nestedMail),
+              ('many_small', manySmallMail),
+              ('huge', hugeMail)]
+
+CASES = [name for name, generator in GENERATORS]
+
+
+def generate(case, scale=1.0, seed=0):
+    """Return the mail of the case as a string.
+
+    At scale 1 the huge case has two 20MB attachments; the other sizes
+    are scaled along.
+    """
+    rng = random.Random('%s-%s' % (seed, case))
+    return dict(GENERATORS)[case](rng, scale).as_string()
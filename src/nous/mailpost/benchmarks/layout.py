@@ -0,0 +1,138 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Inode count and write latency of the attachment store layouts.
+
+Stores the same attachments in a fresh upload directory for every
+layout, timing each storeAttacment, and counts the inodes the store
+ends up using.  Then times migrating a legacy store to each layout:
+
+    python -m nous.mailpost.benchmarks.layout --attachments=100000
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import optparse
+import tempfile
+
+import nous.mailpost
+from nous.mailpost import LEGACY_LAYOUT, parseLayout, formatLayout
+from nous.mailpost import Attachment
+from nous.mailpost.layout import setLayout, migrateAttachments
+from nous.mailpost.benchmarks.stats import percentile
+
+
+def countInodes(upload_dir):
+    """Return the number of directories and files stored in upload_dir."""
+    directories = files = 0
+    for dirpath, dirnames, filenames in os.walk(upload_dir):
+        directories += len(dirnames)
+        files += len([name for name in filenames if not name.startswith('.')])
+    return directories, files
+
+
+def fill(upload_dir, attachments, size, seed):
+    """Store attachments of size random bytes, return the latencies."""
+    rng = random.Random(seed)
+    latencies = []
+    for i in range(attachments):
+        attachment = Attachment('a.bin', 'application', 'octet-stream',
+                                '%d:%s' % (i, '%x' % rng.getrandbits(
+                                    max(size - 8, 1) * 4)))
+        started = time.time()
+        nous.mailpost.storeAttacment(attachment, upload_dir)
+        latencies.append(time.time() - started)
+    return latencies
+
+
+def storeBenchmark(layout, attachments, size, seed):
+    upload_dir = tempfile.mkdtemp()
+    try:
+        if layout != LEGACY_LAYOUT:
+            setLayout(upload_dir, layout)
+        started = time.time()
+        latencies = fill(upload_dir, attachments, size, seed)
+        elapsed = time.time() - started
+        directories, files = countInodes(upload_dir)
+    finally:
+        shutil.rmtree(upload_dir)
+    return {'benchmark': 'store',
+            'layout': formatLayout(layout),
+            'attachments': attachments,
+            'directories': directories,
+            'files': files,
+            'inodes': directories + files,
+            'elapsed': round(elapsed, 6),
+            'write_median': percentile(latencies, 0.5),
+            'write_p95': percentile(latencies, 0.95),
+            'write_max': percentile(latencies, 1.0)}
+
+
+def migrateBenchmark(layout, attachments, size, seed):
+    upload_dir = tempfile.mkdtemp()
+    try:
+        fill(upload_dir, attachments, size, seed)
+        started = time.time()
+        moved, removed = migrateAttachments(upload_dir, layout)
+        elapsed = time.time() - started
+        directories, files = countInodes(upload_dir)
+    finally:
+        shutil.rmtree(upload_dir)
+    return {'benchmark': 'migrate',
+            'layout': formatLayout(layout),
+            'attachments': attachments,
+            'moved': moved,
+            'inodes': directories + files,
+            'elapsed': round(elapsed, 6),
+            'per_attachment': elapsed / max(moved, 1)}
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Compare the layouts of the attachment store.')
+    parser.add_option('--attachments', type='int', default=10000,
+                      help='attachments to store (default: 10000)')
+    parser.add_option('--size', type='int', default=1024,
+                      help='bytes per attachment (default: 1024)')
+    parser.add_option('--layout', dest='layouts', action='append',
+                      default=[],
+                      help='layout to measure, can be repeated (default:'
+                      ' legacy, 2/2, 2, 3)')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed of the random attachment bodies')
+    parser.add_option('--index', action='store_true', default=False,
+                      help='record the attachments in the index as well')
+    options, args = parser.parse_args(args)
+    layouts = [parseLayout(spec) for spec in
+               options.layouts or [LEGACY_LAYOUT, '2/2', '2', '3']]
+    nous.mailpost.setAttachmentIndex(options.index)
+    for layout in layouts:
+        result = storeBenchmark(layout, options.attachments, options.size,
+                                options.seed)
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+    for layout in layouts:
+        if layout == LEGACY_LAYOUT:
+            continue
+        result = migrateBenchmark(layout, options.attachments, options.size,
+                                  options.seed)
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
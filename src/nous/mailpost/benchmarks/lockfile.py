@@ -0,0 +1,109 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Latency of handing the smtp2zope delivery lock to a waiting process.
+
+A number of processes take turns holding one delivery slot for the same
+URL.  The handoff latency is the time from one process releasing the
+slot to a process that was already waiting for it getting it.  This is
+measured with inotify wakeups and with plain polling:
+
+    python -m nous.mailpost.benchmarks.lockfile --processes=8
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import optparse
+import tempfile
+import multiprocessing
+
+from nous.mailpost import smtp2zope
+from nous.mailpost.benchmarks.stats import percentile
+
+
+def contend(lockfile, rounds, hold, released, results):
+    semaphore = smtp2zope.DeliverySemaphore(lockfile, 'http://localhost/',
+                                            slots=1)
+    latencies = []
+    for i in range(rounds):
+        started = time.time()
+        semaphore.acquire(timeout=60)
+        acquired = time.time()
+        if released.value > started:
+            # We were already waiting when the slot was given back.
+            latencies.append(acquired - released.value)
+        time.sleep(hold)
+        released.value = time.time()
+        semaphore.release()
+        # Let somebody else have a go.
+        time.sleep(hold)
+    results.put(latencies)
+
+
+def run(use_inotify, processes, rounds, hold):
+    smtp2zope.USE_INOTIFY = use_inotify
+    directory = tempfile.mkdtemp()
+    try:
+        lockfile = os.path.join(directory, 'smtp2zope.lock')
+        released = multiprocessing.Value('d', 0.0)
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=contend,
+                                           args=(lockfile, rounds, hold,
+                                                 released, results))
+                   for i in range(processes)]
+        started = time.time()
+        for worker in workers:
+            worker.start()
+        latencies = []
+        for worker in workers:
+            latencies.extend(results.get())
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - started
+    finally:
+        shutil.rmtree(directory)
+    return {'benchmark': 'lockfile',
+            'wakeup': use_inotify and 'inotify' or 'poll',
+            'inotify_available': smtp2zope._libc is not None,
+            'processes': processes,
+            'acquisitions': processes * rounds,
+            'contended': len(latencies),
+            'elapsed': round(elapsed, 6),
+            'handoff_median': percentile(latencies, 0.5),
+            'handoff_p95': percentile(latencies, 0.95),
+            'handoff_max': percentile(latencies, 1.0)}
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Measure how long waiting processes take to get the'
+                    ' delivery lock once it is released.')
+    parser.add_option('--processes', type='int', default=4,
+                      help='number of competing processes (default: 4)')
+    parser.add_option('--rounds', type='int', default=20,
+                      help='acquisitions per process (default: 20)')
+    parser.add_option('--hold', type='float', default=0.005,
+                      help='seconds the lock is held (default: 0.005)')
+    options, args = parser.parse_args(args)
+    for use_inotify in (1, 0):
+        result = run(use_inotify, options.processes, options.rounds,
+                     options.hold)
+        print json.dumps(result, sort_keys=True)
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,379 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Time and memory use of the unpack -> store -> post pipeline.
+
+Every function is measured on every mail of the synthetic corpus, in a
+process of its own so the memory it needs can be told apart from the
+memory of the other measurements.  Mails are posted to a local stub
+server.  Results are printed as JSON, one line per case and function:
+
+    python -m nous.mailpost.benchmarks.pipeline --scale=0.1 --repeat=5
+
+Times are in seconds.  parses is how many times the whole mail was
+parsed in one run.  rss_peak_kb is the peak resident size of the
+measuring process while the function ran, rss_growth_kb how far above
+the size it had before that peak was.  On systems where the peak can't
+be reset (anything but Linux) it includes reading the mail.  Pages of
+a memory mapped mail count as resident once they are read, but unlike
+the other memory the kernel can drop them whenever it likes.
+"""
+import gc
+import os
+import re
+import sys
+import json
+import time
+import mimetools
+import email.feedparser
+import shutil
+import resource
+import optparse
+import platform
+import tempfile
+import subprocess
+
+import nous.mailpost
+from nous.mailpost import unpackMail, processAttachments
+from nous.mailpost import storeAttacment, postEmail, setMultipartPost
+from nous.mailpost import deliverEmail, mapMail, Attachment
+from nous.mailpost import smtp2zope
+from nous.mailpost.storepool import StorePool
+from nous.mailpost.benchmarks import corpus
+from nous.mailpost.benchmarks.stubserver import StubServer
+
+
+def unpackMailBenchmark(path, url):
+    mailString = open(path, 'rb').read()
+    def run():
+        unpackMail(mailString)
+    return run, None
+
+
+def processAttachmentsBenchmark(path, url):
+    mailString = open(path, 'rb').read()
+    def run():
+        upload_dir = tempfile.mkdtemp()
+        try:
+            processAttachments(mailString, upload_dir)
+        finally:
+            shutil.rmtree(upload_dir)
+    return run, None
+
+
+def processAttachmentsStreamBenchmark(path, url):
+    def run():
+        upload_dir = tempfile.mkdtemp()
+        try:
+            processAttachments(open(path, 'rb'), upload_dir)
+        finally:
+            shutil.rmtree(upload_dir)
+    return run, None
+
+
+def processAttachmentsMappedBenchmark(path, url):
+    def run():
+        upload_dir = tempfile.mkdtemp()
+        mail = mapMail(open(path, 'rb'))
+        try:
+            processAttachments(mail, upload_dir)
+        finally:
+            if not isinstance(mail, str):
+                mail.close()
+            shutil.rmtree(upload_dir)
+    return run, None
+
+
+def processAttachmentsPooledBenchmark(path, url, mapped=False):
+    pool = StorePool(4)
+    nous.mailpost.installStorePool(pool)
+    if mapped:
+        run = processAttachmentsMappedBenchmark(path, url)[0]
+    else:
+        run = processAttachmentsBenchmark(path, url)[0]
+    def cleanup():
+        nous.mailpost.installStorePool(None)
+        pool.close()
+    return run, cleanup
+
+
+def processAttachmentsMappedPooledBenchmark(path, url):
+    return processAttachmentsPooledBenchmark(path, url, mapped=True)
+
+
+def storeAttacmentBenchmark(path, url):
+    attachments = unpackMail(open(path, 'rb').read())[3]
+    def run():
+        upload_dir = tempfile.mkdtemp()
+        try:
+            for attachment in attachments:
+                # a fresh copy is hashed again, and keeps the original body
+                storeAttacment(Attachment(attachment.filename,
+                                          attachment.maintype,
+                                          attachment.subtype,
+                                          attachment.body), upload_dir)
+        finally:
+            shutil.rmtree(upload_dir)
+    return run, None
+
+
+def stripAttachmentsBenchmark(path, url):
+    mailString = open(path, 'rb').read()
+    def run():
+        smtp2zope.stripAttachments(mailString)
+    return run, None
+
+
+def postEmailBenchmark(path, url, multipart=False):
+    upload_dir = tempfile.mkdtemp()
+    mailString, attachments = processAttachments(open(path, 'rb').read(),
+                                                 upload_dir)
+    setMultipartPost(multipart)
+    def run():
+        postEmail(url, mailString, '', attachments)
+    def cleanup():
+        setMultipartPost(False)
+        shutil.rmtree(upload_dir)
+    return run, cleanup
+
+
+def postEmailMultipartBenchmark(path, url):
+    return postEmailBenchmark(path, url, multipart=True)
+
+
+def deliverEmailBenchmark(path, url, mapped=False):
+    def run():
+        upload_dir = tempfile.mkdtemp()
+        if mapped:
+            mail = mapMail(open(path, 'rb'))
+        else:
+            mail = open(path, 'rb').read()
+        try:
+            if deliverEmail(url, mail, upload_dir):
+                raise RuntimeError('delivery failed')
+        finally:
+            shutil.rmtree(upload_dir)
+    return run, None
+
+
+def deliverEmailMappedBenchmark(path, url):
+    return deliverEmailBenchmark(path, url, mapped=True)
+
+
+BENCHMARKS = [('unpackMail', unpackMailBenchmark),
+              ('processAttachments', processAttachmentsBenchmark),
+              ('processAttachments[stream]',
+               processAttachmentsStreamBenchmark),
+              ('processAttachments[mmap]', processAttachmentsMappedBenchmark),
+              ('processAttachments[pool]', processAttachmentsPooledBenchmark),
+              ('processAttachments[mmap,pool]',
+               processAttachmentsMappedPooledBenchmark),
+              ('storeAttacment', storeAttacmentBenchmark),
+              ('smtp2zope.stripAttachments', stripAttachmentsBenchmark),
+              ('postEmail', postEmailBenchmark),
+              ('postEmail[multipart]', postEmailMultipartBenchmark),
+              ('deliverEmail', deliverEmailBenchmark),
+              ('deliverEmail[mmap]', deliverEmailMappedBenchmark)]
+
+FUNCTIONS = [name for name, benchmark in BENCHMARKS]
+
+
+class ParseCounter(object):
+    """Counts how many times a whole mail is parsed.
+
+    Parsing starts with reading the top-level headers, into a
+    mimetools.Message from anything but a multifile inside a multipart,
+    or with an email.feedparser.FeedParser.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.saved = None
+
+    def install(self):
+        message_init = mimetools.Message.__init__
+        parser_init = email.feedparser.FeedParser.__init__
+        self.saved = message_init, parser_init
+        counter = self
+        def countMessage(msg, fp, *args):
+            # httplib's responses are not mails
+            if (msg.__class__ is mimetools.Message and
+                not getattr(fp, 'stack', None)):
+                counter.count += 1
+            message_init(msg, fp, *args)
+        def countParser(parser, *args, **kw):
+            counter.count += 1
+            parser_init(parser, *args, **kw)
+        mimetools.Message.__init__ = countMessage
+        email.feedparser.FeedParser.__init__ = countParser
+
+    def uninstall(self):
+        mimetools.Message.__init__, email.feedparser.FeedParser.__init__ = \
+            self.saved
+
+
+def currentRSS():
+    """Return the resident size of this process in KB, or None."""
+    try:
+        pages = int(open('/proc/self/statm').read().split()[1])
+    except (EnvironmentError, IndexError, ValueError):
+        return None
+    return pages * resource.getpagesize() / 1024
+
+
+def resetPeakRSS():
+    """Make peakRSS() forget the peaks seen so far, where possible."""
+    try:
+        open('/proc/self/clear_refs', 'w').write('5')
+    except EnvironmentError:
+        pass
+
+
+def peakRSS():
+    """Return the peak resident size of this process in KB."""
+    try:
+        status = open('/proc/self/status').read()
+        return int(re.search(r'VmHWM:\s*(\d+)', status).group(1))
+    except (EnvironmentError, AttributeError):
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes, not KB
+        peak /= 1024
+    return peak
+
+
+def measure(function, path, url, repeat):
+    """Run the benchmark of function repeat times, return the results."""
+    run, cleanup = dict(BENCHMARKS)[function](path, url)
+    gc.collect()
+    resetPeakRSS()
+    baseline = currentRSS()
+    times = []
+    counter = ParseCounter()
+    counter.install()
+    try:
+        for i in range(repeat):
+            started = time.time()
+            run()
+            times.append(time.time() - started)
+    finally:
+        counter.uninstall()
+        if cleanup is not None:
+            cleanup()
+    times.sort()
+    peak = peakRSS()
+    result = {'repeat': repeat,
+              'parses': counter.count / float(repeat),
+              'min': times[0],
+              'median': times[len(times) // 2],
+              'mean': sum(times) / len(times),
+              'max': times[-1],
+              'rss_baseline_kb': baseline,
+              'rss_peak_kb': peak,
+              'rss_growth_kb': None}
+    if baseline is not None:
+        result['rss_growth_kb'] = max(peak - baseline, 0)
+    return result
+
+
+def measureInChild(function, path, url, repeat, hash_algorithm='md5'):
+    """Run measure() in a new Python process, return its results."""
+    package_dir = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.dirname(os.path.abspath(nous.mailpost.__file__)))))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [package_dir] + filter(None, [env.get('PYTHONPATH')]))
+    child = subprocess.Popen(
+        [sys.executable, '-m', 'nous.mailpost.benchmarks.pipeline',
+         '--child', function, path, url, str(repeat), hash_algorithm],
+        stdout=subprocess.PIPE, env=env)
+    output = child.communicate()[0]
+    if child.returncode:
+        raise RuntimeError('measuring %s on %s failed' % (function, path))
+    return json.loads(output)
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args and args[0] == '--child':
+        function, path, url, repeat, hash_algorithm = args[1:]
+        nous.mailpost.log_error = lambda msg: None
+        nous.mailpost.setHashAlgorithm(hash_algorithm)
+        print json.dumps(measure(function, path, url, int(repeat)))
+        return
+
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Measure the mail processing pipeline on a synthetic'
+                    ' corpus and print the results as JSON lines.')
+    parser.add_option('--scale', type='float', default=1.0,
+                      help='size of the mails; at 1 the huge case has two'
+                      ' 20MB attachments (default: 1)')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed of the corpus generator (default: 0)')
+    parser.add_option('--repeat', type='int', default=3,
+                      help='runs of every measurement (default: 3)')
+    parser.add_option('--case', dest='cases', action='append',
+                      choices=corpus.CASES,
+                      help='only this case (%s), can be repeated'
+                      % ', '.join(corpus.CASES))
+    parser.add_option('--function', dest='functions', action='append',
+                      choices=FUNCTIONS,
+                      help='only this function (%s), can be repeated'
+                      % ', '.join(FUNCTIONS))
+    parser.add_option('--hash', default='md5',
+                      help='hash attachments with this algorithm'
+                      ' (default: md5)')
+    parser.add_option('--output', default=None,
+                      help='append the results to this file instead of'
+                      ' printing them')
+    options, args = parser.parse_args(args)
+
+    output = sys.stdout
+    if options.output:
+        output = open(options.output, 'a')
+    server = StubServer()
+    server.start()
+    corpus_dir = tempfile.mkdtemp()
+    try:
+        for case in options.cases or corpus.CASES:
+            mailString = corpus.generate(case, options.scale, options.seed)
+            path = os.path.join(corpus_dir, case)
+            open(path, 'wb').write(mailString)
+            info = {'benchmark': 'pipeline',
+                    'case': case,
+                    'scale': options.scale,
+                    'seed': options.seed,
+                    'hash': options.hash,
+                    'mail_bytes': len(mailString),
+                    'attachments': len(unpackMail(mailString)[3]),
+                    'python': platform.python_version()}
+            del mailString
+            for function in options.functions or FUNCTIONS:
+                result = measureInChild(function, path, server.url,
+                                        options.repeat, options.hash)
+                result.update(info)
+                result['function'] = function
+                output.write(json.dumps(result, sort_keys=True) + '\n')
+                output.flush()
+    finally:
+        shutil.rmtree(corpus_dir)
+        server.stop()
+        if output is not sys.stdout:
+            output.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Replaying a corpus of mails through the pipeline, for load testing.
+
+    mailpost-replay [options] MAILDIR_OR_MBOX
+
+delivers every mail of a Maildir, an mbox or a directory of mail files
+like mailpost would, through deliverEmail, and prints a line of JSON
+with the throughput, the latency percentiles and how many mails got
+each exit code.  Mails are posted to a stub server started for the run
+(see stubserver.py), which can be told to answer slowly or with errors:
+
+    mailpost-replay --concurrency=8 --latency=0.05 --fault=500:0.1 maildir
+
+or to a real instance with --url.  --concurrency sets how many mails are
+delivered at once; with --rate they are started at that many per second
+instead of as fast as possible, and latencies count the time a mail
+waited for its turn.
+"""
+import os
+import json
+import time
+import shutil
+import Queue
+import mailbox
+import optparse
+import tempfile
+import threading
+
+import nous.mailpost
+from nous.mailpost import deliverEmail
+from nous.mailpost.benchmarks.stats import percentile
+from nous.mailpost.benchmarks.stubserver import StubServer, parseFault
+
+
+def iterMails(path):
+    """Generate the mails in the Maildir, mbox or directory at path.
+
+    Mails are read one at a time, as strings.
+    """
+    if os.path.isdir(os.path.join(path, 'cur')):
+        box = mailbox.Maildir(path, factory=None)
+    elif os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            filename = os.path.join(path, name)
+            if not name.startswith('.') and os.path.isfile(filename):
+                yield open(filename, 'rb').read()
+        return
+    else:
+        box = mailbox.mbox(path, factory=None, create=False)
+    for key in box.iterkeys():
+        yield box.get_string(key)
+
+
+class Replay(object):
+    """Delivers mails to url from concurrency threads, noting the latency
+    and exit code of every one.
+    """
+
+    def __init__(self, url, upload_dir, concurrency=1, rate=None):
+        self.url = url
+        self.upload_dir = upload_dir
+        self.concurrency = concurrency
+        self.rate = rate
+        self.queue = Queue.Queue(maxsize=concurrency)
+        self.latencies = []
+        self.exit_codes = {}
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            due, mailString = item
+            if due is None:
+                due = time.time()
+            code = deliverEmail(self.url, mailString, self.upload_dir)
+            latency = time.time() - due
+            self.lock.acquire()
+            try:
+                self.latencies.append(latency)
+                self.exit_codes[code] = self.exit_codes.get(code, 0) + 1
+                self.bytes += len(mailString)
+            finally:
+                self.lock.release()
+
+    def run(self, mails):
+        """Deliver the mails, return the number of seconds it took."""
+        threads = []
+        for i in range(self.concurrency):
+            thread = threading.Thread(target=self.work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        started = time.time()
+        for count, mailString in enumerate(mails):
+            due = None
+            if self.rate:
+                due = started + count / self.rate
+                # sleep() may wake up a little early
+                delay = due - time.time()
+                while delay > 0:
+                    time.sleep(delay)
+                    delay = due - time.time()
+            self.queue.put((due, mailString))
+        for thread in threads:
+            self.queue.put(None)
+        for thread in threads:
+            thread.join()
+        return time.time() - started
+
+    def report(self, elapsed):
+        messages = len(self.latencies)
+        mean = None
+        if messages:
+            mean = sum(self.latencies) / messages
+        return {'messages': messages,
+                'bytes': self.bytes,
+                'elapsed': round(elapsed, 6),
+                'messages_per_second': round(messages / max(elapsed, 1e-6), 3),
+                'latency_mean': mean,
+                'latency_p50': percentile(self.latencies, 0.5),
+                'latency_p90': percentile(self.latencies, 0.9),
+                'latency_p99': percentile(self.latencies, 0.99),
+                'latency_max': percentile(self.latencies, 1.0),
+                'exit_codes': dict([(str(code), count) for code, count
+                                    in self.exit_codes.items()])}
+
+
+def limitMails(mails, limit):
+    for count, mailString in enumerate(mails):
+        if count >= limit:
+            return
+        yield mailString
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options] MAILDIR_OR_MBOX',
+        description='Deliver the mails of a Maildir, mbox or directory of'
+                    ' mails like mailpost would, and print the throughput,'
+                    ' latencies and exit codes as JSON.')
+    parser.add_option('--url', default=None,
+                      help='post the mails here instead of to a stub server'
+                      ' started for the run')
+    parser.add_option('--upload-dir', dest='upload_dir', default=None,
+                      help='store attachments here (default: a temporary'
+                      ' directory removed afterwards)')
+    parser.add_option('--concurrency', type='int', default=1,
+                      help='mails delivered at once (default: 1)')
+    parser.add_option('--rate', type='float', default=None,
+                      help='start this many mails per second (default: as'
+                      ' fast as they are delivered)')
+    parser.add_option('--limit', type='int', default=None,
+                      help='deliver at most this many mails')
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds the stub server waits before answering'
+                      ' (default: 0)')
+    parser.add_option('--fault', dest='faults', action='append', default=[],
+                      metavar='STATUS:SHARE',
+                      help='make the stub server answer this share of the'
+                      ' posts with STATUS, like 404:0.05, 500:0.1 or'
+                      ' 302:0.01; can be repeated')
+    parser.add_option('--seed', type='int', default=0,
+                      help='seed of the faults of the stub server'
+                      ' (default: 0)')
+    parser.add_option('--multipart', action='store_true', default=False,
+                      help='post multipart/form-data instead of urlencoded'
+                      ' forms')
+    parser.add_option('--verbose', action='store_true', default=False,
+                      help='log the errors of the deliveries')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('give one Maildir, mbox or directory of mails')
+    if not os.path.exists(args[0]):
+        parser.error('%s does not exist' % args[0])
+    if options.concurrency < 1:
+        parser.error('--concurrency must be at least 1')
+    try:
+        faults = [parseFault(spec) for spec in options.faults]
+    except ValueError, e:
+        parser.error(str(e))
+
+    if not options.verbose:
+        nous.mailpost.log_error = lambda msg: None
+    nous.mailpost.installBrokenRedirectHandler()
+    nous.mailpost.setMultipartPost(options.multipart)
+    server = None
+    url = options.url
+    if url is None:
+        server = StubServer(latency=options.latency, faults=faults,
+                            seed=options.seed)
+        server.start()
+        url = server.url + 'got_mail'
+    upload_dir = options.upload_dir
+    if upload_dir is None:
+        upload_dir = tempfile.mkdtemp(prefix='mailpost-replay-')
+    try:
+        mails = iterMails(args[0])
+        if options.limit is not None:
+            mails = limitMails(mails, options.limit)
+        replay = Replay(url, upload_dir, options.concurrency, options.rate)
+        result = replay.report(replay.run(mails))
+    finally:
+        if server is not None:
+            server.stop()
+        if options.upload_dir is None:
+            shutil.rmtree(upload_dir)
+    result.update({'source': args[0],
+                   'concurrency': options.concurrency,
+                   'rate': options.rate})
+    if server is not None:
+        result['server_statuses'] = dict(
+            [(str(status), count)
+             for status, count in server.statuses.items()])
+    print json.dumps(result, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
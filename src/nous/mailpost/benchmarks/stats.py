@@ -0,0 +1,31 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Statistics shared by the benchmarks and the replay tool."""
+
+
+def percentile(values, fraction):
+    """Return the value below which fraction of the values lie.
+
+        >>> percentile([3, 1, 2, 4], 0.5)
+        3
+        >>> percentile([3, 1, 2, 4], 1.0)
+        4
+        >>> percentile([], 0.5) is None
+        True
+
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(int(len(values) * fraction), len(values) - 1)]
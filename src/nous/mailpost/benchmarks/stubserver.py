@@ -0,0 +1,183 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""A local HTTP server to post benchmark messages to.
+
+It reads and throws away the posted bodies, so the client side is what
+gets measured.  To see how the client copes with a slow or failing
+server, it can wait before answering and answer a share of the posts
+with another status, like 404, 500 or a 302 redirect.  Run on its own
+it serves until interrupted:
+
+    python -m nous.mailpost.benchmarks.stubserver --port=8080 \
+        --latency=0.05 --fault=404:0.01 --fault=500:0.02
+"""
+import sys
+import time
+import random
+import optparse
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+def parseFault(spec):
+    """Parse a STATUS:SHARE fault.
+
+        >>> parseFault('500:0.25')
+        (500, 0.25)
+        >>> parseFault('500')
+        Traceback (most recent call last):
+        ...
+        ValueError: fault 500 is not STATUS:SHARE
+
+    """
+    status, _, share = spec.partition(':')
+    try:
+        return int(status), float(share)
+    except ValueError:
+        raise ValueError('fault %s is not STATUS:SHARE' % spec)
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Reads the posted body and answers with the status the server
+    picks, 200 unless a fault is injected."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            size = self.discardChunked()
+        else:
+            size = self.discard(int(self.headers.get('Content-Length', 0)))
+        status = self.server.countRequest(size)
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        body = 'ok'
+        if status != 200:
+            body = self.responses.get(status, ('error',))[0]
+        self.send_response(status)
+        if status in (301, 302, 303, 307):
+            self.send_header('Location', self.server.url)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def discard(self, size):
+        left = size
+        while left > 0:
+            chunk = self.rfile.read(min(left, 65536))
+            if not chunk:
+                break
+            left -= len(chunk)
+        return size - left
+
+    def discardChunked(self):
+        total = 0
+        while True:
+            size = int(self.rfile.readline().split(';')[0].strip(), 16)
+            total += self.discard(size)
+            self.rfile.readline()
+            if not size:
+                return total
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves StubHandler on a free port of localhost in a thread.
+
+    Every answer is delayed by latency seconds.  faults is a list of
+    (status, share) pairs: that share of the posts, picked at random, is
+    answered with that status instead of 200.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, handler=StubHandler, latency=0, faults=(), seed=None,
+                 port=0):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', port),
+                                           handler)
+        self.url = 'http://127.0.0.1:%d/' % self.server_address[1]
+        self.latency = latency
+        self.faults = list(faults)
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.bytes = 0
+        self.statuses = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def countRequest(self, size):
+        """Count a post of size bytes, return the status to answer."""
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.bytes += size
+            status = 200
+            if self.faults:
+                draw = self.random.random()
+                for fault, share in self.faults:
+                    if draw < share:
+                        status = fault
+                        break
+                    draw -= share
+            self.statuses[status] = self.statuses.get(status, 0) + 1
+            return status
+        finally:
+            self.lock.release()
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.thread.join()
+        self.server_close()
+
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]',
+        description='Serve a stub to post mails to on localhost.')
+    parser.add_option('--port', type='int', default=8080,
+                      help='port to listen on (default: 8080)')
+    parser.add_option('--latency', type='float', default=0,
+                      help='seconds to wait before answering (default: 0)')
+    parser.add_option('--fault', dest='faults', action='append', default=[],
+                      metavar='STATUS:SHARE',
+                      help='answer this share of the posts with STATUS,'
+                      ' can be repeated')
+    parser.add_option('--seed', type='int', default=None,
+                      help='seed of the random faults')
+    options, args = parser.parse_args(args)
+    try:
+        faults = [parseFault(spec) for spec in options.faults]
+    except ValueError, e:
+        parser.error(str(e))
+    server = StubServer(latency=options.latency, faults=faults,
+                        seed=options.seed, port=options.port)
+    print 'Serving on %s' % server.url
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Streaming request bodies.
+
+urlquoting a mail can triple its size, so postEmail can send the same
+fields as multipart/form-data instead.  Values are never copied into
+one big buffer: MultipartBody reads them one after another, so a mail
+kept in a file is streamed straight from it.  Urlencoded forms with
+values in files are streamed the same way, quoting the values as they
+are read.
+"""
+import os
+import random
+import string
+import urllib
+
+
+# Characters urllib.quote leaves alone
+SAFE_CHARACTERS = string.ascii_letters + string.digits + '_.-/'
+
+
+def getLength(value):
+    """Return the number of bytes left in a string or file, or None.
+
+    Files without a file descriptor can tell the number of bytes left
+    to read with len().
+    """
+    if isinstance(value, str):
+        return len(value)
+    try:
+        size = os.fstat(value.fileno()).st_size
+        return size - value.tell()
+    except (AttributeError, EnvironmentError, ValueError):
+        pass
+    try:
+        return len(value)
+    except (AttributeError, TypeError):
+        return None
+
+
+class QuotedFile(object):
+    """Reads a file urllib.quote()d.
+
+        >>> from StringIO import StringIO
+        >>> quoted = QuotedFile(StringIO('a b&c'))
+        >>> len(quoted)
+        9
+        >>> quoted.read(4), quoted.read(4), quoted.read()
+        ('a%20', 'b%26', 'c')
+
+    """
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.buffer = ''
+
+    def __len__(self):
+        # Count the characters that are quoted, without keeping them
+        try:
+            start = self.fp.tell()
+        except (AttributeError, EnvironmentError):
+            raise TypeError('the length of %r is not known' % self.fp)
+        length = len(self.buffer)
+        while True:
+            chunk = self.fp.read(65536)
+            if not chunk:
+                break
+            length += len(chunk) + 2 * len(chunk.translate(None,
+                                                           SAFE_CHARACTERS))
+        self.fp.seek(start)
+        return length
+
+    def read(self, size=-1):
+        if size < 0:
+            data = self.buffer + urllib.quote(self.fp.read())
+            self.buffer = ''
+            return data
+        while len(self.buffer) < size:
+            chunk = self.fp.read(max(size // 3, 1024))
+            if not chunk:
+                break
+            self.buffer += urllib.quote(chunk)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class SegmentedBody(object):
+    """A request body that can be read like a file.
+
+    It is made of segments, strings and files to read, that are read one
+    after another.
+    """
+
+    def __init__(self, segments, content_type):
+        self.segments = list(segments)
+        self.content_type = content_type
+        self.length = self.getLength()
+
+    def getLength(self):
+        total = 0
+        for segment in self.segments:
+            length = getLength(segment)
+            if length is None:
+                return None
+            total += length
+        return total
+
+    def read(self, size=-1):
+        """Read up to size bytes, or everything that is left."""
+        chunks = []
+        while self.segments and size != 0:
+            segment = self.segments[0]
+            if isinstance(segment, str):
+                if size < 0 or len(segment) <= size:
+                    chunk = segment
+                    self.segments.pop(0)
+                else:
+                    chunk = segment[:size]
+                    self.segments[0] = segment[size:]
+            else:
+                chunk = segment.read(size)
+                if not chunk or size < 0:
+                    self.segments.pop(0)
+            chunks.append(chunk)
+            if size > 0:
+                size -= len(chunk)
+        return ''.join(chunks)
+
+    def __iter__(self):
+        while True:
+            chunk = self.read(65536)
+            if not chunk:
+                break
+            yield chunk
+
+
+class MultipartBody(SegmentedBody):
+    """A multipart/form-data body that can be read like a file.
+
+    fields is a list of (name, value) pairs, where value is a string or
+    a file to read the value from.
+
+        >>> body = MultipartBody([('Mail', 'Hello'), ('md5[]', 'abc')],
+        ...                      boundary='xyz')
+        >>> body.content_type
+        'multipart/form-data; boundary=xyz'
+        >>> data = body.read()
+        >>> print data.replace('\\r\\n', '\\n')
+        --xyz
+        Content-Disposition: form-data; name="Mail"
+        <BLANKLINE>
+        Hello
+        --xyz
+        Content-Disposition: form-data; name="md5[]"
+        <BLANKLINE>
+        abc
+        --xyz--
+        <BLANKLINE>
+        >>> len(data) == body.length
+        True
+
+    """
+
+    def __init__(self, fields, boundary=None):
+        if boundary is None:
+            boundary = '----mailpost%032x' % random.getrandbits(128)
+        self.boundary = boundary
+        segments = []
+        for name, value in fields:
+            segments.append('--%s\r\nContent-Disposition: form-data;'
+                            ' name="%s"\r\n\r\n' % (boundary, name))
+            segments.append(value)
+            segments.append('\r\n')
+        segments.append('--%s--\r\n' % boundary)
+        SegmentedBody.__init__(
+            self, segments, 'multipart/form-data; boundary=%s' % boundary)
@@ -0,0 +1,185 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Pool of persistent HTTP connections for posting mail.
+
+A long running mailpost (see nous.mailpost.lmtp) posts every message to
+the same few hosts, so connections are kept open between requests
+instead of paying the TCP setup for each message.
+"""
+import time
+import select
+import socket
+import httplib
+import urllib2
+import urlparse
+import threading
+from StringIO import StringIO
+
+
+class ConnectionPool(object):
+    """Keeps idle HTTP connections keyed by (scheme, host, port).
+
+    At most `maxsize` idle connections are kept for every key, and idle
+    connections older than `idle_timeout` seconds are closed instead of
+    being reused.  A connection is checked before reuse, and if the
+    server closed it meanwhile, a fresh one is opened.
+
+    Just like the BrokenHTTPRedirectHandler installed for urllib2,
+    redirects are never followed: any non-2xx response raises
+    urllib2.HTTPError.
+    """
+
+    connection_classes = {'http': httplib.HTTPConnection,
+                          'https': httplib.HTTPSConnection}
+
+    def __init__(self, maxsize=4, idle_timeout=30, timeout=None):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def getKey(self, url):
+        """Return the pool key for url.
+
+            >>> pool = ConnectionPool()
+            >>> pool.getKey('http://localhost/got_mail')
+            ('http', 'localhost', 80)
+            >>> pool.getKey('https://Example.com:8443/got_mail')
+            ('https', 'example.com', 8443)
+
+        """
+        parts = urlparse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port
+        if port is None:
+            port = (scheme == 'https') and 443 or 80
+        return (scheme, parts.hostname.lower(), port)
+
+    def newConnection(self, key):
+        scheme, host, port = key
+        connection_class = self.connection_classes[scheme]
+        if self.timeout is None:
+            return connection_class(host, port)
+        return connection_class(host, port, timeout=self.timeout)
+
+    def isHealthy(self, conn):
+        """Check that an idle connection was not closed by the server.
+
+        An idle connection should never be readable: if it is, the server
+        either closed it or sent something we did not ask for.
+        """
+        if conn.sock is None:
+            return False
+        try:
+            readable, _, _ = select.select([conn.sock], [], [], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        return not readable
+
+    def getConnection(self, key):
+        """Return (connection, reused) for key."""
+        now = time.time()
+        self.lock.acquire()
+        try:
+            idle = self.idle.get(key, [])
+            while idle:
+                conn, released = idle.pop()
+                if now - released <= self.idle_timeout and self.isHealthy(conn):
+                    return conn, True
+                conn.close()
+        finally:
+            self.lock.release()
+        return self.newConnection(key), False
+
+    def releaseConnection(self, key, conn):
+        self.lock.acquire()
+        try:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.time()))
+                return
+        finally:
+            self.lock.release()
+        conn.close()
+
+    def closeAll(self):
+        self.lock.acquire()
+        try:
+            idle, self.idle = self.idle, {}
+        finally:
+            self.lock.release()
+        for connections in idle.values():
+            for conn, released in connections:
+                conn.close()
+
+    def request(self, url, data, headers):
+        """POST data to url, return the (status, body) of the response.
+
+        data is either a string or an object with a read() method, which
+        is sent using chunked transfer encoding.  Raises urllib2.HTTPError
+        for non-2xx responses.
+        """
+        key = self.getKey(url)
+        parts = urlparse.urlsplit(url)
+        selector = urlparse.urlunsplit(('', '', parts.path or '/',
+                                        parts.query, ''))
+        headers = dict(headers)
+        headers.setdefault('Content-Type', 'application/x-www-form-urlencoded')
+
+        conn, reused = self.getConnection(key)
+        try:
+            try:
+                response = self.send(conn, selector, data, headers)
+            except (httplib.BadStatusLine, socket.error):
+                if not reused or not isinstance(data, str):
+                    raise
+                # The server closed the kept-alive connection before it
+                # saw our request, try once more on a fresh one.
+                conn.close()
+                conn = self.newConnection(key)
+                response = self.send(conn, selector, data, headers)
+            body = response.read()
+        except:
+            conn.close()
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self.releaseConnection(key, conn)
+
+        if not 200 <= response.status < 300:
+            raise urllib2.HTTPError(url, response.status, response.reason,
+                                    response.msg, StringIO(body))
+        return response.status, body
+
+    def send(self, conn, selector, data, headers):
+        if isinstance(data, str):
+            conn.request('POST', selector, data, headers)
+            return conn.getresponse()
+
+        # Stream bodies that are read like files with chunked encoding
+        conn.putrequest('POST', selector, skip_accept_encoding=True)
+        for header, value in headers.items():
+            conn.putheader(header, value)
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        while True:
+            chunk = data.read(65536)
+            if not chunk:
+                break
+            conn.send('%x\r\n%s\r\n' % (len(chunk), chunk))
+        conn.send('0\r\n\r\n')
+        return conn.getresponse()
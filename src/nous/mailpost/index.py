@@ -0,0 +1,412 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Index of the attachments stored in an upload directory.
+
+Every time a message brings an attachment, its digest, size and mime
+type are recorded in the index of the upload directory, which counts
+how many messages referenced the attachment and remembers when it was
+first and last seen.  That allows listing the store and collecting the
+attachments nobody references any more without crawling the tree:
+
+    mailpost gc --list UPLOAD_DIR
+    mailpost gc --release=DIGEST UPLOAD_DIR
+
+Delivering processes only append records to a log (.index.log), which
+they can all do at once without waiting for each other.  Reading the
+index folds the log into an SQLite database (.index.sqlite) first, and
+so does a delivering process that finds the log grown past
+max_log_size, unless somebody else is folding or collecting.
+
+The index is for listing and collecting the store; whether an
+attachment is stored is still answered by the store itself.  A
+delivering process holds the log locked shared from finding (or
+putting) an attachment in the store until its reference is appended,
+and collecting holds it locked exclusively until the attachments are
+removed, so an attachment is never removed under a message that was
+just given it.  References are only released by whoever removes the
+messages, with `mailpost gc --release`.
+
+Log records are tab separated lines:
+
+    +  digest  size  mime_type  time    a message references the attachment
+    -  digest  time                     a reference was released
+
+Records folded in right before a crash may be folded in again, which
+can only make reference counts too high, never too low.
+"""
+import os
+import sys
+import time
+import errno
+import fcntl
+import urllib
+import sqlite3
+import optparse
+
+import nous.mailpost
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS attachments (
+    digest TEXT PRIMARY KEY,
+    size INTEGER,
+    mime_type TEXT,
+    refcount INTEGER,
+    first_seen REAL,
+    last_seen REAL
+);
+"""
+
+
+class IndexEntry(object):
+    """An attachment in the index."""
+
+    def __init__(self, digest, size, mime_type, refcount, first_seen,
+                 last_seen):
+        self.digest = digest
+        self.size = size
+        self.mime_type = mime_type
+        self.refcount = refcount
+        self.first_seen = first_seen
+        self.last_seen = last_seen
+
+
+class AttachmentIndex(object):
+    """The index of the attachments stored in upload_dir."""
+
+    # delivering processes fold the log once it is bigger than this
+    max_log_size = 1 << 20
+
+    def __init__(self, upload_dir):
+        self.upload_dir = upload_dir
+        self.log_path = os.path.join(upload_dir, '.index.log')
+        self.db_path = os.path.join(upload_dir, '.index.sqlite')
+        self.db = None
+        self.log_fd = None
+
+    #
+    # Writing
+    #
+
+    def add(self, digest, size, mime_type, now=None):
+        """Record that a message references the attachment."""
+        if now is None:
+            now = time.time()
+        self.append('+\t%s\t%d\t%s\t%f\n' % (digest, size,
+                                             urllib.quote(mime_type, ''),
+                                             now))
+
+    def release(self, digest, now=None):
+        """Record that a message no longer references the attachment."""
+        if now is None:
+            now = time.time()
+        self.append('-\t%s\t%f\n' % (digest, now))
+
+    def openLog(self):
+        fd = os.open(self.log_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                     0664)
+        try:
+            # Appenders share the lock, folding the log takes it alone.
+            fcntl.flock(fd, fcntl.LOCK_SH)
+        except:
+            os.close(fd)
+            raise
+        return fd
+
+    def lockShared(self):
+        """Keep the log locked shared until unlock().
+
+        Records are appended under this lock meanwhile, and attachments
+        are not collected.
+        """
+        if self.log_fd is None:
+            self.log_fd = self.openLog()
+
+    def unlock(self):
+        """Release the shared lock, folding the log if it grew too big."""
+        if self.log_fd is None:
+            return
+        os.close(self.log_fd)
+        self.log_fd = None
+        self.foldIfLarge()
+
+    def append(self, record):
+        if self.log_fd is not None:
+            os.write(self.log_fd, record)
+            return
+        fd = self.openLog()
+        try:
+            os.write(fd, record)
+        finally:
+            os.close(fd)
+        self.foldIfLarge()
+
+    def foldIfLarge(self):
+        """Fold the log if it is bigger than max_log_size and nobody else
+        has it locked."""
+        try:
+            try:
+                if os.path.getsize(self.log_path) > self.max_log_size:
+                    self.refresh(blocking=False)
+            except (EnvironmentError, sqlite3.Error), e:
+                # the records stay in the log for the next one to fold
+                nous.mailpost.log_warning(
+                    'Could not fold attachment index log %s: %s'
+                    % (self.log_path, e))
+        finally:
+            self.close()
+
+    #
+    # Reading
+    #
+
+    def connect(self):
+        if self.db is None:
+            self.db = sqlite3.connect(self.db_path, timeout=60)
+            self.db.executescript(SCHEMA)
+        return self.db
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    def lockLog(self, blocking=True, create=False):
+        """Open the log and lock it exclusively, return it.
+
+        Returns None if there is no log, unless create is true, or if
+        the lock is held by somebody else and blocking is false.
+        """
+        flags = os.O_RDWR
+        if create:
+            flags |= os.O_CREAT
+        try:
+            fd = os.open(self.log_path, flags, 0664)
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        log = os.fdopen(fd, 'r+')
+        operation = fcntl.LOCK_EX
+        if not blocking:
+            operation |= fcntl.LOCK_NB
+        try:
+            fcntl.flock(fd, operation)
+        except IOError, e:
+            log.close()
+            if blocking or e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return None
+        return log
+
+    def refresh(self, blocking=True):
+        """Fold the records appended to the log into the database.
+
+        Unless blocking is true, nothing is folded while somebody else
+        holds the log locked.
+        """
+        self.connect()
+        log = self.lockLog(blocking)
+        if log is None:
+            return
+        try:
+            self.foldLog(log)
+        finally:
+            log.close()
+
+    def foldLog(self, log):
+        """Fold the records of the log, which is locked exclusively."""
+        db = self.connect()
+        for line in log:
+            if line.endswith('\n'):
+                self.fold(db, line[:-1].split('\t'))
+        db.commit()
+        log.truncate(0)
+
+    def fold(self, db, record):
+        try:
+            if record[0] == '+':
+                digest, size, mime_type, seen = record[1:]
+                seen = float(seen)
+                updated = db.execute(
+                    'UPDATE attachments SET refcount = refcount + 1,'
+                    ' last_seen = max(last_seen, ?) WHERE digest = ?',
+                    (seen, digest)).rowcount
+                if not updated:
+                    db.execute('INSERT INTO attachments VALUES'
+                               ' (?, ?, ?, 1, ?, ?)',
+                               (digest, int(size), urllib.unquote(mime_type),
+                                seen, seen))
+            elif record[0] == '-':
+                digest, seen = record[1:]
+                db.execute('UPDATE attachments SET refcount = refcount - 1,'
+                           ' last_seen = max(last_seen, ?) WHERE digest = ?',
+                           (float(seen), digest))
+        except (ValueError, IndexError):
+            nous.mailpost.log_warning(
+                'Skipping broken attachment index record %r' % (record,))
+
+    def get(self, digest):
+        """Return the IndexEntry of the attachment or None."""
+        row = self.connect().execute(
+            'SELECT * FROM attachments WHERE digest = ?', (digest,)).fetchone()
+        if row is None:
+            return None
+        return IndexEntry(*row)
+
+    def __contains__(self, digest):
+        return self.connect().execute(
+            'SELECT 1 FROM attachments WHERE digest = ?',
+            (digest,)).fetchone() is not None
+
+    def entries(self):
+        """Generate the IndexEntry of every attachment, by digest."""
+        for row in self.connect().execute(
+                'SELECT * FROM attachments ORDER BY digest'):
+            yield IndexEntry(*row)
+
+    #
+    # Maintenance
+    #
+
+    def scan(self):
+        """Add the attachments stored but not in the index yet.
+
+        Used once to index an existing upload directory, which is the
+        only time the tree is crawled.  Returns the number added.
+        """
+        self.refresh()
+        db = self.connect()
+        added = 0
+        for dirpath, dirnames, filenames in os.walk(self.upload_dir):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.startswith('.'):
+                    continue
+                path = os.path.join(dirpath, filename)
+                digest = nous.mailpost.getAttachmentDigest(path,
+                                                           self.upload_dir)
+                if digest in self:
+                    continue
+                st = os.stat(path)
+                db.execute('INSERT INTO attachments VALUES (?, ?, ?, 1, ?, ?)',
+                           (digest, st.st_size, '', st.st_mtime, st.st_mtime))
+                added += 1
+        db.commit()
+        return added
+
+    def collect(self, min_age=86400, dry_run=False, now=None):
+        """Remove the attachments nobody references.
+
+        Attachments seen in the last min_age seconds are kept, in case a
+        message referencing them is still on its way.  Index entries of
+        attachments that were removed by someone else are dropped.
+        Returns the entries of the attachments removed.
+        """
+        if now is None:
+            now = time.time()
+        # no references are added until the attachments are removed
+        log = self.lockLog(create=True)
+        try:
+            return self.collectLocked(log, min_age, dry_run, now)
+        finally:
+            log.close()
+
+    def collectLocked(self, log, min_age, dry_run, now):
+        self.foldLog(log)
+        db = self.connect()
+        removed = []
+        for entry in list(self.entries()):
+            path = nous.mailpost.getAttachmentPath(entry.digest,
+                                                   self.upload_dir)
+            if not os.path.exists(path):
+                if not dry_run:
+                    db.execute('DELETE FROM attachments WHERE digest = ?',
+                               (entry.digest,))
+                continue
+            if entry.refcount > 0 or entry.last_seen > now - min_age:
+                continue
+            removed.append(entry)
+            if dry_run:
+                continue
+            os.unlink(path)
+            db.execute('DELETE FROM attachments WHERE digest = ?',
+                       (entry.digest,))
+            removeEmptyDirectories(os.path.dirname(path), self.upload_dir)
+        db.commit()
+        return removed
+
+
+def removeEmptyDirectories(path, top):
+    """Remove path and its parents up to top, as long as they are empty."""
+    while len(path) > len(top):
+        try:
+            os.rmdir(path)
+        except OSError, e:
+            if e.errno not in (errno.ENOTEMPTY, errno.EEXIST, errno.ENOENT):
+                raise
+            return
+        path = os.path.dirname(path)
+
+
+def gc(args):
+    """Entry point of `mailpost gc`."""
+    parser = optparse.OptionParser(usage='%prog gc [options] UPLOAD_DIR')
+    parser.add_option('--release', dest='release', action='append',
+                      default=[], metavar='DIGEST',
+                      help='release a reference to the attachment before'
+                      ' collecting, can be repeated')
+    parser.add_option('--min-age', dest='min_age', type='int', default=86400,
+                      help='keep attachments seen in the last this many'
+                      ' seconds (default: one day)')
+    parser.add_option('--dry-run', dest='dry_run', action='store_true',
+                      default=False,
+                      help='only print what would be removed')
+    parser.add_option('--list', dest='list', action='store_true',
+                      default=False,
+                      help='print the index instead of collecting')
+    parser.add_option('--scan', dest='scan', action='store_true',
+                      default=False,
+                      help='add the attachments stored before the index'
+                      ' existed')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        nous.mailpost.log_critical('gc needs the upload directory'
+                                   ' (%s parameters given)' % len(args))
+        sys.exit(nous.mailpost.EXIT_USAGE)
+
+    index = AttachmentIndex(args[0])
+    try:
+        for digest in options.release:
+            index.release(digest)
+        if options.scan:
+            print 'indexed %d attachments' % index.scan()
+        if options.list:
+            index.refresh()
+            for entry in index.entries():
+                print '%s\t%d\t%s\t%d\t%s\t%s' % (
+                    entry.digest, entry.size, entry.mime_type or '-',
+                    entry.refcount, formatTime(entry.first_seen),
+                    formatTime(entry.last_seen))
+            return
+        for entry in index.collect(options.min_age, options.dry_run):
+            print '%s %s (%d bytes)' % (
+                options.dry_run and 'would remove' or 'removed',
+                entry.digest, entry.size)
+    finally:
+        index.close()
+
+
+def formatTime(t):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(t))
@@ -0,0 +1,132 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Changing the layout of an upload directory.
+
+Attachments were always stored under their digest split into 8
+character directories, which gives four levels of directories holding
+one file each.  An upload directory can use a flatter layout instead:
+with a fan-out of 2/2, attachments are stored in two levels of
+directories named after the first characters of the digest, under the
+full digest:
+
+    UPLOAD_DIR/d4/1d/d41d8cd98f00b204e9800998ecf8427e
+
+The layout is kept in UPLOAD_DIR/.layout and changed with
+
+    mailpost migrate --layout=2/2 UPLOAD_DIR
+
+which can run while mail is delivered: the new layout is set first, so
+new attachments go to their new place, then the stored ones are moved.
+Whatever reads the attachments from the upload directory has to look
+them up in the new layout as well.
+"""
+import os
+import sys
+import optparse
+
+import nous.mailpost
+from nous.mailpost import LEGACY_LAYOUT
+from nous.mailpost import parseLayout, formatLayout
+from nous.mailpost import getAttachmentPath, getAttachmentDigest
+from nous.mailpost.index import removeEmptyDirectories
+
+
+def setLayout(upload_dir, layout):
+    """Make layout the layout of upload_dir, for everybody storing there."""
+    path = os.path.join(upload_dir, '.layout')
+    tmp_path = '%s.%d' % (path, os.getpid())
+    f = open(tmp_path, 'w')
+    try:
+        f.write(formatLayout(layout) + '\n')
+    finally:
+        f.close()
+    os.rename(tmp_path, path)
+
+
+def iterAttachments(upload_dir):
+    """Yield the paths of the attachments stored in upload_dir."""
+    for dirpath, dirnames, filenames in os.walk(upload_dir):
+        dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+        for filename in filenames:
+            if not filename.startswith('.'):
+                yield os.path.join(dirpath, filename)
+
+
+def migrateAttachments(upload_dir, layout, dry_run=False):
+    """Move the attachments of upload_dir to layout.
+
+    Attachments that were stored again in the new layout meanwhile are
+    removed from the old one.  Returns the number of attachments moved
+    and removed.
+    """
+    if not dry_run:
+        setLayout(upload_dir, layout)
+    moved = removed = 0
+    for path in list(iterAttachments(upload_dir)):
+        digest = getAttachmentDigest(path, upload_dir)
+        target = getAttachmentPath(digest, upload_dir, layout)
+        if target == path:
+            continue
+        if os.path.exists(target):
+            removed += 1
+            if not dry_run:
+                os.unlink(path)
+        else:
+            moved += 1
+            if not dry_run:
+                dirname = os.path.dirname(target)
+                if not os.path.isdir(dirname):
+                    try:
+                        os.makedirs(dirname)
+                    except OSError:
+                        if not os.path.isdir(dirname):
+                            raise
+                os.rename(path, target)
+        if not dry_run:
+            removeEmptyDirectories(os.path.dirname(path), upload_dir)
+    return moved, removed
+
+
+def migrate(args):
+    """Entry point of `mailpost migrate`."""
+    parser = optparse.OptionParser(
+        usage='%prog migrate --layout=LAYOUT UPLOAD_DIR')
+    parser.add_option('--layout', dest='layout', default=None,
+                      help='the new layout: a fan-out like 2/2, or %s for'
+                      ' 8 character segments' % LEGACY_LAYOUT)
+    parser.add_option('--dry-run', dest='dry_run', action='store_true',
+                      default=False,
+                      help='only count the attachments that would move')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        nous.mailpost.log_critical('migrate needs the upload directory'
+                                   ' (%s parameters given)' % len(args))
+        sys.exit(nous.mailpost.EXIT_USAGE)
+    upload_dir = args[0]
+    if options.layout is None:
+        print formatLayout(nous.mailpost.getLayout(upload_dir))
+        return
+    try:
+        layout = parseLayout(options.layout)
+    except ValueError, e:
+        nous.mailpost.log_critical(str(e))
+        sys.exit(nous.mailpost.EXIT_USAGE)
+    if not os.path.isdir(upload_dir):
+        nous.mailpost.log_critical('File upload directory (%s) is invalid'
+                                   % upload_dir)
+        sys.exit(nous.mailpost.EXIT_USAGE)
+
+    moved, removed = migrateAttachments(upload_dir, layout, options.dry_run)
+    print '%s %d attachments, %d stored twice' % (
+        options.dry_run and 'would move' or 'moved', moved, removed)
@@ -0,0 +1,128 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Size limits enforced while a mail is read and decoded.
+
+A mail bigger than the limit is refused as soon as the limit is passed,
+before the rest of it is read, and attachments are refused as soon as
+their decoded bodies add up to more than the limit for attachments.
+Refused mails are never held in memory or parsed in full.
+"""
+
+
+class SizeLimitExceeded(Exception):
+    """A mail or its attachments are bigger than allowed."""
+
+    def __init__(self, what, limit):
+        Exception.__init__(self, '%s size limit of %d bytes exceeded'
+                           % (what, limit))
+        self.what = what
+        self.limit = limit
+
+
+class SizeLimit(object):
+    """Counts bytes against a limit.
+
+        >>> limit = SizeLimit(10, 'mail')
+        >>> limit.charge(6)
+        >>> limit.remaining()
+        4
+        >>> limit.charge(6)
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: mail size limit of 10 bytes exceeded
+
+    """
+
+    def __init__(self, limit, what):
+        self.limit = limit
+        self.what = what
+        self.used = 0
+
+    def remaining(self):
+        return self.limit - self.used
+
+    def charge(self, size):
+        self.used += size
+        if self.used > self.limit:
+            raise SizeLimitExceeded(self.what, self.limit)
+
+
+class LimitedReader(object):
+    """Reads a file, raising SizeLimitExceeded once more than the limit
+    was read.
+
+    Reads of everything or of whole lines never ask the file for more
+    than one byte past the limit, so a refused mail is not read into
+    memory.
+
+        >>> from StringIO import StringIO
+        >>> reader = LimitedReader(StringIO('Hello\\nworld\\n'),
+        ...                        SizeLimit(8, 'mail'))
+        >>> reader.readline()
+        'Hello\\n'
+        >>> reader.read()
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: mail size limit of 8 bytes exceeded
+
+    """
+
+    def __init__(self, fp, limit):
+        self.fp = fp
+        self.limit = limit
+
+    def read(self, size=-1):
+        if size < 0:
+            # all that is left, or one byte too many
+            size = max(self.limit.remaining(), 0) + 1
+        data = self.fp.read(size)
+        self.limit.charge(len(data))
+        return data
+
+    def readline(self, size=-1):
+        if size < 0:
+            size = max(self.limit.remaining(), 0) + 1
+        line = self.fp.readline(size)
+        self.limit.charge(len(line))
+        return line
+
+
+class LimitedWriter(object):
+    """Writes to output, raising SizeLimitExceeded before more than the
+    limit is written.
+
+    Several writers can share a limit, so it caps what they write
+    together.
+
+        >>> from StringIO import StringIO
+        >>> limit = SizeLimit(8, 'attachment')
+        >>> first = LimitedWriter(StringIO(), limit)
+        >>> first.write('Hello')
+        >>> LimitedWriter(StringIO(), limit).write('world')
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: attachment size limit of 8 bytes exceeded
+
+    """
+
+    def __init__(self, output, limit):
+        self.output = output
+        self.limit = limit
+
+    def write(self, data):
+        self.limit.charge(len(data))
+        self.output.write(data)
+
+    def close(self):
+        self.output.close()
@@ -0,0 +1,548 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""LMTP listener for running mailpost as a persistent daemon.
+
+Instead of having the MTA fork ``mailpost`` for every message, run
+
+    mailpost serve --socket=/var/run/mailpost.sock URL UPLOAD_DIR
+
+or
+
+    mailpost serve --listen=127.0.0.1:8024 URL UPLOAD_DIR
+
+and point the MTA's LMTP transport at it.  Every recipient of a message
+is delivered through the same pipeline as the one-shot script and gets
+its own LMTP reply derived from the exit code the script would have
+returned.
+
+URL may contain $recipient, $local and $domain placeholders which are
+replaced with the (lowercased) envelope recipient address, its local
+part and its domain.
+"""
+import os
+import sys
+import socket
+import optparse
+import SocketServer
+from string import Template
+
+import nous.mailpost
+from nous.mailpost.httppool import ConnectionPool
+from nous.mailpost.storepool import StorePool
+from nous.mailpost.batch import BatchPoster
+from nous.mailpost.engine import DeliveryEngine
+from nous.mailpost.spool import Spool, SpoolWorker
+from nous.mailpost.limits import SizeLimitExceeded
+from nous.mailpost.metrics import Registry, MetricsServer
+from nous.mailpost.trace import SlowMessageLog
+from nous.mailpost import EXIT_OK, EXIT_USAGE, EXIT_NOUSER, EXIT_NOPERM
+from nous.mailpost import EXIT_TEMPFAIL
+from nous.mailpost import log_critical, log_error, log_info
+
+
+# LMTP replies for the exit codes of the one-shot script
+REPLIES = {
+    EXIT_OK: '250 2.0.0 Ok',
+    EXIT_USAGE: '554 5.3.5 Mail system configuration error',
+    EXIT_NOUSER: '550 5.1.1 No such mailbox',
+    EXIT_NOPERM: '554 5.7.1 Delivery not authorized',
+    EXIT_TEMPFAIL: '451 4.3.0 Temporary failure, try again later',
+    }
+
+# LMTP reply for messages over the size limit (RFC 1870)
+TOO_BIG = '552 5.3.4 Message size exceeds fixed maximum message size'
+
+
+def replyForExitCode(code):
+    """Return the LMTP reply for an exit code of deliverEmail.
+
+        >>> replyForExitCode(EXIT_OK)
+        '250 2.0.0 Ok'
+        >>> replyForExitCode(EXIT_NOUSER)
+        '550 5.1.1 No such mailbox'
+
+    Unknown codes are treated as temporary failures:
+
+        >>> replyForExitCode(1)
+        '451 4.3.0 Temporary failure, try again later'
+
+    """
+    return REPLIES.get(code, REPLIES[EXIT_TEMPFAIL])
+
+
+def recipientURL(callURL, recipient):
+    """Substitute recipient placeholders in callURL.
+
+        >>> recipientURL('http://localhost/lists/$local/got_mail',
+        ...              'Announce@Example.com')
+        'http://localhost/lists/announce/got_mail'
+        >>> recipientURL('http://localhost/got_mail', 'x@example.com')
+        'http://localhost/got_mail'
+
+    """
+    recipient = recipient.lower()
+    local, _, domain = recipient.rpartition('@')
+    if not local:
+        local, domain = domain, ''
+    return Template(callURL).safe_substitute(recipient=recipient,
+                                             local=local,
+                                             domain=domain)
+
+
+def parseAddress(arg):
+    """Extract the address from a MAIL FROM/RCPT TO argument.
+
+        >>> parseAddress('TO:<bob@example.com> NOTIFY=NEVER')
+        'bob@example.com'
+        >>> parseAddress('FROM:<>')
+        ''
+        >>> parseAddress('TO: bob@example.com')
+        'bob@example.com'
+
+    """
+    arg = arg.split(':', 1)[-1].strip()
+    if arg.startswith('<'):
+        return arg[1:arg.find('>')]
+    return arg.split(' ', 1)[0]
+
+
+def parseSize(arg):
+    """Extract the declared message size from a MAIL FROM argument.
+
+        >>> parseSize('FROM:<bob@example.com> BODY=8BITMIME SIZE=1000')
+        1000
+        >>> print parseSize('FROM:<bob@example.com>')
+        None
+
+    """
+    for param in arg.split()[1:]:
+        if param.upper().startswith('SIZE='):
+            try:
+                return int(param[len('SIZE='):])
+            except ValueError:
+                return None
+    return None
+
+
+class LMTPHandler(SocketServer.StreamRequestHandler):
+    """Speaks LMTP (RFC 2033) with a single client connection."""
+
+    def setup(self):
+        SocketServer.StreamRequestHandler.setup(self)
+        self.resetTransaction()
+
+    def resetTransaction(self):
+        self.sender = None
+        self.recipients = []
+
+    def reply(self, line):
+        self.wfile.write(line + '\r\n')
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply('220 %s LMTP mailpost ready' % self.server.hostname)
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            line = line.rstrip('\r\n')
+            command, _, arg = line.partition(' ')
+            method = getattr(self, 'lmtp_' + command.upper(), None)
+            if method is None:
+                self.reply('500 5.5.1 Command unrecognized')
+                continue
+            if method(arg) is False:
+                return
+
+    def lmtp_LHLO(self, arg):
+        if not arg:
+            self.reply('501 5.5.4 Syntax: LHLO hostname')
+            return
+        self.resetTransaction()
+        self.reply('250-%s' % self.server.hostname)
+        self.reply('250-PIPELINING')
+        self.reply('250-ENHANCEDSTATUSCODES')
+        if self.server.max_size:
+            self.reply('250-SIZE %d' % self.server.max_size)
+        self.reply('250 8BITMIME')
+
+    def lmtp_MAIL(self, arg):
+        if self.sender is not None:
+            self.reply('503 5.5.1 Nested MAIL command')
+            return
+        size = parseSize(arg)
+        if self.server.max_size and size > self.server.max_size:
+            # refused before the message is sent at all
+            self.reply(TOO_BIG)
+            return
+        self.sender = parseAddress(arg)
+        self.reply('250 2.1.0 Ok')
+
+    def lmtp_RCPT(self, arg):
+        if self.sender is None:
+            self.reply('503 5.5.1 Need MAIL command')
+            return
+        self.recipients.append(parseAddress(arg))
+        self.reply('250 2.1.5 Ok')
+
+    def lmtp_DATA(self, arg):
+        if not self.recipients:
+            self.reply('503 5.5.1 Need RCPT command')
+            return
+        self.reply('354 End data with <CR><LF>.<CR><LF>')
+        try:
+            mailString = self.readData(self.server.max_size)
+        except SizeLimitExceeded, e:
+            log_error('Refused email from %s: %s' % (self.sender, e))
+            for recipient in self.recipients:
+                nous.mailpost.recordExitCode(EXIT_NOPERM)
+                self.reply(TOO_BIG)
+            self.resetTransaction()
+            return
+        if mailString is None:
+            return False
+        for code in self.server.deliverAll(self.recipients, mailString):
+            self.reply(replyForExitCode(code))
+        self.resetTransaction()
+
+    def lmtp_RSET(self, arg):
+        self.resetTransaction()
+        self.reply('250 2.0.0 Ok')
+
+    def lmtp_NOOP(self, arg):
+        self.reply('250 2.0.0 Ok')
+
+    def lmtp_QUIT(self, arg):
+        self.reply('221 2.0.0 Bye')
+        return False
+
+    def readData(self, max_size=0):
+        """Read the dot-terminated message, undoing dot-stuffing.
+
+        Line endings are normalized to LF, as if the message had been
+        piped to the one-shot script.  Returns None if the client went
+        away before the terminating dot.  If the message is bigger than
+        max_size, the rest of it is read without being kept and
+        SizeLimitExceeded is raised after the terminating dot.
+        """
+        lines = []
+        size = 0
+        # whether the line read starts a line, chunks of long ones may not
+        start = True
+        while True:
+            if lines is None:
+                line = self.rfile.readline(65536)
+            elif max_size:
+                # a line cut short is over the limit anyway
+                line = self.rfile.readline(max_size - size + 3)
+            else:
+                line = self.rfile.readline()
+            if not line:
+                return None
+            if start and line in ('.\r\n', '.\n'):
+                if lines is None:
+                    raise SizeLimitExceeded('mail', max_size)
+                return ''.join(lines)
+            start = line.endswith('\n')
+            if lines is None:
+                continue
+            if line.startswith('.'):
+                line = line[1:]
+            if line.endswith('\r\n'):
+                line = line[:-2] + '\n'
+            size += len(line)
+            if max_size and size > max_size:
+                lines = None
+                continue
+            lines.append(line)
+
+
+class LMTPServerMixin:
+    """Delivers the messages received by LMTPHandler."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def setupDelivery(self, callURL, upload_dir, batcher=None, spool=None,
+                      max_size=0, engine=None):
+        self.callURL = callURL
+        self.upload_dir = upload_dir
+        self.batcher = batcher
+        self.spool = spool
+        self.engine = engine
+        self.max_size = max_size
+        self.hostname = socket.getfqdn()
+
+    def deliverAll(self, recipients, mailString):
+        """Generate the exit codes of delivering the mail to recipients,
+        in their order.
+
+        With an engine, the mail is delivered to all of them at once.
+        """
+        if self.engine is not None:
+            deliveries = self.engine.submit(
+                [recipientURL(self.callURL, recipient)
+                 for recipient in recipients],
+                mailString, self.upload_dir)
+            for delivery in deliveries:
+                yield delivery.wait()
+            return
+        for recipient in recipients:
+            yield self.deliver(recipient, mailString)
+
+    def deliver(self, recipient, mailString):
+        callURL = recipientURL(self.callURL, recipient)
+        try:
+            if self.spool is not None:
+                self.spool.enqueue(callURL, mailString, self.upload_dir)
+                return EXIT_OK
+            if self.batcher is not None:
+                return self.batcher.deliver(callURL, mailString,
+                                            self.upload_dir)
+            return nous.mailpost.deliverEmail(callURL, mailString,
+                                              self.upload_dir)
+        except Exception, e:
+            log_error('Unexpected error delivering mail for %s: %s'
+                      % (recipient, e))
+            return EXIT_TEMPFAIL
+
+
+class TCPLMTPServer(LMTPServerMixin, SocketServer.ThreadingMixIn,
+                    SocketServer.TCPServer):
+    pass
+
+
+class UnixLMTPServer(LMTPServerMixin, SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        SocketServer.UnixStreamServer.server_bind(self)
+
+
+def makeServer(callURL, upload_dir, socket_path=None, address=None,
+               batcher=None, spool=None, max_size=0, engine=None):
+    """Create an LMTP server listening on a unix socket or TCP address.
+
+    If batcher (a BatchPoster) is given, messages are posted in batches.
+    If spool is given, messages are only stored in it.  If engine (a
+    DeliveryEngine) is given, messages are posted through it.  Messages
+    bigger than max_size bytes are refused while they are received.
+    """
+    if socket_path:
+        server = UnixLMTPServer(socket_path, LMTPHandler)
+    else:
+        server = TCPLMTPServer(address, LMTPHandler)
+    server.setupDelivery(callURL, upload_dir, batcher, spool, max_size,
+                         engine)
+    return server
+
+
+def parseListenAddress(listen):
+    """Parse a HOST:PORT argument.
+
+        >>> parseListenAddress('127.0.0.1:8024')
+        ('127.0.0.1', 8024)
+        >>> parseListenAddress('8024')
+        ('localhost', 8024)
+
+    """
+    host, _, port = listen.rpartition(':')
+    return (host or 'localhost', int(port))
+
+
+def serve(args):
+    """Entry point of `mailpost serve`."""
+    parser = optparse.OptionParser(
+        usage='%prog serve (--socket=PATH | --listen=HOST:PORT) URL UPLOAD_DIR')
+    parser.add_option('--socket', dest='socket_path', default=None,
+                      help='listen on the unix socket at PATH')
+    parser.add_option('--listen', dest='listen', default=None,
+                      help='listen on TCP HOST:PORT')
+    parser.add_option('--pool-size', dest='pool_size', type='int', default=4,
+                      help='idle HTTP connections kept per host (0 disables'
+                      ' keep-alive)')
+    parser.add_option('--idle-timeout', dest='idle_timeout', type='int',
+                      default=30,
+                      help='seconds an idle HTTP connection is kept open')
+    parser.add_option('--no-index', dest='index', action='store_false',
+                      default=True,
+                      help='do not record stored attachments in the index'
+                      ' of the upload directory')
+    parser.add_option('--hash', dest='hash', default='md5',
+                      help='hash attachments with this algorithm, like'
+                      ' sha256 or blake2b (default: md5)')
+    parser.add_option('--store-threads', dest='store_threads', type='int',
+                      default=0,
+                      help='hash and write attachments in this many threads'
+                      ' (default: 0, in the delivering thread)')
+    parser.add_option('--multipart', dest='multipart', action='store_true',
+                      default=False,
+                      help='post multipart/form-data instead of urlencoded'
+                      ' forms')
+    parser.add_option('--max-size', dest='max_size', type='int', default=0,
+                      metavar='BYTES',
+                      help='refuse messages bigger than this while they are'
+                      ' received (default: 0, no limit)')
+    parser.add_option('--max-attachment-bytes', dest='max_attachments',
+                      type='int', default=0, metavar='BYTES',
+                      help='refuse messages with attachments that decode to'
+                      ' more than this altogether (default: 0, no limit)')
+    parser.add_option('--metrics', dest='metrics', default=None,
+                      metavar='HOST:PORT',
+                      help='serve metrics over HTTP at /metrics on this'
+                      ' address')
+    parser.add_option('--slow-log', dest='slow_log', default=None,
+                      metavar='PATH',
+                      help='append a line of JSON describing every message'
+                      ' that is slow to deliver to this file')
+    parser.add_option('--slow-threshold', dest='slow_threshold',
+                      type='float', default=1.0, metavar='SECONDS',
+                      help='messages taking longer than this to deliver are'
+                      ' slow (default: 1)')
+    parser.add_option('--batch-size', dest='batch_size', type='int',
+                      default=0,
+                      help='post up to this many messages for the same URL'
+                      ' in one request (0 disables batching)')
+    parser.add_option('--batch-delay', dest='batch_delay', type='int',
+                      default=100,
+                      help='milliseconds a message may wait for its batch'
+                      ' to fill up')
+    parser.add_option('--max-in-flight', dest='max_in_flight', type='int',
+                      default=16,
+                      help='number of messages posted at once (0 posts'
+                      ' every message from the thread that received it)')
+    parser.add_option('--per-host', dest='per_host', type='int', default=4,
+                      help='number of messages posted at once to one host')
+    parser.add_option('--process-threads', dest='process_threads',
+                      type='int', default=4,
+                      help='number of messages processed at once, ahead'
+                      ' of posting them')
+    parser.add_option('--spool', dest='spool', default=None,
+                      help='accept messages into this spool directory and'
+                      ' post them from background threads')
+    parser.add_option('--spool-threads', dest='spool_threads', type='int',
+                      default=4,
+                      help='number of spooled messages posted at once')
+    parser.add_option('--per-url', dest='per_url', type='int', default=2,
+                      help='number of spooled messages posted at once to'
+                      ' one URL')
+    options, args = parser.parse_args(args)
+
+    if len(args) != 2:
+        log_critical('serve needs the URL of u2ti instance and directory for'
+                     ' uploaded files (%s parameters given)' % len(args))
+        sys.exit(EXIT_USAGE)
+    callURL, upload_dir = args
+    if callURL.find('http://') == -1:
+        log_critical('URL is specified (%s) is not a valid URL' % callURL)
+        sys.exit(EXIT_USAGE)
+    if bool(options.socket_path) == bool(options.listen):
+        log_critical('exactly one of --socket and --listen should be given')
+        sys.exit(EXIT_USAGE)
+    address = metrics_address = None
+    if options.listen:
+        try:
+            address = parseListenAddress(options.listen)
+        except ValueError:
+            log_critical('Listen address (%s) is invalid' % options.listen)
+            sys.exit(EXIT_USAGE)
+    if options.metrics:
+        try:
+            metrics_address = parseListenAddress(options.metrics)
+        except ValueError:
+            log_critical('Metrics address (%s) is invalid' % options.metrics)
+            sys.exit(EXIT_USAGE)
+
+    if not os.path.exists(upload_dir):
+        os.makedirs(upload_dir)
+    if not os.path.isdir(upload_dir):
+        log_critical('File upload directory (%s) is invalid' % upload_dir)
+        sys.exit(EXIT_USAGE)
+
+    nous.mailpost.installBrokenRedirectHandler()
+    nous.mailpost.setMultipartPost(options.multipart)
+    nous.mailpost.setAttachmentIndex(options.index)
+    nous.mailpost.setSizeLimits(options.max_size, options.max_attachments)
+    if options.slow_log:
+        nous.mailpost.installTracer(
+            SlowMessageLog(options.slow_log, options.slow_threshold))
+    try:
+        nous.mailpost.setHashAlgorithm(options.hash)
+    except ValueError, e:
+        log_critical(str(e))
+        sys.exit(EXIT_USAGE)
+    if options.store_threads > 0:
+        nous.mailpost.installStorePool(StorePool(options.store_threads))
+    if options.pool_size > 0:
+        nous.mailpost.installConnectionPool(
+            ConnectionPool(maxsize=options.pool_size,
+                           idle_timeout=options.idle_timeout))
+    metrics_server = None
+    if metrics_address is not None:
+        registry = Registry()
+        nous.mailpost.installMetrics(registry)
+        metrics_server = MetricsServer(metrics_address, registry)
+        metrics_server.start()
+    batcher = engine = None
+    if options.batch_size > 0:
+        batcher = BatchPoster(max_messages=options.batch_size,
+                              max_delay=options.batch_delay / 1000.0)
+    elif options.max_in_flight > 0:
+        engine = DeliveryEngine(max_in_flight=options.max_in_flight,
+                                per_host=options.per_host,
+                                process_threads=options.process_threads)
+    spool = worker = None
+    if options.spool:
+        spool = Spool(options.spool)
+        if not spool.lockWorker():
+            log_critical('Spool %s is drained by another process already'
+                         % options.spool)
+            sys.exit(EXIT_USAGE)
+        worker = SpoolWorker(spool, threads=options.spool_threads,
+                             per_url=options.per_url, engine=engine)
+        if batcher is not None:
+            def deliverBatched(entry):
+                f = open(spool.getPath(entry.id), 'rb')
+                try:
+                    mailString = f.read()
+                finally:
+                    f.close()
+                return batcher.deliver(entry.callURL, mailString,
+                                       entry.upload_dir)
+            worker.deliver = deliverBatched
+        worker.start()
+    # with a spool, the listener only spools and the worker posts
+    listener_engine = engine
+    if spool is not None:
+        listener_engine = None
+    server = makeServer(callURL, upload_dir,
+                        socket_path=options.socket_path, address=address,
+                        batcher=batcher, spool=spool,
+                        max_size=options.max_size,
+                        engine=listener_engine)
+    log_info('mailpost listening for LMTP on %s' % (server.server_address,))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
+        if worker is not None:
+            worker.stop()
+        if batcher is not None:
+            batcher.close()
+        if engine is not None:
+            engine.close()
+        if metrics_server is not None:
+            metrics_server.stop()
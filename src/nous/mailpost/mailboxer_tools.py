@@ -21,7 +21,9 @@ warnings.simplefilter('ignore', DeprecationWarning)
 import multifile
 warnings.simplefilter('default', DeprecationWarning)
 
-from nous.mailpost.MailBoxerTools import mime_decode_header
+from nous.mailpost.MailBoxerTools import mime_decode_header, decodePart
+from nous.mailpost.MailBoxerTools import Attachment
+from nous.mailpost.limits import LimitedWriter
 
 # these functions are from Products/MailBoxer/MailBoxer_tools.py with a
 # small modification to unpackMultifile to fix a bug
@@ -31,20 +33,13 @@ def unpackMail(mailString):
 
     returns body, content-type, html-body and attachments for mail-string.
     """
-    return unpackMultifile(multifile.MultiFile(StringIO.StringIO(mailString)))
+    return unpackMultifile(multifile.MultiFile(StringIO.StringIO(mailString)),
+                           data=mailString)
 
 
-def unpackMultifile(multifile, attachments=None):
-    """ Unpack multifile into plainbody, content-type, htmlbody and attachments.
+def getPartName(msg):
+    """ Return the file name of a message part or None.
     """
-    if attachments is None:
-        attachments=[]
-    textBody = htmlBody = contentType = ''
-
-    msg = mimetools.Message(multifile)
-    maintype = msg.getmaintype()
-    subtype = msg.getsubtype()
-
     name = msg.getparam('name')
 
     if not name:
@@ -55,6 +50,23 @@ def unpackMultifile(multifile, attachments=None):
                                    disposition)
             if matchObj:
                 name = matchObj.group('filename')
+    return name
+
+
+def unpackMultifile(multifile, attachments=None, data=None):
+    """ Unpack multifile into plainbody, content-type, htmlbody and attachments.
+
+    If multifile reads the string data, bodies are decoded from it in bulk.
+    """
+    if attachments is None:
+        attachments=[]
+    textBody = htmlBody = contentType = ''
+
+    msg = mimetools.Message(multifile)
+    maintype = msg.getmaintype()
+    subtype = msg.getsubtype()
+
+    name = getPartName(msg)
 
     # Recurse over all nested multiparts
     if maintype == 'multipart':
@@ -64,7 +76,7 @@ def unpackMultifile(multifile, attachments=None):
             multifile.next()
 
             (tmpTextBody, tmpContentType, tmpHtmlBody, tmpAttachments) = \
-                                       unpackMultifile(multifile, attachments)
+                           unpackMultifile(multifile, attachments, data)
 
             # Return ContentType only for the plain-body of a mail
             if tmpContentType:# and not textBody:
@@ -82,13 +94,7 @@ def unpackMultifile(multifile, attachments=None):
 
     # Process MIME-encoded data
     plainfile = StringIO.StringIO()
-
-    try:
-        mimetools.decode(multifile,plainfile,msg.getencoding())
-    # unknown or no encoding? 7bit, 8bit or whatever... copy literal
-    except ValueError:
-        mimetools.copyliteral(multifile,plainfile)
-
+    decodePart(msg, multifile, plainfile, data)
     body = plainfile.getvalue()
     plainfile.close()
 
@@ -102,10 +108,296 @@ def unpackMultifile(multifile, attachments=None):
             name = '%s.%s' % (maintype,subtype)
             htmlBody = body
 
-        attachments.append({'filename' : mime_decode_header(name),
-                            'filebody' : body,
-                            'maintype' : maintype,
-                            'subtype' : subtype})
+        attachments.append(Attachment(mime_decode_header(name),
+                                      maintype, subtype, body))
 
     return (textBody, contentType, htmlBody, attachments)
 
+
+
+# Single pass variant of unpackMail.  The mail is read incrementally,
+# so attachment bodies never have to be held in memory, and the mail to
+# post is cut from the original by the offsets found on the way, or
+# taken from the lines read if there is no original to cut from.
+
+def closingBoundary(line):
+    r""" Return the closing line for the boundary line of a multipart.
+
+        >>> closingBoundary('--outer\r\n')
+        '--outer--\r\n'
+        >>> closingBoundary('--outer--\n')
+        '--outer--\n'
+
+    """
+    if not line.startswith('--'):
+        return line
+    boundary = line.rstrip('\r\n')
+    if boundary.endswith('--'):
+        return line
+    return boundary + '--' + line[len(boundary):]
+
+
+class BufferFile:
+    """ Reads the start of a buffer, followed by a tail string, like a
+    file, copying only as much as is read at a time.
+
+        >>> f = BufferFile('Hello world', 5, '!')
+        >>> len(f)
+        6
+        >>> f.read(3), f.read(), f.read()
+        ('Hel', 'lo!', '')
+
+    len() is the number of bytes left to read.
+    """
+
+    def __init__(self, data, end=None, tail=''):
+        if end is None:
+            end = len(data)
+        self.data = data
+        self.end = end
+        self.tail = tail
+        self.pos = 0
+
+    def __len__(self):
+        return self.end + len(self.tail) - self.pos
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=0):
+        if whence == 1:
+            pos += self.pos
+        elif whence == 2:
+            pos += self.end + len(self.tail)
+        self.pos = max(pos, 0)
+
+    def read(self, size=-1):
+        start = self.pos
+        stop = self.end + len(self.tail)
+        if size >= 0:
+            stop = min(start + size, stop)
+        if start >= stop:
+            return ''
+        self.pos = stop
+        if stop <= self.end:
+            return self.data[start:stop]
+        head = ''
+        if start < self.end:
+            head = self.data[start:self.end]
+        return head + self.tail[max(start - self.end, 0):stop - self.end]
+
+
+class RecordingFile:
+    """ File wrapper that keeps track of the raw lines read through it.
+
+    `offset` is the number of bytes read so far.  Unless recording is
+    turned off, two copies of the lines are kept as well: `full` holds
+    every line read until forget() is called and `stripped` holds the
+    lines up to the end of the first part of the mail.
+    """
+
+    def __init__(self, fp, record=True):
+        self.fp = fp
+        self.offset = 0
+        self.last = ''
+        self.firstPartEnd = None
+        self.closing = ''
+        self.full = self.stripped = None
+        if record:
+            self.full = []
+            self.stripped = []
+
+    def readline(self):
+        line = self.fp.readline()
+        self.offset += len(line)
+        self.last = line
+        if self.full is not None:
+            self.full.append(line)
+        if self.stripped is not None and self.firstPartEnd is None:
+            self.stripped.append(line)
+        return line
+
+    def tell(self):
+        return self.offset
+
+    def seek(self, offset):
+        """ Skip to offset, without recording what is skipped.
+        """
+        self.fp.seek(offset)
+        self.offset = offset
+
+    def forget(self):
+        """ Stop recording the full copy of the mail.
+        """
+        self.full = None
+
+    def endFirstPart(self):
+        """ Note that the first part of the mail and the boundary line
+        after it have just been read.
+        """
+        # the line break before the boundary belongs to the boundary, but
+        # keeping it matches what the email package makes of the part
+        self.firstPartEnd = self.offset - len(self.last)
+        self.closing = closingBoundary(self.last)
+        if self.stripped:
+            self.stripped[-1] = self.closing
+
+
+def iterMultifile(multifile, recorder=None, msg=None):
+    """ Generate the mimetools.Message of every non-multipart part.
+
+    The multifile is positioned at the start of the part body when the
+    part is yielded; bodies that were not read are skipped.  msg is the
+    mimetools.Message of the headers, if they were read already.  If
+    recorder is given, it is told where the first part of the mail ends.
+    """
+    if msg is None:
+        msg = mimetools.Message(multifile)
+    if msg.getmaintype() != 'multipart':
+        yield msg
+        return
+
+    multifile.push(msg.getparam('boundary'))
+    multifile.readlines()
+    first = True
+    while not multifile.last:
+        if not multifile.next():
+            break
+        for part in iterMultifile(multifile):
+            yield part
+        if recorder is not None and first:
+            while multifile.readline():
+                pass
+            recorder.endFirstPart()
+        first = False
+    multifile.pop()
+
+
+class ParsedMail:
+    """ A mail parsed in a single pass.
+
+    Holds the top-level headers (a mimetools.Message), the plain text
+    and html bodies and the attachments found in the mail, and the mail
+    to post: the original mail if it had no attachments, otherwise its
+    headers and first part only.
+
+    The decoded body of every attachment is written to the file returned
+    by openAttachment(attachment) and closed afterwards.  Without
+    openAttachment, bodies are kept in attachment.body like unpackMail
+    does.  If fp reads a mail available as a string (or any
+    other buffer that can be sliced) already, pass it as original: the
+    mail to post is then cut from it instead of being recorded.  If
+    attachmentLimit (a limits.SizeLimit) is given, the decoded bodies are
+    counted against it and parsing stops as soon as they pass it.
+    """
+
+    def __init__(self, fp, openAttachment=None, original=None,
+                 attachmentLimit=None):
+        self.textBody = self.htmlBody = self.contentType = ''
+        self.attachments = []
+        self.openAttachment = openAttachment
+        self.original = original
+        self.attachmentLimit = attachmentLimit
+        self.recorder = RecordingFile(fp, record=original is None)
+
+        parts = multifile.MultiFile(self.recorder, seekable=0)
+        self.headers = mimetools.Message(parts)
+        for msg in iterMultifile(parts, self.recorder, self.headers):
+            self.addPart(msg)
+
+    def addPart(self, msg):
+        maintype = msg.getmaintype()
+        subtype = msg.getsubtype()
+        name = getPartName(msg)
+
+        if maintype == 'text' and subtype == 'plain' and not name:
+            plainfile = StringIO.StringIO()
+            decodePart(msg, msg.fp, plainfile, self.original)
+            self.textBody += plainfile.getvalue()
+            self.contentType = msg.get('content-type', 'text/plain')
+            return
+
+        self.recorder.forget()
+        attachment = Attachment(None, maintype, subtype)
+        body = None
+        if not name:
+            # No name? This should be the html-body...
+            name = '%s.%s' % (maintype,subtype)
+            plainfile = StringIO.StringIO()
+            decodePart(msg, msg.fp, plainfile, self.original)
+            body = self.htmlBody = plainfile.getvalue()
+        attachment.filename = mime_decode_header(name)
+
+        if self.openAttachment is None:
+            output = StringIO.StringIO()
+        else:
+            output = self.openAttachment(attachment)
+        writer = output
+        if self.attachmentLimit is not None:
+            writer = LimitedWriter(output, self.attachmentLimit)
+        if body is None:
+            decodePart(msg, msg.fp, writer, self.original)
+        else:
+            writer.write(body)
+        if self.openAttachment is None:
+            attachment.body = output.getvalue()
+            attachment.size = len(attachment.body)
+        output.close()
+        self.attachments.append(attachment)
+
+    def unpack(self):
+        """ Return body, content-type, html-body and attachments, like
+        unpackMail.
+        """
+        return (self.textBody, self.contentType, self.htmlBody,
+                self.attachments)
+
+    def strippedMail(self):
+        """ Return the headers and the first part of the mail.
+        """
+        if self.original is None:
+            return ''.join(self.recorder.stripped)
+        end = self.recorder.firstPartEnd
+        if end is None:
+            # not a multipart, there is nothing to cut off
+            return self.original[:]
+        return self.original[:end] + self.recorder.closing
+
+    def mailFile(self):
+        """ Return a BufferFile reading the mail to post from the original.
+        """
+        if self.attachments and self.recorder.firstPartEnd is not None:
+            return BufferFile(self.original, self.recorder.firstPartEnd,
+                              self.recorder.closing)
+        return BufferFile(self.original)
+
+    def mailString(self):
+        """ Return the mail to post.
+        """
+        if self.attachments:
+            return self.strippedMail()
+        if self.original is not None:
+            return self.original[:]
+        return ''.join(self.recorder.full)
+
+
+def parseMail(mailString, openAttachment=None, attachmentLimit=None):
+    """ Return the ParsedMail of a mail given as string.
+    """
+    return ParsedMail(StringIO.StringIO(mailString), openAttachment,
+                      original=mailString, attachmentLimit=attachmentLimit)
+
+
+def unpackMailStream(fp, openAttachment):
+    """ Unpack a mail while reading it incrementally from fp.
+
+    Works like unpackMail, but the decoded body of every attachment is
+    written straight to the file returned by openAttachment(attachment)
+    (and closed afterwards), so no attachment keeps its body.
+    Only the plain text and html bodies are kept in memory.
+
+    Returns body, content-type, html-body, attachments and the mail to
+    post (see ParsedMail).
+    """
+    mail = ParsedMail(fp, openAttachment)
+    return mail.unpack() + (mail.mailString(),)
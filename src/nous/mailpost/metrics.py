@@ -0,0 +1,312 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Counters and histograms of the mailpost pipeline.
+
+Install a Registry (see installMetrics) and the pipeline counts the
+messages it processes, their attachments and posts in it.  Daemons serve
+the registry in the Prometheus text format with a MetricsServer:
+
+    mailpost serve --metrics=127.0.0.1:9125 ...
+
+The one-shot script lives too short to be scraped, so it sends what it
+measured to a statsd server, or appends it to a file in the statsd line
+format, when it exits:
+
+    mailpost --statsd=127.0.0.1:8125 ...
+    mailpost --metrics-file=/var/log/mailpost/metrics ...
+"""
+import socket
+import threading
+import BaseHTTPServer
+import SocketServer
+
+
+# name, type and description of every metric
+METRICS = [
+    ('messages_total', 'counter', 'Messages processed.'),
+    ('received_bytes_total', 'counter', 'Bytes of the messages processed.'),
+    ('parse_seconds', 'histogram',
+     'Time spent parsing and decoding a message.'),
+    ('attachments_total', 'counter', 'Attachments found in messages.'),
+    ('attachment_bytes_total', 'counter', 'Decoded bytes of attachments.'),
+    ('store_seconds', 'histogram',
+     'Time spent storing the attachments of a message.'),
+    ('store_dedup_hits_total', 'counter',
+     'Attachments that were stored already.'),
+    ('post_seconds', 'histogram', 'Time spent posting, by HTTP status.'),
+    ('exit_codes_total', 'counter', 'Messages by exit code.'),
+    ]
+
+# upper bounds of the histogram buckets, in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+           30.0)
+
+
+def formatLabels(labels, extra=()):
+    """Format the labels of a sample.
+
+        >>> formatLabels((('status', '200'),), (('le', '0.5'),))
+        '{status="200",le="0.5"}'
+        >>> formatLabels(())
+        ''
+
+    """
+    labels = tuple(labels) + tuple(extra)
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, value)
+                              for name, value in labels])
+
+
+def formatValue(value):
+    if isinstance(value, float) and value == int(value):
+        value = int(value)
+    return repr(value).rstrip('L')
+
+
+class Registry(object):
+    """Counters and histograms, kept by name and labels.
+
+        >>> registry = Registry()
+        >>> registry.inc('messages_total')
+        >>> registry.inc('exit_codes_total', code=0)
+        >>> registry.observe('post_seconds', 0.3, status=200)
+        >>> print registry.render(),
+        # HELP mailpost_messages_total Messages processed.
+        # TYPE mailpost_messages_total counter
+        mailpost_messages_total 1
+        # HELP mailpost_post_seconds Time spent posting, by HTTP status.
+        # TYPE mailpost_post_seconds histogram
+        mailpost_post_seconds_bucket{status="200",le="0.005"} 0
+        ...
+        mailpost_post_seconds_bucket{status="200",le="0.25"} 0
+        mailpost_post_seconds_bucket{status="200",le="0.5"} 1
+        ...
+        mailpost_post_seconds_bucket{status="200",le="+Inf"} 1
+        mailpost_post_seconds_sum{status="200"} 0.3
+        mailpost_post_seconds_count{status="200"} 1
+        # HELP mailpost_exit_codes_total Messages by exit code.
+        # TYPE mailpost_exit_codes_total counter
+        mailpost_exit_codes_total{code="0"} 1
+
+    """
+
+    def __init__(self, prefix='mailpost_'):
+        self.prefix = prefix
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter."""
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            self.samples[key] = self.samples.get(key, 0) + value
+        finally:
+            self.lock.release()
+
+    def observe(self, name, value, **labels):
+        """Count value in a histogram."""
+        key = (name, tuple(sorted(labels.items())))
+        self.lock.acquire()
+        try:
+            histogram = self.samples.get(key)
+            if histogram is None:
+                # counts by bucket, then the sum and the count of values
+                histogram = self.samples[key] = [0] * len(BUCKETS) + [0, 0]
+            for i, bound in enumerate(BUCKETS):
+                if value <= bound:
+                    histogram[i] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+        finally:
+            self.lock.release()
+
+    def get(self, name, **labels):
+        """Return the value of a counter, or the count of a histogram."""
+        sample = self.samples.get((name, tuple(sorted(labels.items()))), 0)
+        if isinstance(sample, list):
+            return sample[-1]
+        return sample
+
+    def render(self):
+        """Return the samples in the Prometheus text format."""
+        samples = []
+        self.lock.acquire()
+        try:
+            for key, value in self.samples.items():
+                if isinstance(value, list):
+                    value = value[:]
+                samples.append((key, value))
+        finally:
+            self.lock.release()
+        samples.sort()
+        lines = []
+        for name, kind, description in METRICS:
+            found = [(labels, value) for (sample_name, labels), value
+                     in samples if sample_name == name]
+            if not found:
+                continue
+            full_name = self.prefix + name
+            lines.append('# HELP %s %s' % (full_name, description))
+            lines.append('# TYPE %s %s' % (full_name, kind))
+            for labels, value in found:
+                if kind == 'counter':
+                    lines.append('%s%s %s' % (full_name, formatLabels(labels),
+                                              formatValue(value)))
+                    continue
+                bounds = [repr(bound) for bound in BUCKETS] + ['+Inf']
+                counts = value[:len(BUCKETS)] + [value[-1]]
+                for bound, count in zip(bounds, counts):
+                    lines.append('%s_bucket%s %d' % (
+                        full_name, formatLabels(labels, [('le', bound)]),
+                        count))
+                lines.append('%s_sum%s %s' % (full_name, formatLabels(labels),
+                                              formatValue(value[-2])))
+                lines.append('%s_count%s %d' % (full_name,
+                                                formatLabels(labels),
+                                                value[-1]))
+        return ''.join([line + '\n' for line in lines])
+
+
+class StatsdSink(object):
+    """Collects samples as statsd lines and sends them when flushed.
+
+    Labels are folded into the metric name, histograms are sent as
+    timers in milliseconds:
+
+        >>> sink = StatsdSink()
+        >>> sink.inc('messages_total')
+        >>> sink.observe('post_seconds', 0.25, status=200)
+        >>> sink.lines
+        ['mailpost.messages_total:1|c', 'mailpost.post_seconds.status_200:250|ms']
+
+    The lines are sent over UDP to address, a (host, port) pair, and
+    appended to the file at path.
+    """
+
+    # bytes of lines sent in one datagram at most
+    packet_size = 512
+
+    def __init__(self, address=None, path=None, prefix='mailpost.'):
+        self.address = address
+        self.path = path
+        self.prefix = prefix
+        self.lines = []
+        self.lock = threading.Lock()
+
+    def getName(self, name, labels):
+        parts = [self.prefix + name]
+        for label, value in sorted(labels.items()):
+            parts.append('%s_%s' % (label, value))
+        return '.'.join(parts)
+
+    def add(self, line):
+        self.lock.acquire()
+        try:
+            self.lines.append(line)
+        finally:
+            self.lock.release()
+
+    def inc(self, name, value=1, **labels):
+        self.add('%s:%s|c' % (self.getName(name, labels), formatValue(value)))
+
+    def observe(self, name, value, **labels):
+        # every histogram is one of seconds
+        self.add('%s:%s|ms' % (self.getName(name, labels),
+                               formatValue(round(value * 1000, 3))))
+
+    def getPackets(self, lines):
+        packet = []
+        size = 0
+        for line in lines:
+            if packet and size + len(line) + 1 > self.packet_size:
+                yield '\n'.join(packet)
+                packet = []
+                size = 0
+            packet.append(line)
+            size += len(line) + 1
+        if packet:
+            yield '\n'.join(packet)
+
+    def flush(self):
+        """Send the lines collected so far, errors are ignored."""
+        self.lock.acquire()
+        try:
+            lines, self.lines = self.lines, []
+        finally:
+            self.lock.release()
+        if not lines:
+            return
+        if self.address is not None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            try:
+                for packet in self.getPackets(lines):
+                    try:
+                        sock.sendto(packet, self.address)
+                    except socket.error:
+                        pass
+            finally:
+                sock.close()
+        if self.path is not None:
+            try:
+                f = open(self.path, 'a')
+                try:
+                    # a single write, so lines of processes exiting at
+                    # the same time are not interleaved
+                    f.write(''.join([line + '\n' for line in lines]))
+                finally:
+                    f.close()
+            except EnvironmentError:
+                pass
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the registry of the server at /metrics."""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.registry.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MetricsServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Serves a Registry over HTTP from a thread of its own."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, registry):
+        BaseHTTPServer.HTTPServer.__init__(self, address, MetricsHandler)
+        self.registry = registry
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.thread.join()
+        self.server_close()
@@ -0,0 +1,123 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Profiling deliveries on real traffic.
+
+    mailpost --profile=/var/tmp/mailpost-profiles URL UPLOAD_DIR ...
+
+delivers the mail under cProfile and dumps the profile of the run to
+the directory.  Once report_every profiles have gathered there, the
+process that finds them claims them by moving them into a directory of
+their own, report-*, and aggregates them into report.prof (for pstats)
+and report.txt, the functions sorted by cumulative and internal time.
+Every profile goes to exactly one report, however many mailpost
+processes the MTA runs at once.
+"""
+import os
+import time
+import glob
+import pstats
+import cProfile
+from cStringIO import StringIO
+
+from nous.mailpost import log_warning
+
+
+# Functions listed in a report, by each sort order
+REPORT_LINES = 40
+
+
+def getStamp():
+    return '%.6f-%d' % (time.time(), os.getpid())
+
+
+def writeReport(paths, directory):
+    """Aggregate the profiles at paths into directory."""
+    stats = pstats.Stats(paths[0])
+    for path in paths[1:]:
+        stats.add(path)
+    stats.dump_stats(os.path.join(directory, 'report.prof'))
+    output = StringIO()
+    stats.stream = output
+    print >> output, 'Aggregated from %d profiles' % len(paths)
+    stats.sort_stats('cumulative').print_stats(REPORT_LINES)
+    stats.sort_stats('time').print_stats(REPORT_LINES)
+    f = open(os.path.join(directory, 'report.txt'), 'w')
+    try:
+        f.write(output.getvalue())
+    finally:
+        f.close()
+
+
+class Profiler(object):
+    """Profiles function calls into directory, aggregating every
+    report_every of them in a report.
+    """
+
+    def __init__(self, directory, report_every=100):
+        self.directory = directory
+        self.report_every = report_every
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def run(self, function, *args):
+        """Call function under the profiler, return what it returns.
+
+        The profile is dumped however the function exits, sys.exit()
+        included.  Failing to dump or report it does not change how it
+        exits, the MTA goes by the exit code.
+        """
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args)
+        finally:
+            try:
+                self.dump(profile)
+            except Exception, e:
+                log_warning('Could not dump profile to %s: %s'
+                            % (self.directory, e))
+
+    def dump(self, profile):
+        """Dump the profile into the directory, reporting if it is time."""
+        stamp = getStamp()
+        tmp_path = os.path.join(self.directory, '.%s.tmp' % stamp)
+        profile.dump_stats(tmp_path)
+        # only complete profiles are ever seen by others
+        os.rename(tmp_path, os.path.join(self.directory, '%s.prof' % stamp))
+        if self.report_every > 0:
+            self.report()
+
+    def report(self, force=False):
+        """Aggregate the profiles in the directory if there are enough.
+
+        Returns the directory of the report, or None.
+        """
+        paths = glob.glob(os.path.join(self.directory, '*.prof'))
+        if not paths or (len(paths) < self.report_every and not force):
+            return None
+        report_dir = os.path.join(self.directory, 'report-%s' % getStamp())
+        os.mkdir(report_dir)
+        claimed = []
+        for path in sorted(paths):
+            target = os.path.join(report_dir, os.path.basename(path))
+            try:
+                os.rename(path, target)
+            except OSError:
+                # claimed by another process meanwhile
+                continue
+            claimed.append(target)
+        if not claimed:
+            os.rmdir(report_dir)
+            return None
+        writeReport(claimed, report_dir)
+        return report_dir
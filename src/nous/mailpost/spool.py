@@ -0,0 +1,702 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Local durable spool of messages waiting to be posted.
+
+Instead of making the MTA requeue a message with EXIT_TEMPFAIL when the
+Zope side is slow or down, mailpost can accept the message into a spool
+and post it later from a background worker:
+
+    mailpost --spool=/var/spool/mailpost URL UPLOAD_DIR SENDER RECIPIENT
+    mailpost drain /var/spool/mailpost
+
+Message files are sharded into directories named after the first two
+characters of their ids, which are reused as messages come and go.
+Every change to the spool is first appended to a journal, which is
+replayed when the spool is opened.  Concurrent writers share the
+journal fsyncs, so a burst of messages costs fewer syncs than messages.
+
+Journal records are tab separated lines:
+
+    E  id  url  upload_dir  time    message enqueued
+    R  id  attempts  next_try       delivery failed temporarily
+    D  id                           message delivered (or dropped)
+    F  id                           delivery failed permanently
+"""
+import os
+import sys
+import time
+import uuid
+import errno
+import fcntl
+import urllib
+import optparse
+import threading
+
+import nous.mailpost
+from nous.mailpost import EXIT_OK, EXIT_USAGE, EXIT_TEMPFAIL
+from nous.mailpost import getAttachmentPath, copy_chunked, LEGACY_LAYOUT
+from nous.mailpost import log_critical, log_error, log_info, log_warning
+from nous.mailpost.storepool import StorePool
+from nous.mailpost.metrics import Registry, MetricsServer
+from nous.mailpost.trace import SlowMessageLog
+
+
+# Spool ids are random, so a fan-out of at most 256 directories is
+# shared by all messages instead of new directories for each of them
+SPOOL_LAYOUT = (2,)
+
+
+def makeDirectories(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            # somebody else might have created it meanwhile
+            if not os.path.isdir(path):
+                raise
+
+
+def fsyncDirectory(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class SpoolEntry(object):
+    """A message in the spool."""
+
+    def __init__(self, id, callURL, upload_dir, enqueued,
+                 attempts=0, next_try=0):
+        self.id = id
+        self.callURL = callURL
+        self.upload_dir = upload_dir
+        self.enqueued = enqueued
+        self.attempts = attempts
+        self.next_try = next_try
+        self.in_progress = False
+
+
+class Spool(object):
+    """Messages kept on disk until they are posted.
+
+    Any number of processes may enqueue messages, but only the one that
+    holds the worker lock (see lockWorker) posts them.  It picks up
+    messages spooled by other processes by reading what they append to
+    the journal, and compacts the journal as it grows.
+    """
+
+    # journals bigger than this are compacted by the worker
+    max_journal_size = 1 << 20
+
+    def __init__(self, directory, replay=True):
+        self.directory = directory
+        self.queue_dir = os.path.join(directory, 'queue')
+        self.failed_dir = os.path.join(directory, 'failed')
+        self.journal_path = os.path.join(directory, 'journal')
+        for path in (self.queue_dir, self.failed_dir):
+            makeDirectories(path)
+
+        # protects entries and appending to the journal
+        self.condition = threading.Condition()
+        # serializes fsyncs of the journal
+        self.sync_lock = threading.Lock()
+        self.written = 0
+        self.synced = 0
+        self.worker_lock = None
+
+        self.entries = {}
+        self.journal = None
+        self.offset = 0
+        self.compacted_size = 0
+        if replay:
+            self.refresh()
+
+    def getPath(self, id):
+        return getAttachmentPath(id, self.queue_dir, SPOOL_LAYOUT)
+
+    def getLegacyPath(self, id):
+        """Return where older versions spooled the message, sharded
+        like attachments into directories of 8 characters."""
+        return getAttachmentPath(id, self.queue_dir, LEGACY_LAYOUT)
+
+    def removeLegacyDirectories(self):
+        """Remove the empty directories older versions spooled in."""
+        for name in os.listdir(self.queue_dir):
+            top = os.path.join(self.queue_dir, name)
+            if len(name) == SPOOL_LAYOUT[0] or not os.path.isdir(top):
+                continue
+            for path, dirnames, filenames in os.walk(top, topdown=False):
+                try:
+                    os.rmdir(path)
+                except OSError, e:
+                    if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                        raise
+
+    #
+    # Journal
+    #
+
+    def openJournal(self):
+        """Open the journal for appending and lock it.
+
+        The journal may have been replaced by compact() in the meantime,
+        so make sure the file we locked is still the current one.
+        """
+        while True:
+            journal = open(self.journal_path, 'a')
+            fcntl.flock(journal.fileno(), fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.journal_path).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(journal.fileno()).st_ino:
+                return journal
+            journal.close()
+
+    def append(self, record):
+        """Append a record to the journal, return its sequence number.
+
+        Must be called with the condition held.
+        """
+        if self.journal is None:
+            self.journal = self.openJournal()
+        else:
+            fcntl.flock(self.journal.fileno(), fcntl.LOCK_EX)
+            if os.stat(self.journal_path).st_ino != \
+                    os.fstat(self.journal.fileno()).st_ino:
+                self.journal.close()
+                self.journal = self.openJournal()
+        try:
+            self.journal.write(record)
+            self.journal.flush()
+        finally:
+            fcntl.flock(self.journal.fileno(), fcntl.LOCK_UN)
+        self.written += 1
+        return self.written
+
+    def sync(self, seq):
+        """Make sure the journal is on disk up to record seq.
+
+        Whoever gets to sync first, syncs the records of all the threads
+        waiting behind it as well.
+        """
+        self.sync_lock.acquire()
+        try:
+            if self.synced >= seq:
+                return
+            self.condition.acquire()
+            try:
+                written = self.written
+                if self.journal is None:
+                    # compact() rewrote and synced the journal meanwhile
+                    self.synced = written
+                    return
+                # a descriptor of our own, compact() or close() may close
+                # the journal meanwhile
+                fileno = os.dup(self.journal.fileno())
+            finally:
+                self.condition.release()
+            try:
+                os.fsync(fileno)
+            finally:
+                os.close(fileno)
+            self.synced = written
+        finally:
+            self.sync_lock.release()
+
+    def refresh(self):
+        """Replay the records appended to the journal since the last call."""
+        self.condition.acquire()
+        try:
+            try:
+                journal = open(self.journal_path)
+            except IOError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+                return
+            try:
+                journal.seek(self.offset)
+                for line in journal:
+                    if not line.endswith('\n'):
+                        # a record that is still being written
+                        break
+                    self.offset += len(line)
+                    self.replay(line[:-1].split('\t'))
+            finally:
+                journal.close()
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def replay(self, record):
+        try:
+            if record[0] == 'E':
+                id, url, upload_dir, enqueued = record[1:]
+                if id not in self.entries:
+                    self.entries[id] = SpoolEntry(id, urllib.unquote(url),
+                                                  urllib.unquote(upload_dir),
+                                                  float(enqueued))
+            elif record[0] == 'R':
+                id, attempts, next_try = record[1:]
+                if id in self.entries:
+                    self.entries[id].attempts = int(attempts)
+                    self.entries[id].next_try = float(next_try)
+            elif record[0] in ('D', 'F'):
+                self.entries.pop(record[1], None)
+        except (ValueError, IndexError):
+            log_warning('Skipping broken spool journal record %r' % (record,))
+
+    def compact(self):
+        """Rewrite the journal with the records of pending messages only.
+
+        Messages spooled by older versions are moved into the current
+        layout.
+
+        Only the process holding the worker lock may do this.
+        """
+        self.condition.acquire()
+        try:
+            journal = self.openJournal()
+            try:
+                self.refresh()
+                for entry in self.entries.values():
+                    path = self.getPath(entry.id)
+                    if entry.in_progress or os.path.exists(path):
+                        continue
+                    legacy_path = self.getLegacyPath(entry.id)
+                    if os.path.exists(legacy_path):
+                        makeDirectories(os.path.dirname(path))
+                        os.rename(legacy_path, path)
+                        continue
+                    log_warning('Spooled message %s is missing' % entry.id)
+                    del self.entries[entry.id]
+                self.removeLegacyDirectories()
+
+                tmp_path = self.journal_path + '.new'
+                new = open(tmp_path, 'w')
+                for entry in sorted(self.entries.values(),
+                                    key=lambda e: e.enqueued):
+                    new.write(self.formatEnqueued(entry))
+                    if entry.attempts:
+                        new.write(self.formatRetry(entry))
+                new.flush()
+                os.fsync(new.fileno())
+                self.offset = self.compacted_size = new.tell()
+                new.close()
+                os.rename(tmp_path, self.journal_path)
+                fsyncDirectory(self.directory)
+            finally:
+                journal.close()
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+        finally:
+            self.condition.release()
+
+    def compactIfLarge(self):
+        """Compact the journal once it is bigger than max_journal_size.
+
+        A journal that is big because many messages are pending is only
+        compacted again once it doubled.
+        """
+        try:
+            size = os.path.getsize(self.journal_path)
+        except OSError:
+            return
+        if size > max(self.max_journal_size, 2 * self.compacted_size):
+            self.compact()
+
+    def lockWorker(self):
+        """Take the worker lock of the spool, return False if it is taken."""
+        self.worker_lock = open(os.path.join(self.directory, 'worker.lock'),
+                                'a')
+        try:
+            fcntl.flock(self.worker_lock.fileno(),
+                        fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            self.worker_lock.close()
+            self.worker_lock = None
+            return False
+        return True
+
+    def formatEnqueued(self, entry):
+        return 'E\t%s\t%s\t%s\t%f\n' % (entry.id,
+                                        urllib.quote(entry.callURL, ''),
+                                        urllib.quote(entry.upload_dir, ''),
+                                        entry.enqueued)
+
+    def formatRetry(self, entry):
+        return 'R\t%s\t%d\t%f\n' % (entry.id, entry.attempts, entry.next_try)
+
+    #
+    # Queue
+    #
+
+    def enqueue(self, callURL, mail, upload_dir):
+        """Durably store the mail (a string or a file), return its entry."""
+        entry = SpoolEntry(uuid.uuid4().hex, callURL, upload_dir, time.time())
+        path = self.getPath(entry.id)
+        dirname = os.path.dirname(path)
+        makeDirectories(dirname)
+        f = open(path, 'wb')
+        try:
+            try:
+                copy_chunked(mail, f, 65536)
+                f.flush()
+                os.fsync(f.fileno())
+            finally:
+                f.close()
+        except:
+            # a mail refused or cut short is not left behind
+            os.unlink(path)
+            raise
+        fsyncDirectory(dirname)
+
+        self.condition.acquire()
+        try:
+            seq = self.append(self.formatEnqueued(entry))
+            self.entries[entry.id] = entry
+        finally:
+            self.condition.release()
+        self.sync(seq)
+
+        self.condition.acquire()
+        try:
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        return entry
+
+    def done(self, entry):
+        """Remove a delivered message from the spool."""
+        self.condition.acquire()
+        try:
+            seq = self.append('D\t%s\n' % entry.id)
+            self.entries.pop(entry.id, None)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        self.sync(seq)
+        try:
+            os.unlink(self.getPath(entry.id))
+        except OSError, e:
+            if e.errno != errno.ENOENT:
+                raise
+
+    def retry(self, entry, next_try):
+        """Schedule another delivery attempt of the message."""
+        self.condition.acquire()
+        try:
+            entry.attempts += 1
+            entry.next_try = next_try
+            entry.in_progress = False
+            seq = self.append(self.formatRetry(entry))
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        self.sync(seq)
+
+    def fail(self, entry):
+        """Move a message that can not be delivered out of the queue."""
+        os.rename(self.getPath(entry.id),
+                  os.path.join(self.failed_dir, entry.id))
+        self.condition.acquire()
+        try:
+            seq = self.append('F\t%s\n' % entry.id)
+            self.entries.pop(entry.id, None)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        self.sync(seq)
+
+    def close(self):
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.worker_lock is not None:
+            self.worker_lock.close()
+            self.worker_lock = None
+
+
+class SpoolWorker(object):
+    """Posts spooled messages, retrying with exponential backoff.
+
+    At most `per_url` messages for the same URL are posted at once.  A
+    message that failed temporarily is retried after retry_delay seconds,
+    doubling the delay with every attempt up to max_retry_delay.  Messages
+    still failing after max_age seconds, or refused permanently (e.g. with
+    EXIT_NOUSER), are moved to the failed directory of the spool.  If
+    engine (an engine.DeliveryEngine) is given, messages are posted
+    through it.  After every message, the journal is compacted if it
+    grew too big (see Spool.compactIfLarge).
+    """
+
+    # seconds between looking for messages spooled by other processes
+    poll_interval = 1.0
+
+    def __init__(self, spool, threads=4, per_url=2, retry_delay=60,
+                 max_retry_delay=3600, max_age=5*24*3600, deliver=None,
+                 engine=None):
+        self.spool = spool
+        self.engine = engine
+        self.threads = threads
+        self.per_url = per_url
+        self.retry_delay = retry_delay
+        self.max_retry_delay = max_retry_delay
+        self.max_age = max_age
+        if deliver is not None:
+            self.deliver = deliver
+        self.active = {}
+        self.running = False
+        self.workers = []
+
+    def deliver(self, entry):
+        f = open(self.spool.getPath(entry.id), 'rb')
+        try:
+            mail = nous.mailpost.mapMail(f)
+        finally:
+            f.close()
+        try:
+            if self.engine is not None:
+                return self.engine.deliver(entry.callURL, mail,
+                                           entry.upload_dir)
+            return nous.mailpost.deliverEmail(entry.callURL, mail,
+                                              entry.upload_dir)
+        finally:
+            if not isinstance(mail, str):
+                mail.close()
+
+    def getReady(self, now):
+        """Return the oldest entry that may be posted now and the time the
+        next one becomes ready.  Must be called with the condition held.
+        """
+        ready = None
+        next_try = None
+        for entry in self.spool.entries.values():
+            if entry.in_progress:
+                continue
+            if self.active.get(entry.callURL, 0) >= self.per_url:
+                continue
+            if entry.next_try > now:
+                if next_try is None or entry.next_try < next_try:
+                    next_try = entry.next_try
+                continue
+            if ready is None or entry.enqueued < ready.enqueued:
+                ready = entry
+        return ready, next_try
+
+    def take(self, block=True):
+        condition = self.spool.condition
+        condition.acquire()
+        try:
+            while True:
+                # pick up messages spooled by other processes
+                self.spool.refresh()
+                entry, next_try = self.getReady(time.time())
+                if entry is not None:
+                    entry.in_progress = True
+                    self.active[entry.callURL] = \
+                        self.active.get(entry.callURL, 0) + 1
+                    return entry
+                if not block or not self.running:
+                    return None
+                timeout = self.poll_interval
+                if next_try is not None:
+                    timeout = min(max(next_try - time.time(), 0.01), timeout)
+                condition.wait(timeout)
+        finally:
+            condition.release()
+
+    def release(self, entry):
+        condition = self.spool.condition
+        condition.acquire()
+        try:
+            self.active[entry.callURL] -= 1
+            if not self.active[entry.callURL]:
+                del self.active[entry.callURL]
+            entry.in_progress = False
+            condition.notifyAll()
+        finally:
+            condition.release()
+
+    def process(self, entry):
+        try:
+            try:
+                code = self.deliver(entry)
+            except Exception, e:
+                log_error('Unexpected error posting spooled message %s: %s'
+                          % (entry.id, e))
+                code = EXIT_TEMPFAIL
+
+            try:
+                self.finish(entry, code)
+            except Exception, e:
+                # the entry stays in the spool and is tried again later,
+                # the worker goes on with the others
+                log_error('Unexpected error finishing spooled message %s:'
+                          ' %s' % (entry.id, e))
+                entry.next_try = time.time() + self.retry_delay
+        finally:
+            self.release(entry)
+
+        try:
+            self.spool.compactIfLarge()
+        except EnvironmentError, e:
+            log_error('Could not compact spool journal in %s: %s'
+                      % (self.spool.directory, e))
+
+    def finish(self, entry, code):
+        """Remove, retry or fail the entry by the exit code of posting it."""
+        if code == EXIT_OK:
+            self.spool.done(entry)
+        elif code == EXIT_TEMPFAIL and \
+                time.time() - entry.enqueued < self.max_age:
+            delay = min(self.retry_delay * 2 ** entry.attempts,
+                        self.max_retry_delay)
+            self.spool.retry(entry, time.time() + delay)
+        else:
+            log_error('Giving up on spooled message %s for %s (exit code'
+                      ' %s)' % (entry.id, entry.callURL, code))
+            self.spool.fail(entry)
+
+    def drain(self):
+        """Post the messages that are ready now in the calling thread."""
+        while True:
+            entry = self.take(block=False)
+            if entry is None:
+                return
+            self.process(entry)
+
+    def run(self):
+        while self.running:
+            entry = self.take()
+            if entry is not None:
+                self.process(entry)
+
+    def start(self):
+        self.spool.compact()
+        self.running = True
+        for i in range(self.threads):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.workers.append(thread)
+
+    def stop(self):
+        self.spool.condition.acquire()
+        try:
+            self.running = False
+            self.spool.condition.notifyAll()
+        finally:
+            self.spool.condition.release()
+        for thread in self.workers:
+            thread.join()
+        self.workers = []
+
+
+def drain(args):
+    """Entry point of `mailpost drain`."""
+    parser = optparse.OptionParser(usage='%prog drain [options] SPOOL_DIR')
+    parser.add_option('--once', dest='once', action='store_true',
+                      default=False,
+                      help='post the messages that are due and exit')
+    parser.add_option('--threads', dest='threads', type='int', default=4,
+                      help='number of messages posted at once')
+    parser.add_option('--per-url', dest='per_url', type='int', default=2,
+                      help='number of messages posted at once to one URL')
+    parser.add_option('--retry-delay', dest='retry_delay', type='int',
+                      default=60,
+                      help='seconds before the first retry, doubled with'
+                      ' every attempt')
+    parser.add_option('--hash', dest='hash', default='md5',
+                      help='hash attachments with this algorithm, like'
+                      ' sha256 or blake2b (default: md5)')
+    parser.add_option('--store-threads', dest='store_threads', type='int',
+                      default=0,
+                      help='hash and write attachments in this many threads'
+                      ' (default: 0, in the delivering thread)')
+    parser.add_option('--max-attachment-bytes', dest='max_attachments',
+                      type='int', default=0, metavar='BYTES',
+                      help='refuse mails with attachments that decode to'
+                      ' more than this altogether (default: 0, no limit)')
+    parser.add_option('--metrics', dest='metrics', default=None,
+                      metavar='HOST:PORT',
+                      help='serve metrics over HTTP at /metrics on this'
+                      ' address')
+    parser.add_option('--slow-log', dest='slow_log', default=None,
+                      metavar='PATH',
+                      help='append a line of JSON describing every message'
+                      ' that is slow to deliver to this file')
+    parser.add_option('--slow-threshold', dest='slow_threshold',
+                      type='float', default=1.0, metavar='SECONDS',
+                      help='messages taking longer than this to deliver are'
+                      ' slow (default: 1)')
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        log_critical('drain needs the spool directory (%s parameters given)'
+                     % len(args))
+        sys.exit(EXIT_USAGE)
+    try:
+        nous.mailpost.setHashAlgorithm(options.hash)
+    except ValueError, e:
+        log_critical(str(e))
+        sys.exit(EXIT_USAGE)
+    if options.store_threads > 0:
+        nous.mailpost.installStorePool(StorePool(options.store_threads))
+    nous.mailpost.setSizeLimits(max_attachments=options.max_attachments)
+    if options.slow_log:
+        nous.mailpost.installTracer(
+            SlowMessageLog(options.slow_log, options.slow_threshold))
+    metrics_address = None
+    if options.metrics:
+        from nous.mailpost.lmtp import parseListenAddress
+        try:
+            metrics_address = parseListenAddress(options.metrics)
+        except ValueError:
+            log_critical('Metrics address (%s) is invalid' % options.metrics)
+            sys.exit(EXIT_USAGE)
+
+    nous.mailpost.installBrokenRedirectHandler()
+    spool = Spool(args[0])
+    if not spool.lockWorker():
+        log_critical('Spool %s is drained by another process already'
+                     % args[0])
+        sys.exit(EXIT_USAGE)
+    worker = SpoolWorker(spool, threads=options.threads,
+                         per_url=options.per_url,
+                         retry_delay=options.retry_delay)
+    log_info('Draining mailpost spool %s (%s messages)'
+             % (args[0], len(spool.entries)))
+    if options.once:
+        spool.compact()
+        worker.drain()
+        return
+    metrics_server = None
+    if metrics_address is not None:
+        registry = Registry()
+        nous.mailpost.installMetrics(registry)
+        metrics_server = MetricsServer(metrics_address, registry)
+        metrics_server.start()
+    worker.start()
+    try:
+        while True:
+            time.sleep(3600)
+    finally:
+        worker.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
@@ -0,0 +1,192 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Pool of threads hashing and writing attachments.
+
+Storing an attachment is decoding, hashing and writing it, one after
+the other.  With a StorePool installed (see installStorePool), the
+delivering thread only decodes: the decoded data is handed to the pool
+in chunks, so hashing and writing one attachment overlaps with decoding
+the next.  The message is posted once every attachment is stored, and
+the attachments that could not be stored are reported together in a
+StoreError.
+"""
+import sys
+import Queue
+import threading
+import collections
+
+
+class StoreError(Exception):
+    """Some attachments of a message could not be stored.
+
+    errors is a list of (attachment, exception) pairs.
+    """
+
+    def __init__(self, errors):
+        Exception.__init__(self, errors)
+        self.errors = errors
+
+    def __str__(self):
+        return '; '.join(['%s: %s' % (attachment.filename, e)
+                          for attachment, e in self.errors])
+
+
+class StoreJob(object):
+    """A function run by the pool, that can be waited for."""
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        try:
+            self.function(*self.args)
+        except Exception, e:
+            self.error = e
+        self.done.set()
+
+    def wait(self):
+        """Wait for the job to finish, return the error it raised or None."""
+        self.done.wait()
+        return self.error
+
+
+class StorePool(object):
+    """Runs store jobs in a number of threads.
+
+    At most max_chunks chunks written through a PooledWriter wait to be
+    written at any time, writers block until the pool catches up.
+    Attachments smaller than min_size are not worth handing over to
+    another thread, they are stored right away.
+    """
+
+    def __init__(self, threads=4, max_chunks=None, min_size=65536):
+        if max_chunks is None:
+            max_chunks = threads * 4
+        self.min_size = min_size
+        self.jobs = Queue.Queue()
+        self.slots = threading.Semaphore(max_chunks)
+        self.threads = []
+        for i in range(threads):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            job.run()
+
+    def submit(self, function, *args):
+        """Run function(*args) in the pool, return a StoreJob."""
+        job = StoreJob(function, args)
+        self.jobs.put(job)
+        return job
+
+    def close(self):
+        """Stop the threads once the jobs submitted are done."""
+        for thread in self.threads:
+            self.jobs.put(None)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+
+class PooledWriter(object):
+    """Writes to a file from the threads of a StorePool.
+
+    Data written is collected into chunks of chunk_size bytes, which the
+    pool writes to output in order.  Errors writing are raised by
+    wait(), once the chunks written before are done.
+    """
+
+    def __init__(self, pool, output, chunk_size=262144):
+        self.pool = pool
+        self.output = output
+        self.chunk_size = chunk_size
+        self.buffer = []
+        self.buffered = 0
+        self.chunks = collections.deque()
+        self.lock = threading.Lock()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.error = None
+        self.flushed = False
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        chunk = ''.join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.flushed = True
+        self.pool.slots.acquire()
+        self.lock.acquire()
+        try:
+            self.chunks.append(chunk)
+            if not self.idle.isSet():
+                # the job writing the chunks before takes this one too
+                return
+            self.idle.clear()
+        finally:
+            self.lock.release()
+        self.pool.submit(self.writeChunks)
+
+    def writeChunks(self):
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.chunks:
+                    self.idle.set()
+                    return
+                chunk = self.chunks.popleft()
+            finally:
+                self.lock.release()
+            try:
+                if self.error is None:
+                    self.output.write(chunk)
+            except Exception:
+                self.error = sys.exc_info()[1]
+            self.pool.slots.release()
+
+    def close(self):
+        if not self.flushed and self.buffered < self.pool.min_size:
+            # small enough to write right away
+            data = ''.join(self.buffer)
+            self.buffer = []
+            self.buffered = 0
+            try:
+                self.output.write(data)
+            except Exception:
+                self.error = sys.exc_info()[1]
+            return
+        self.flush()
+
+    def wait(self):
+        """Wait for the chunks to be written, raise the error if any."""
+        self.flush()
+        self.idle.wait()
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,167 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from zope.testing import doctest
+
+import nous.mailpost
+
+
+def doctest_measure():
+    r"""Tests for the pipeline benchmark.
+
+        >>> from nous.mailpost.benchmarks import corpus, pipeline
+        >>> path = os.path.join(tmpdir, 'nested')
+        >>> open(path, 'w').write(corpus.generate('nested', scale=0.01))
+
+        >>> result = pipeline.measure('processAttachments', path,
+        ...                           'http://localhost/', repeat=3)
+        >>> sorted(result)
+        ['max', 'mean', 'median', 'min', 'parses', 'repeat',
+         'rss_baseline_kb', 'rss_growth_kb', 'rss_peak_kb']
+        >>> result['min'] <= result['median'] <= result['max']
+        True
+
+    The mail is parsed once, even though it has attachments:
+
+        >>> result['parses']
+        1.0
+
+    """
+
+
+def doctest_storeBenchmark():
+    r"""Tests for the layout benchmark.
+
+        >>> from nous.mailpost.benchmarks import layout
+        >>> result = layout.storeBenchmark((2, 2), 20, 64, seed=0)
+        >>> result['files'], result['inodes'] <= 20 * 3
+        (20, True)
+        >>> result['write_median'] <= result['write_max']
+        True
+
+        >>> result = layout.migrateBenchmark((2,), 20, 64, seed=0)
+        >>> result['moved'], result['inodes'] <= 20 * 2
+        (20, True)
+
+    """
+
+
+def doctest_StubServer():
+    r"""Tests for the faults of the stub server.
+
+        >>> import httplib
+        >>> from nous.mailpost.benchmarks.stubserver import StubServer
+        >>> server = StubServer(latency=0.01, faults=[(404, 0.3), (302, 0.3)],
+        ...                     seed=0)
+        >>> server.start()
+        >>> def post():
+        ...     connection = httplib.HTTPConnection(
+        ...         '127.0.0.1', server.server_address[1])
+        ...     connection.request('POST', '/got_mail', 'Mail=x')
+        ...     response = connection.getresponse()
+        ...     response.read()
+        ...     connection.close()
+        ...     return response
+        >>> responses = [post() for i in range(20)]
+        >>> server.stop()
+
+    The share of posts picked for a fault get its status:
+
+        >>> sorted(set([response.status for response in responses]))
+        [200, 302, 404]
+        >>> sum(server.statuses.values()) == server.requests == 20
+        True
+
+    Redirects lead back to the server:
+
+        >>> [response.getheader('Location') for response in responses
+        ...  if response.status == 302][0] == server.url
+        True
+
+    """
+
+
+def doctest_replay():
+    r"""Tests for replaying a corpus.
+
+        >>> import mailbox
+        >>> from nous.mailpost.benchmarks import corpus, replay
+        >>> maildir = mailbox.Maildir(os.path.join(tmpdir, 'maildir'))
+        >>> for case in ('plain', 'many_small', 'nested'):
+        ...     key = maildir.add(corpus.generate(case, scale=0.001))
+        >>> mbox = mailbox.mbox(os.path.join(tmpdir, 'mbox'))
+        >>> key = mbox.add(corpus.generate('plain', scale=0.001))
+        >>> mbox.flush()
+
+    Mails are read from Maildirs, mboxes and plain directories:
+
+        >>> len(list(replay.iterMails(os.path.join(tmpdir, 'maildir'))))
+        3
+        >>> [mail] = replay.iterMails(os.path.join(tmpdir, 'mbox'))
+        >>> mail.startswith('From ')
+        False
+        >>> os.mkdir(os.path.join(tmpdir, 'files'))
+        >>> open(os.path.join(tmpdir, 'files', '1'), 'w').write(mail)
+        >>> list(replay.iterMails(os.path.join(tmpdir, 'files'))) == [mail]
+        True
+
+    They are delivered to a server, and the exit codes mailpost would
+    have exited with are counted:
+
+        >>> from nous.mailpost.benchmarks.stubserver import StubServer
+        >>> server = StubServer(faults=[(500, 1.0)])
+        >>> server.start()
+        >>> upload_dir = os.path.join(tmpdir, 'upload')
+        >>> os.mkdir(upload_dir)
+        >>> run = replay.Replay(server.url + 'got_mail', upload_dir,
+        ...                     concurrency=2, rate=100)
+        >>> elapsed = run.run(replay.iterMails(
+        ...     os.path.join(tmpdir, 'maildir')))
+        >>> server.stop()
+        >>> result = run.report(elapsed)
+        >>> result['messages'], result['exit_codes']
+        (3, {'75': 3})
+        >>> elapsed >= 0.02
+        True
+        >>> (result['latency_p50'] <= result['latency_p90']
+        ...  <= result['latency_max'])
+        True
+
+    The command starts a stub server of its own:
+
+        >>> replay.main(['--limit=2', '--fault=404:1',
+        ...              os.path.join(tmpdir, 'maildir')])
+        {..."exit_codes": {"67": 2}, ..."messages": 2, ...
+         "server_statuses": {"404": 2}, ...}
+
+    """
+
+
+def setUp(test):
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+    test.globs['saved_log_error'] = nous.mailpost.log_error
+    nous.mailpost.log_error = lambda msg: None
+
+
+def tearDown(test):
+    nous.mailpost.log_error = test.globs['saved_log_error']
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            doctest.DocTestSuite('nous.mailpost.benchmarks.corpus'),
+            doctest.DocTestSuite('nous.mailpost.benchmarks.stats'),
+            doctest.DocTestSuite('nous.mailpost.benchmarks.stubserver',
+                                 optionflags=doctest.ELLIPSIS),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,156 @@
+import threading
+import unittest
+import BaseHTTPServer
+from StringIO import StringIO
+
+from zope.testing import doctest
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answers POSTs with the status code named by the path."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.server.connections.add(self.client_address)
+        if self.headers.get('Transfer-Encoding') == 'chunked':
+            self.server.posted.append(self.readChunked())
+        else:
+            self.server.posted.append(
+                self.rfile.read(int(self.headers['Content-Length'])))
+        code = int(self.path.strip('/') or 200)
+        body = 'ok'
+        self.send_response(code)
+        if code == 302:
+            self.send_header('Location', 'http://localhost/login')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def readChunked(self):
+        chunks = []
+        while True:
+            size = int(self.rfile.readline().strip(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if not size:
+                return ''.join(chunks)
+
+    def log_message(self, *args):
+        pass
+
+
+def doctest_ConnectionPool():
+    r"""Tests for ConnectionPool.
+
+        >>> from nous.mailpost.httppool import ConnectionPool
+        >>> pool = ConnectionPool(maxsize=2, idle_timeout=30)
+        >>> url = 'http://127.0.0.1:%d/' % port
+
+    Successive posts to the same host reuse one connection:
+
+        >>> pool.request(url, 'Mail=first', {})
+        (200, 'ok')
+        >>> pool.request(url + '202', 'Mail=second', {})
+        (202, 'ok')
+        >>> server.posted
+        ['Mail=first', 'Mail=second']
+        >>> len(server.connections)
+        1
+
+    Redirects are not followed, they fail like other error responses:
+
+        >>> pool.request(url + '302', 'Mail=third', {})
+        Traceback (most recent call last):
+          ...
+        HTTPError: HTTP Error 302: Found
+        >>> try:
+        ...     pool.request(url + '404', 'Mail=fourth', {})
+        ... except Exception, e:
+        ...     print e.code
+        404
+
+    Connections idle for too long are not reused:
+
+        >>> pool.idle_timeout = -1
+        >>> pool.request(url, 'Mail=fifth', {})
+        (200, 'ok')
+        >>> len(server.connections)
+        2
+
+    Bodies that are read like files are streamed in chunks:
+
+        >>> from nous.mailpost.formdata import MultipartBody
+        >>> body = MultipartBody([('Mail', StringIO('Hello'))], boundary='xyz')
+        >>> pool.request(url, body, {'Content-Type': body.content_type})
+        (200, 'ok')
+        >>> print server.posted[-1].replace('\r\n', '\n')
+        --xyz
+        Content-Disposition: form-data; name="Mail"
+        <BLANKLINE>
+        Hello
+        --xyz--
+        <BLANKLINE>
+
+        >>> pool.closeAll()
+
+    """
+
+
+def doctest_postForm_pool():
+    r"""Tests for postForm posting through the connection pool.
+
+        >>> import nous.mailpost
+        >>> from nous.mailpost.httppool import ConnectionPool
+        >>> from nous.mailpost.metrics import Registry
+        >>> registry = Registry()
+        >>> nous.mailpost.installMetrics(registry)
+        >>> nous.mailpost.installConnectionPool(ConnectionPool())
+        >>> url = 'http://127.0.0.1:%d/' % port
+
+    The status of the response is recorded as it was answered:
+
+        >>> nous.mailpost.postForm(url + '202', [('Mail', 'x')], '').read()
+        'ok'
+        >>> registry.get('post_seconds', status=202)
+        1
+        >>> registry.get('post_seconds', status=200)
+        0
+
+        >>> nous.mailpost.connection_pool.closeAll()
+        >>> nous.mailpost.installConnectionPool(None)
+        >>> nous.mailpost.installMetrics(None)
+
+    """
+
+
+def setUp(test):
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+    server.posted = []
+    server.connections = set()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    test.globs['server'] = server
+    test.globs['port'] = server.server_address[1]
+
+
+def tearDown(test):
+    test.globs['server'].shutdown()
+    test.globs['server'].server_close()
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS),
+            doctest.DocTestSuite('nous.mailpost.httppool',
+                                 optionflags=doctest.ELLIPSIS),
+            doctest.DocTestSuite('nous.mailpost.formdata',
+                                 optionflags=doctest.ELLIPSIS),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,129 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from zope.testing import doctest
+
+import nous.mailpost
+
+
+def doctest_AttachmentIndex():
+    r"""Tests for the attachment index.
+
+        >>> from nous.mailpost import Attachment, storeAttacment
+        >>> from nous.mailpost.index import AttachmentIndex
+        >>> def store(body):
+        ...     attachment = Attachment('a.txt', 'text', 'plain', body)
+        ...     storeAttacment(attachment, tmpdir)
+        ...     return attachment.digest
+        >>> first = store('first')
+        >>> second = store('second')
+        >>> second == store('second')
+        True
+
+    Storing only appends to the log, reading the index folds it into the
+    database:
+
+        >>> index = AttachmentIndex(tmpdir)
+        >>> len(open(index.log_path).readlines())
+        3
+        >>> index.refresh()
+        >>> os.path.getsize(index.log_path)
+        0
+        >>> first in index, 'f' * 32 in index
+        (True, False)
+        >>> sorted([(entry.size, entry.refcount, entry.digest == first)
+        ...         for entry in index.entries()])
+        [(5, 1, True), (6, 2, False)]
+
+    Attachments are collected when all their references are released,
+    and they were not seen for a while:
+
+        >>> index.release(second)
+        >>> index.collect(min_age=0)
+        []
+        >>> index.release(second)
+        >>> index.collect(min_age=3600)
+        []
+        >>> [entry.digest == second for entry in index.collect(min_age=0)]
+        [True]
+        >>> os.path.exists(nous.mailpost.getAttachmentPath(second, tmpdir))
+        False
+        >>> [entry.digest == first for entry in index.entries()]
+        [True]
+
+    The empty directories of the attachment are removed too:
+
+        >>> sorted(os.listdir(tmpdir)) == sorted(
+        ...     ['.index.log', '.index.sqlite', first[:8]])
+        True
+
+    Attachments stored without the index are picked up by a scan:
+
+        >>> nous.mailpost.setAttachmentIndex(False)
+        >>> third = store('third')
+        >>> nous.mailpost.setAttachmentIndex(True)
+        >>> third in index
+        False
+        >>> index.scan()
+        1
+        >>> index.get(third).size
+        5
+
+    Delivering processes fold the log once it grows too big, so it does
+    not grow without bound when the index is never read:
+
+        >>> AttachmentIndex.max_log_size = 100
+        >>> digests = [store('body %d' % i) for i in range(5)]
+        >>> os.path.getsize(index.log_path) < 100
+        True
+        >>> index.get(digests[0]).refcount
+        1
+
+    Collecting waits for deliveries that are storing attachments, which
+    keep the log locked until the reference is recorded:
+
+        >>> import threading, time
+        >>> delivery = AttachmentIndex(tmpdir)
+        >>> delivery.lockShared()
+        >>> def collect():
+        ...     gc = AttachmentIndex(tmpdir)
+        ...     gc.collect(min_age=0)
+        ...     gc.close()
+        >>> collecting = threading.Thread(target=collect)
+        >>> collecting.start()
+        >>> time.sleep(0.1)
+        >>> collecting.isAlive()
+        True
+        >>> delivery.unlock()
+        >>> collecting.join()
+
+        >>> index.close()
+
+    """
+
+
+def setUp(test):
+    from nous.mailpost.index import AttachmentIndex
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+    test.globs['saved_max_log_size'] = AttachmentIndex.max_log_size
+
+
+def tearDown(test):
+    from nous.mailpost.index import AttachmentIndex
+    AttachmentIndex.max_log_size = test.globs['saved_max_log_size']
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,95 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from zope.testing import doctest
+
+import nous.mailpost
+
+
+def doctest_migrateAttachments():
+    r"""Tests for changing the layout of an upload directory.
+
+        >>> from nous.mailpost import Attachment, storeAttacment, getAttachmentPath
+        >>> from nous.mailpost.layout import migrateAttachments
+        >>> from nous.mailpost.index import AttachmentIndex
+        >>> def store(body):
+        ...     attachment = Attachment('a.txt', 'text', 'plain', body)
+        ...     storeAttacment(attachment, tmpdir)
+        ...     return attachment.digest
+        >>> def tree():
+        ...     for dirpath, dirnames, filenames in sorted(os.walk(tmpdir)):
+        ...         for filename in filenames:
+        ...             if not filename.startswith('.'):
+        ...                 print os.path.join(dirpath, filename)[len(tmpdir):]
+
+    Upload directories start out in the legacy layout:
+
+        >>> first = store('first')
+        >>> second = store('second')
+        >>> tree()
+        /8b04d5e3/775d298e/78455efc/5ca404d5
+        /a9f0e61a/137d86aa/9db53465/e0801612
+
+    Migrating moves the stored attachments and makes new ones go to the
+    new layout too:
+
+        >>> migrateAttachments(tmpdir, (2, 2))
+        (2, 0)
+        >>> open(os.path.join(tmpdir, '.layout')).read()
+        '2/2\n'
+        >>> third = store('third')
+        >>> tree()
+        /8b/04/8b04d5e3775d298e78455efc5ca404d5
+        /a9/f0/a9f0e61a137d86aa9db53465e0801612
+        /dd/5c/dd5c8bf51558ffcbe5007071908e9524
+        >>> open(getAttachmentPath(first, tmpdir)).read()
+        'first'
+
+    Attachments stored again in the new layout before they were moved
+    are dropped from the old one, and the index still finds them all:
+
+        >>> old = getAttachmentPath(first, tmpdir, 'legacy')
+        >>> os.makedirs(os.path.dirname(old))
+        >>> open(old, 'w').write('first')
+        >>> migrateAttachments(tmpdir, (2, 2))
+        (0, 1)
+        >>> index = AttachmentIndex(tmpdir)
+        >>> [entry.digest for entry in index.collect(min_age=0, dry_run=True)]
+        []
+        >>> len(list(index.entries()))
+        3
+        >>> index.close()
+
+    And back:
+
+        >>> migrateAttachments(tmpdir, 'legacy')
+        (3, 0)
+        >>> tree()
+        /8b04d5e3/775d298e/78455efc/5ca404d5
+        /a9f0e61a/137d86aa/9db53465/e0801612
+        /dd5c8bf5/1558ffcb/e5007071/908e9524
+
+    """
+
+
+def setUp(test):
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+
+
+def tearDown(test):
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
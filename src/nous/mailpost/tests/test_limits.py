@@ -0,0 +1,131 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from zope.testing import doctest
+
+import nous.mailpost
+from nous.mailpost.tests.test_mailpost import attachmentMail
+
+
+def doctest_setSizeLimits():
+    r"""Tests for refusing mails that are too big.
+
+        >>> from nous.mailpost import processAttachments, deliverEmail
+        >>> from nous.mailpost import setSizeLimits, limitInput, mapMail
+        >>> from nous.mailpost.limits import SizeLimitExceeded
+        >>> len(attachmentMail)
+        536
+
+    Mails bigger than the limit are refused before they are parsed,
+    whether they are given as a string, a memory map or a file:
+
+        >>> setSizeLimits(max_size=500)
+        >>> processAttachments(attachmentMail, tmpdir)
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: mail size limit of 500 bytes exceeded
+        >>> path = os.path.join(tmpdir, 'mail')
+        >>> open(path, 'w').write(attachmentMail)
+        >>> processAttachments(mapMail(open(path)), tmpdir)
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: mail size limit of 500 bytes exceeded
+        >>> processAttachments(StringIO(attachmentMail), tmpdir)
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: mail size limit of 500 bytes exceeded
+
+    Files are read no further than one byte past the limit:
+
+        >>> mail = StringIO(attachmentMail)
+        >>> limitInput(mail).read()
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: mail size limit of 500 bytes exceeded
+        >>> mail.tell()
+        501
+
+    The MTA is told not to try again:
+
+        >>> deliverEmail('http://localhost/got_mail', attachmentMail,
+        ...              tmpdir) == nous.mailpost.EXIT_NOPERM
+        True
+
+    Nothing was stored:
+
+        >>> os.listdir(tmpdir)
+        ['mail']
+
+    The attachments are limited on their own, by the size of their
+    decoded bodies taken together:
+
+        >>> setSizeLimits(max_attachments=300)
+        >>> processAttachments(attachmentMail, tmpdir)
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: attachment size limit of 300 bytes exceeded
+        >>> processAttachments(StringIO(attachmentMail), tmpdir)
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: attachment size limit of 300 bytes exceeded
+        >>> os.listdir(tmpdir)
+        ['mail']
+
+        >>> setSizeLimits(max_size=536, max_attachments=307)
+        >>> len(processAttachments(attachmentMail, tmpdir)[1])
+        1
+
+    """
+
+
+def doctest_Spool_enqueue_limit():
+    r"""Mails refused while they are spooled are not left in the spool.
+
+        >>> from nous.mailpost import setSizeLimits, limitInput
+        >>> from nous.mailpost.spool import Spool
+        >>> spool = Spool(tmpdir)
+        >>> setSizeLimits(max_size=100)
+        >>> spool.enqueue('http://localhost/got_mail',
+        ...               limitInput(StringIO(attachmentMail)), '/upload')
+        Traceback (most recent call last):
+        ...
+        SizeLimitExceeded: mail size limit of 100 bytes exceeded
+        >>> spool.entries
+        {}
+        >>> [filenames for dirpath, dirnames, filenames
+        ...  in os.walk(os.path.join(tmpdir, 'queue')) if filenames]
+        []
+        >>> spool.close()
+
+    """
+
+
+def setUp(test):
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+    test.globs['saved_log_error'] = nous.mailpost.log_error
+    nous.mailpost.log_error = lambda msg: None
+
+
+def tearDown(test):
+    nous.mailpost.setSizeLimits()
+    nous.mailpost.log_error = test.globs['saved_log_error']
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            doctest.DocTestSuite('nous.mailpost.limits',
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
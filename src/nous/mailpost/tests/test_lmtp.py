@@ -0,0 +1,201 @@
+import os
+import shutil
+import smtplib
+import tempfile
+import threading
+import unittest
+import mox
+from textwrap import dedent
+
+from zope.testing import doctest
+
+
+mailString = dedent('''\
+From: bob@example.com
+To: announce@example.com
+Subject: Hi
+
+Hello
+.leading dot
+''')
+
+
+def doctest_LMTPServer():
+    r"""Tests for the LMTP listener.
+
+        >>> import nous.mailpost
+        >>> from nous.mailpost.lmtp import makeServer
+        >>> socket_path = os.path.join(tmpdir, 'lmtp.sock')
+        >>> server = makeServer('http://localhost/lists/$local/got_mail',
+        ...                     tmpdir, socket_path=socket_path)
+        >>> thread = threading.Thread(target=server.serve_forever)
+        >>> thread.start()
+
+    Every recipient is delivered separately and the exit codes are
+    reported back as per-recipient replies:
+
+        >>> mox.StubOutWithMock(nous.mailpost, 'deliverEmail')
+        >>> mm = nous.mailpost.deliverEmail(
+        ...     'http://localhost/lists/announce/got_mail',
+        ...     mailString, tmpdir).AndReturn(nous.mailpost.EXIT_OK)
+        >>> mm = nous.mailpost.deliverEmail(
+        ...     'http://localhost/lists/missing/got_mail',
+        ...     mailString, tmpdir).AndReturn(nous.mailpost.EXIT_NOUSER)
+        >>> mox.ReplayAll()
+
+        >>> client = smtplib.LMTP(socket_path)
+        >>> client.ehlo('test')[0]
+        250
+        >>> client.mail('bob@example.com')
+        (250, '2.1.0 Ok')
+        >>> client.rcpt('announce@example.com')
+        (250, '2.1.5 Ok')
+        >>> client.rcpt('Missing@example.com')
+        (250, '2.1.5 Ok')
+        >>> client.data(mailString)
+        (250, '2.0.0 Ok')
+        >>> client.getreply()
+        (550, '5.1.1 No such mailbox')
+        >>> client.quit()
+        (221, '2.0.0 Bye')
+
+        >>> mox.VerifyAll()
+
+        >>> server.shutdown()
+        >>> thread.join()
+        >>> server.server_close()
+
+    """
+
+
+def doctest_LMTPServer_engine():
+    r"""Tests for delivering through the delivery engine.
+
+        >>> import nous.mailpost
+        >>> from nous.mailpost.lmtp import makeServer
+        >>> from nous.mailpost.engine import DeliveryEngine
+        >>> engine = DeliveryEngine(max_in_flight=2, per_host=2)
+        >>> socket_path = os.path.join(tmpdir, 'lmtp.sock')
+        >>> server = makeServer('http://localhost/lists/$local/got_mail',
+        ...                     tmpdir, socket_path=socket_path,
+        ...                     engine=engine)
+        >>> thread = threading.Thread(target=server.serve_forever)
+        >>> thread.start()
+
+    The recipients are posted to at the same time, the first one is
+    answered only once the second one was posted as well:
+
+        >>> second_posted = threading.Event()
+        >>> def postEmail(callURL, mailString, authorization, attachments):
+        ...     if 'first' in callURL:
+        ...         second_posted.wait()
+        ...         raise IOError('Connection refused')
+        ...     second_posted.set()
+        >>> mox.stubs.Set(nous.mailpost, 'postEmail', postEmail)
+        >>> mox.stubs.Set(nous.mailpost, 'log_error', lambda msg: None)
+
+        >>> client = smtplib.LMTP(socket_path)
+        >>> client.ehlo('test')[0]
+        250
+        >>> client.mail('bob@example.com')
+        (250, '2.1.0 Ok')
+        >>> client.rcpt('first@example.com')
+        (250, '2.1.5 Ok')
+        >>> client.rcpt('second@example.com')
+        (250, '2.1.5 Ok')
+        >>> client.data(mailString)
+        (451, '4.3.0 Temporary failure, try again later')
+        >>> client.getreply()
+        (250, '2.0.0 Ok')
+        >>> client.quit()
+        (221, '2.0.0 Bye')
+
+        >>> server.shutdown()
+        >>> thread.join()
+        >>> server.server_close()
+        >>> engine.close()
+
+    """
+
+
+def doctest_LMTPServer_max_size():
+    r"""Tests for refusing messages that are too big.
+
+        >>> import nous.mailpost
+        >>> from nous.mailpost.lmtp import makeServer
+        >>> socket_path = os.path.join(tmpdir, 'lmtp.sock')
+        >>> server = makeServer('http://localhost/got_mail', tmpdir,
+        ...                     socket_path=socket_path, max_size=60)
+        >>> thread = threading.Thread(target=server.serve_forever)
+        >>> thread.start()
+        >>> mox.StubOutWithMock(nous.mailpost, 'deliverEmail')
+        >>> mox.StubOutWithMock(nous.mailpost.lmtp, 'log_error')
+        >>> mm = nous.mailpost.lmtp.log_error(mox_module.IsA(str))
+        >>> mox.ReplayAll()
+
+    The limit is announced, so the client can refuse the message itself:
+
+        >>> client = smtplib.LMTP(socket_path)
+        >>> client.ehlo('test')[0]
+        250
+        >>> client.esmtp_features['size']
+        '60'
+
+    Messages declared too big are refused right away:
+
+        >>> client.mail('bob@example.com', ['SIZE=1000'])
+        (552, '5.3.4 Message size exceeds fixed maximum message size')
+
+    Messages turning out too big are read to the end but not kept, and
+    refused for every recipient without being delivered:
+
+        >>> client.mail('bob@example.com')
+        (250, '2.1.0 Ok')
+        >>> client.rcpt('announce@example.com')
+        (250, '2.1.5 Ok')
+        >>> client.rcpt('other@example.com')
+        (250, '2.1.5 Ok')
+        >>> client.data(mailString + 'x' * 100000 + '\n.x\n')
+        (552, '5.3.4 Message size exceeds fixed maximum message size')
+        >>> client.getreply()
+        (552, '5.3.4 Message size exceeds fixed maximum message size')
+
+    The connection can go on:
+
+        >>> client.noop()
+        (250, '2.0.0 Ok')
+        >>> client.quit()
+        (221, '2.0.0 Bye')
+
+        >>> mox.VerifyAll()
+
+        >>> server.shutdown()
+        >>> thread.join()
+        >>> server.server_close()
+
+    """
+
+
+def setUp(test):
+    test.globs['mox'] = mox.Mox()
+    test.globs['mox_module'] = mox
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+
+
+def tearDown(test):
+    test.globs['mox'].UnsetStubs()
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS),
+            doctest.DocTestSuite('nous.mailpost.lmtp',
+                                 optionflags=doctest.ELLIPSIS),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,279 @@
+import base64
+import unittest
+from StringIO import StringIO
+from textwrap import dedent
+
+from zope.testing import doctest
+
+
+multipartMail = dedent('''\
+From: bob@example.com
+To: announce@example.com
+Subject: Report
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+This is a multi-part message in MIME format.
+--outer
+Content-Type: multipart/alternative; boundary="inner"
+
+--inner
+Content-Type: text/plain; charset=utf-8
+
+See the attached report.
+
+--inner
+Content-Type: text/html; charset=utf-8
+
+<p>See the attached report.</p>
+
+--inner--
+
+--outer
+Content-Type: application/octet-stream; name="report.bin"
+Content-Transfer-Encoding: base64
+
+AAECAwQFBgcICQ==
+
+--outer--
+''')
+
+
+plainMail = dedent('''\
+From: bob@example.com
+Subject: Hi
+
+Hello
+''')
+
+
+class FileWriter(StringIO):
+    """A StringIO that keeps its value after it is closed."""
+
+    def close(self):
+        self.value = self.getvalue()
+        StringIO.close(self)
+
+
+def doctest_unpackMailStream():
+    r"""Tests for unpackMailStream.
+
+        >>> from nous.mailpost.mailboxer_tools import unpackMail
+        >>> from nous.mailpost.mailboxer_tools import unpackMailStream
+
+    Attachment bodies are written to the files returned by the
+    openAttachment callback instead of being kept in the attachment
+    dicts:
+
+        >>> written = []
+        >>> def openAttachment(attachment):
+        ...     f = FileWriter()
+        ...     written.append(f)
+        ...     return f
+
+        >>> text, content_type, html, attachments, mail = unpackMailStream(
+        ...     StringIO(multipartMail), openAttachment)
+        >>> text
+        'See the attached report.\n\n'
+        >>> content_type
+        'text/plain; charset=utf-8'
+        >>> html
+        '<p>See the attached report.</p>\n\n'
+        >>> for attachment in attachments:
+        ...     print attachment
+        <Attachment 'text.html' text/html>
+        <Attachment 'report.bin' application/octet-stream>
+        >>> [f.value for f in written]
+        ['<p>See the attached report.</p>\n\n', '\x00\x01\x02\x03\x04\x05\x06\x07\x08\t']
+
+    The results match the ones of unpackMail:
+
+        >>> expected = unpackMail(multipartMail)
+        >>> expected[:3] == (text, content_type, html)
+        True
+        >>> [a.body for a in expected[3]] == [f.value for f in written]
+        True
+        >>> [(a.filename, a.mime_type) for a in expected[3]] == \
+        ...     [(a.filename, a.mime_type) for a in attachments]
+        True
+
+    As there are attachments, the mail to post is made of the headers
+    and the first part only:
+
+        >>> print mail
+        From: bob@example.com
+        To: announce@example.com
+        Subject: Report
+        MIME-Version: 1.0
+        Content-Type: multipart/mixed; boundary="outer"
+        <BLANKLINE>
+        This is a multi-part message in MIME format.
+        --outer
+        Content-Type: multipart/alternative; boundary="inner"
+        <BLANKLINE>
+        --inner
+        Content-Type: text/plain; charset=utf-8
+        <BLANKLINE>
+        See the attached report.
+        <BLANKLINE>
+        --inner
+        Content-Type: text/html; charset=utf-8
+        <BLANKLINE>
+        <p>See the attached report.</p>
+        <BLANKLINE>
+        --inner--
+        <BLANKLINE>
+        --outer--
+        <BLANKLINE>
+
+    Mails without attachments are passed through unchanged:
+
+        >>> text, content_type, html, attachments, mail = unpackMailStream(
+        ...     StringIO(plainMail), openAttachment)
+        >>> text, attachments
+        ('Hello\n', [])
+        >>> mail == plainMail
+        True
+
+    """
+
+
+oddMails = [
+    # base64 lines of odd widths, padding inside and junk, with CRLF
+    'Content-Type: multipart/mixed; boundary=b\r\n\r\n--b\r\n'
+    'Content-Type: application/octet-stream; name=a\r\n'
+    'Content-Transfer-Encoding: base64\r\n\r\n'
+    'SGVsbG8=\r\nSGk=\r\nAAECAwQFBgcICQoLDA0ODxAREhM=\r\nU*FRY\r\n'
+    '--b--\r\n',
+    # quoted-printable with soft line breaks, lines that look like
+    # boundaries but are not, and a boundary with trailing blanks
+    'Content-Type: multipart/mixed; boundary=b\n\n--b\n'
+    'Content-Type: text/plain; name=q\n'
+    'Content-Transfer-Encoding: quoted-printable\n\n'
+    'caf=C3=A9 and a very long =\nline\n-- \n--b-not\n--bb\n--b  \n'
+    'Content-Type: text/x-unknown; name=u\n'
+    'Content-Transfer-Encoding: x-foo\n\n'
+    '--\nliteral\n--b--',
+    # uuencoded, 8bit, and a body running into the end of the mail
+    'Content-Type: multipart/mixed; boundary=b\n\n--b\n'
+    'Content-Type: text/plain; name=x\n'
+    'Content-Transfer-Encoding: x-uuencode\n\n'
+    'begin 644 x\n#86)C\n`\nend\n--b\n'
+    'Content-Type: text/plain; name=y\n'
+    'Content-Transfer-Encoding: 8bit\n\n'
+    '\xe9t\xe9\n',
+    # the outer boundary inside an inner multipart
+    'Content-Type: multipart/mixed; boundary=outer\n\n--outer\n'
+    'Content-Type: multipart/mixed; boundary=inner\n\n--inner\n'
+    'Content-Type: image/png; name=i\n'
+    'Content-Transfer-Encoding: base64\n\nAAEC\n--outer--\n',
+    # not a multipart at all
+    'Subject: Hi\nContent-Type: text/plain\n'
+    'Content-Transfer-Encoding: base64\n\nSGVsbG8g\nd29ybGQ=\n',
+    ]
+
+
+def doctest_decodePart():
+    r"""Tests for decoding bodies in bulk.
+
+        >>> import multifile
+        >>> from nous.mailpost import MailBoxerTools
+        >>> from nous.mailpost.mailboxer_tools import unpackMultifile
+        >>> from nous.mailpost.mailboxer_tools import ParsedMail, parseMail
+        >>> from nous.mailpost.benchmarks import corpus
+
+    Bodies are decoded in bulk from the mail if it is given as a string,
+    and line by line through multifile.MultiFile otherwise.  Both give
+    the same results on the corpus and on odd mails, even when the bodies
+    are cut into small blocks:
+
+        >>> def unpackMultifileBoth(mail):
+        ...     results = []
+        ...     for data in mail, None:
+        ...         try:
+        ...             results.append(unpackMultifile(
+        ...                 multifile.MultiFile(StringIO(mail)), data=data))
+        ...         except Exception, e:
+        ...             results.append(repr(e))
+        ...     return results
+        >>> def parseMailBoth(mail):
+        ...     results = []
+        ...     for parse in parseMail, lambda mail: ParsedMail(StringIO(mail)):
+        ...         try:
+        ...             parsed = parse(mail)
+        ...             results.append(parsed.unpack() +
+        ...                            (parsed.mailString(),))
+        ...         except Exception, e:
+        ...             results.append(repr(e))
+        ...     return results
+        >>> def parseMailBoxerBoth(mail, keepBodies=True):
+        ...     results = []
+        ...     for data in mail, None:
+        ...         try:
+        ...             mf = multifile.MultiFile(StringIO(mail))
+        ...             msg = mimetools.Message(mf)
+        ...             results.append(MailBoxerTools.unpackMultifile(
+        ...                 mf, msg=msg, data=data, keepBodies=keepBodies))
+        ...         except Exception, e:
+        ...             results.append(repr(e))
+        ...     return results
+        >>> def skipBodiesBoth(mail):
+        ...     return parseMailBoxerBoth(mail, keepBodies=False)
+
+        >>> import mimetools
+        >>> mails = [corpus.generate(case, scale=0.01)
+        ...          for case in corpus.CASES] + oddMails
+        >>> mails.append(base64.encodestring('x' * 1000).join(
+        ...     multipartMail.split('AAECAwQFBgcICQ==\n')))
+        >>> MailBoxerTools.DECODE_BLOCK_SIZE = 64
+        >>> for mail in mails:
+        ...     for both in (unpackMultifileBoth, parseMailBoth,
+        ...                  parseMailBoxerBoth, skipBodiesBoth):
+        ...         fast, slow = both(mail)
+        ...         if fast != slow:
+        ...             print both.__name__, repr(mail[:60])
+        ...             print '  fast:', repr(fast)[:300]
+        ...             print '  slow:', repr(slow)[:300]
+        >>> MailBoxerTools.DECODE_BLOCK_SIZE = 1 << 20
+
+    Some of the odd mails are refused, the same way either way:
+
+        >>> for mail in oddMails:
+        ...     result = unpackMultifileBoth(mail)[0]
+        ...     if isinstance(result, str):
+        ...         print result
+        ...     else:
+        ...         print repr(result[0]), [a.filename for a in result[3]]
+        '' ['a']
+        '' ['q', 'u']
+        Error('sudden EOF in MultiFile.readline()',)
+        Error('Missing endmarker in MultiFile.readline()',)
+        'Hello world' []
+
+    Lines that only look like boundaries are part of the body:
+
+        >>> unpackMultifileBoth(oddMails[1])[0][3][0].body
+        'caf\xc3\xa9 and a very long line\n-- \n--b-not\n--bb\n'
+
+    smtp2zope only counts the attachments, their bodies are skipped
+    without being decoded:
+
+        >>> for attachment in MailBoxerTools.parseMailString(
+        ...         oddMails[1], keepBodies=False)[4]:
+        ...     print attachment, attachment.body
+        <Attachment 'q' text/plain> None
+        <Attachment 'u' text/x-unknown> None
+
+    """
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(optionflags=doctest.ELLIPSIS),
+            doctest.DocTestSuite('nous.mailpost.mailboxer_tools'),
+            doctest.DocTestSuite('nous.mailpost.MailBoxerTools'),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
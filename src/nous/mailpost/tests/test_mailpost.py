@@ -1,6 +1,10 @@
+import os
+import shutil
+import tempfile
 import unittest
 import mox
 import urllib2
+from StringIO import StringIO
 from textwrap import dedent
 
 from zope.testing import doctest
@@ -62,19 +66,308 @@ def doctest_postEmail():
     """
 
 
+def doctest_postEmail_multipart():
+    r"""Tests for postEmail sending multipart/form-data.
+
+        >>> import nous.mailpost
+        >>> from nous.mailpost import postEmail, setMultipartPost, Attachment
+        >>> from nous.mailpost.formdata import MultipartBody
+
+        >>> url = 'http://localhost/got_mail'
+        >>> req = urllib2.Request(url)
+        >>> mox.StubOutWithMock(urllib2, 'Request', use_mock_anything=True)
+        >>> mox.StubOutWithMock(urllib2, 'urlopen')
+
+    The same fields are sent, but the body is read from a MultipartBody:
+
+        >>> mm = urllib2.Request(url).AndReturn(req)
+        >>> mm = urllib2.urlopen(req, data=mox_module.IsA(MultipartBody))
+        >>> mox.ReplayAll()
+
+        >>> setMultipartPost(True)
+        >>> postEmail(url, mailString, authorization="",
+        ...           attachments=[Attachment('doom.ics', 'text', 'calendar',
+        ...                                   digest='abc')])
+        >>> setMultipartPost(False)
+        >>> mox.VerifyAll()
+
+        >>> req.get_header('Content-type')
+        'multipart/form-data; boundary=...'
+        >>> int(req.get_header('Content-length')) > len(mailString)
+        True
+
+    """
+
+
+attachmentMail = dedent('''\
+From: bob@example.com
+Subject: Report
+MIME-Version: 1.0
+Content-Type: multipart/mixed; boundary="outer"
+
+--outer
+Content-Type: text/plain
+
+See the attached report.
+
+--outer
+Content-Type: text/calendar; name="doom.ics"
+
+%s
+--outer--
+''') % mailString
+
+
+def doctest_processAttachments_stream():
+    r"""Tests for processAttachments reading the mail from a file.
+
+        >>> from nous.mailpost import processAttachments
+        >>> mail, attachments = processAttachments(StringIO(attachmentMail),
+        ...                                        tmpdir)
+
+    The attachment is stored under its md5 and nothing else is left in
+    the upload directory:
+
+        >>> len(attachments)
+        1
+        >>> attachment = attachments[0]
+        >>> attachment
+        <Attachment 'doom.ics' text/calendar, 307 bytes>
+        >>> attachment.digest
+        'ad3de96f5b6aded313b83cb77e685cb6'
+        >>> path = os.path.join(tmpdir, *[attachment.digest[i:i+8]
+        ...                               for i in range(0, 32, 8)])
+        >>> attachment.path == path
+        True
+        >>> attachment.open().read() == mailString + '\n'
+        True
+        >>> os.listdir(tmpdir)
+        ['...']
+
+    Only the first part is posted:
+
+        >>> print mail
+        From: bob@example.com
+        Subject: Report
+        MIME-Version: 1.0
+        Content-Type: multipart/mixed; boundary="outer"
+        <BLANKLINE>
+        --outer
+        Content-Type: text/plain
+        <BLANKLINE>
+        See the attached report.
+        <BLANKLINE>
+        --outer--
+        <BLANKLINE>
+
+    Mails given as a string are stripped the same way:
+
+        >>> string_mail, string_attachments = processAttachments(
+        ...     attachmentMail, tmpdir)
+        >>> string_mail == mail
+        True
+        >>> string_attachments == attachments
+        True
+
+    Once stored, the body is not kept in memory but read from the store:
+
+        >>> attachment.body is None
+        True
+
+    """
+
+
+def doctest_processAttachments_mmap():
+    r"""Tests for processAttachments working on a memory map of the mail.
+
+        >>> from nous.mailpost import processAttachments, mapMail
+        >>> from nous.mailpost import spillInput, encodePostFields
+        >>> path = os.path.join(tmpdir, 'mail')
+        >>> open(path, 'w').write(attachmentMail)
+        >>> upload_dir = os.path.join(tmpdir, 'upload')
+        >>> os.mkdir(upload_dir)
+
+    The mail to post is returned as a file reading it from the map:
+
+        >>> mail, attachments = processAttachments(mapMail(open(path)),
+        ...                                        upload_dir)
+        >>> expected = processAttachments(attachmentMail, upload_dir)
+        >>> attachments[0].digest == expected[1][0].digest
+        True
+        >>> len(mail) == len(expected[0])
+        True
+
+    It is quoted as it is read when it is posted:
+
+        >>> body = encodePostFields([('Mail', mail), ('md5[]', 'abc')])
+        >>> body.length == len(body.read())
+        True
+        >>> mail.seek(0)
+        >>> encodePostFields([('Mail', mail)]).read() == \
+        ...     encodePostFields([('Mail', expected[0])])
+        True
+
+    Big mails read from a pipe are spilled to a temporary file and
+    mapped, small ones are kept as strings:
+
+        >>> spillInput(StringIO(attachmentMail), 10000) == attachmentMail
+        True
+        >>> spilled = spillInput(StringIO(attachmentMail), 100, tmpdir)
+        >>> spilled[:] == attachmentMail
+        True
+        >>> sorted(os.listdir(tmpdir))
+        ['mail', 'upload']
+
+    """
+
+
+def doctest_storeAttacment():
+    r"""Tests for storeAttacment.
+
+        >>> from nous.mailpost import storeAttacment, getAttachmentFilename
+        >>> from nous.mailpost import Attachment
+        >>> attachment = Attachment('doom.ics', 'text', 'calendar', mailString)
+        >>> storeAttacment(attachment, tmpdir)
+
+    The digest is remembered, so postEmail does not hash the body again:
+
+        >>> attachment.digest
+        '28ade8d4532ce3cee33d7c48636e1a54'
+        >>> getAttachmentFilename(attachment)
+        '28ade8d4532ce3cee33d7c48636e1a54'
+
+        >>> path = os.path.join(tmpdir, '28ade8d4', '532ce3ce', 'e33d7c48',
+        ...                     '636e1a54')
+        >>> open(path).read() == mailString
+        True
+
+    The body is dropped, it is read from the store from now on:
+
+        >>> attachment.body is None, attachment.path == path
+        (True, True)
+        >>> attachment.open().read() == mailString
+        True
+
+    Storing the same body again leaves no temporary files behind, only
+    the log of the attachment index:
+
+        >>> storeAttacment(Attachment('doom.ics', 'text', 'calendar',
+        ...                           mailString), tmpdir)
+        >>> sorted(os.listdir(tmpdir))
+        ['.index.log', '28ade8d4']
+
+    Both messages are counted as references:
+
+        >>> from nous.mailpost.index import AttachmentIndex
+        >>> index = AttachmentIndex(tmpdir)
+        >>> index.refresh()
+        >>> entry = index.get('28ade8d4532ce3cee33d7c48636e1a54')
+        >>> entry.refcount, entry.size, entry.mime_type
+        (2, 306, u'text/calendar')
+        >>> index.close()
+
+    New bodies are hashed once, while they are written:
+
+        >>> import nous.mailpost
+        >>> hashed = []
+        >>> def getHash(algorithm):
+        ...     hashed.append(algorithm)
+        ...     return saved_getHash(algorithm)
+        >>> saved_getHash = nous.mailpost.getHash
+        >>> nous.mailpost.getHash = getHash
+        >>> storeAttacment(Attachment('other.ics', 'text', 'calendar',
+        ...                           'Other'), tmpdir)
+        >>> hashed
+        ['md5']
+
+    Bodies with a known key are not hashed at all:
+
+        >>> del hashed[:]
+        >>> attachment = Attachment('doom.ics', 'text', 'calendar',
+        ...                         mailString,
+        ...                         digest='28ade8d4532ce3cee33d7c48636e1a54')
+        >>> storeAttacment(attachment, tmpdir)
+        >>> hashed, attachment.path == path
+        ([], True)
+        >>> nous.mailpost.getHash = saved_getHash
+
+    Stored files get the mode open() creates files with under the umask
+    mailpost started with, not the 0600 of temporary files, so Zope can
+    read them when it runs as another user:
+
+        >>> import stat
+        >>> nous.mailpost.attachment_mode == 0666 & ~nous.mailpost.getUmask()
+        True
+        >>> saved_mode = nous.mailpost.attachment_mode
+        >>> nous.mailpost.attachment_mode = 0644
+        >>> attachment = Attachment('mode.txt', 'text', 'plain', 'Readable')
+        >>> storeAttacment(attachment, tmpdir)
+        >>> oct(stat.S_IMODE(os.stat(attachment.path).st_mode))
+        '0644'
+        >>> nous.mailpost.attachment_mode = saved_mode
+
+    """
+
+
+def doctest_setHashAlgorithm():
+    r"""Tests for keying attachments with other hash algorithms.
+
+        >>> from nous.mailpost import processAttachments, getPostFields
+        >>> from nous.mailpost import setHashAlgorithm, getAttachmentPath
+        >>> md5_key = processAttachments(attachmentMail, tmpdir)[1][0].digest
+
+    Keys of other algorithms carry its name:
+
+        >>> setHashAlgorithm('sha256')
+        >>> mail, attachments = processAttachments(StringIO(attachmentMail),
+        ...                                        tmpdir)
+        >>> key = attachments[0].digest
+        >>> key
+        'sha256-2cc73afae6f72581d7e2f9c15ec2452a63e0cff1c8f332afda723214502ed6fa'
+        >>> getAttachmentPath(key, tmpdir)[len(tmpdir):]
+        '/sha256/2cc73afa/e6f72581/d7e2f9c1/5ec2452a/63e0cff1/c8f332af/da723214/502ed6fa'
+
+    Both copies are kept, so lookups with the MD5 keys posted before go
+    on working:
+
+        >>> os.path.exists(getAttachmentPath(md5_key, tmpdir))
+        True
+
+    The algorithm is posted with the key:
+
+        >>> getPostFields(mail, attachments)[1:]
+        [('digest[]', 'sha256-2cc7...'), ('digest-algorithm[]', 'sha256'),
+         ('mime-type[]', 'text/calendar'), ('filename[]', 'doom.ics')]
+
+    Algorithms that are not available are refused:
+
+        >>> setHashAlgorithm('whirlpool-ish')
+        Traceback (most recent call last):
+        ...
+        ValueError: unknown hash algorithm: whirlpool-ish
+
+        >>> setHashAlgorithm('md5')
+
+    """
+
+
 def setUp(test):
     test.globs['mox'] = mox.Mox()
+    test.globs['mox_module'] = mox
+    test.globs['tmpdir'] = tempfile.mkdtemp()
 
 
 def tearDown(test):
     test.globs['mox'].UnsetStubs()
+    shutil.rmtree(test.globs['tmpdir'])
 
 
 def test_suite():
     return unittest.TestSuite([
             doctest.DocTestSuite(setUp=setUp,
                                  tearDown=tearDown,
-                                 optionflags=doctest.ELLIPSIS),
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
             doctest.DocTestSuite('nous.mailpost',
                                  optionflags=doctest.ELLIPSIS),
             ])
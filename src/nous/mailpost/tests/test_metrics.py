@@ -0,0 +1,150 @@
+import os
+import socket
+import shutil
+import tempfile
+import unittest
+import urllib2
+from StringIO import StringIO
+
+from zope.testing import doctest
+
+import nous.mailpost
+from nous.mailpost.tests.test_mailpost import attachmentMail
+
+
+def doctest_metrics():
+    r"""Tests for the metrics of the pipeline.
+
+        >>> from nous.mailpost import processAttachments, installMetrics
+        >>> from nous.mailpost.metrics import Registry
+        >>> registry = Registry()
+        >>> installMetrics(registry)
+
+    Messages are counted with their size and attachments, and the time
+    spent parsing and storing them is measured:
+
+        >>> mail, attachments = processAttachments(attachmentMail, tmpdir)
+        >>> mail, attachments = processAttachments(StringIO(attachmentMail),
+        ...                                        tmpdir)
+        >>> for name in ('messages_total', 'received_bytes_total',
+        ...              'attachments_total', 'attachment_bytes_total',
+        ...              'parse_seconds', 'store_seconds'):
+        ...     print name, registry.get(name)
+        messages_total 2
+        received_bytes_total 1072
+        attachments_total 2
+        attachment_bytes_total 614
+        parse_seconds 2
+        store_seconds 2
+
+    The second copy of the attachment was stored already:
+
+        >>> registry.get('store_dedup_hits_total')
+        1
+
+    Posts are timed by the status of the response, and every message
+    delivered is counted by its exit code:
+
+        >>> from nous.mailpost.benchmarks.stubserver import StubServer
+        >>> server = StubServer()
+        >>> server.start()
+        >>> nous.mailpost.deliverEmail(server.url + 'got_mail',
+        ...                            attachmentMail, tmpdir)
+        0
+        >>> nous.mailpost.deliverEmail('http://127.0.0.1:1/got_mail',
+        ...                            attachmentMail, tmpdir)
+        75
+        >>> server.stop()
+        >>> registry.get('post_seconds', status=200)
+        1
+        >>> registry.get('post_seconds', status='error')
+        1
+        >>> registry.get('exit_codes_total', code=0)
+        1
+        >>> registry.get('exit_codes_total', code=75)
+        1
+
+    Daemons serve the metrics over HTTP:
+
+        >>> from nous.mailpost.metrics import MetricsServer
+        >>> metrics_server = MetricsServer(('127.0.0.1', 0), registry)
+        >>> metrics_server.start()
+        >>> url = 'http://127.0.0.1:%d' % metrics_server.server_address[1]
+        >>> print urllib2.urlopen(url + '/metrics').read()
+        # HELP mailpost_messages_total Messages processed.
+        # TYPE mailpost_messages_total counter
+        mailpost_messages_total 4
+        ...
+        mailpost_exit_codes_total{code="0"} 1
+        mailpost_exit_codes_total{code="75"} 1
+        >>> urllib2.urlopen(url + '/')
+        Traceback (most recent call last):
+        ...
+        HTTPError: HTTP Error 404: Not Found
+        >>> metrics_server.stop()
+
+    """
+
+
+def doctest_StatsdSink():
+    r"""Tests for sending the metrics of the one-shot script.
+
+        >>> from nous.mailpost.metrics import StatsdSink
+        >>> receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        >>> receiver.bind(('127.0.0.1', 0))
+        >>> path = os.path.join(tmpdir, 'metrics')
+        >>> sink = StatsdSink(receiver.getsockname(), path)
+        >>> nous.mailpost.installMetrics(sink)
+        >>> nous.mailpost.processAttachments(attachmentMail, tmpdir)[1]
+        [<Attachment 'doom.ics' text/calendar, 307 bytes>]
+        >>> nous.mailpost.recordExitCode(0)
+        0
+
+    Nothing is sent until the sink is flushed:
+
+        >>> os.path.exists(path)
+        False
+        >>> sink.flush()
+        >>> print receiver.recv(65536)
+        mailpost.messages_total:1|c
+        mailpost.received_bytes_total:536|c
+        mailpost.parse_seconds:...|ms
+        mailpost.store_seconds:...|ms
+        mailpost.attachments_total:1|c
+        mailpost.attachment_bytes_total:307|c
+        mailpost.exit_codes_total.code_0:1|c
+        >>> print open(path).read()
+        mailpost.messages_total:1|c
+        ...
+        mailpost.exit_codes_total.code_0:1|c
+        >>> receiver.close()
+
+    """
+
+
+def setUp(test):
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+    test.globs['saved_log_error'] = nous.mailpost.log_error
+    nous.mailpost.log_error = lambda msg: None
+
+
+def tearDown(test):
+    nous.mailpost.installMetrics(None)
+    nous.mailpost.log_error = test.globs['saved_log_error']
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            doctest.DocTestSuite('nous.mailpost.metrics',
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,105 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+from zope.testing import doctest
+
+import nous.mailpost
+
+
+def doctest_Profiler():
+    r"""Tests for profiling deliveries.
+
+        >>> from nous.mailpost.profiling import Profiler
+        >>> directory = os.path.join(tmpdir, 'profiles')
+        >>> profiler = Profiler(directory, report_every=3)
+
+    Every call is profiled into a file of its own, however it exits:
+
+        >>> from nous.mailpost.tests.test_mailpost import attachmentMail
+        >>> def deliver(mail):
+        ...     nous.mailpost.processAttachments(mail, tmpdir)
+        ...     sys.exit(0)
+        >>> profiler.run(deliver, attachmentMail)
+        Traceback (most recent call last):
+        ...
+        SystemExit: 0
+        >>> profiler.run(len, attachmentMail)
+        536
+        >>> sorted(os.listdir(directory))
+        ['...-....prof', '...-....prof']
+
+    Once there are enough of them, they are moved into a report:
+
+        >>> profiler.run(len, attachmentMail)
+        536
+        >>> [report] = os.listdir(directory)
+        >>> report
+        'report-...'
+        >>> sorted(os.listdir(os.path.join(directory, report)))
+        ['...-....prof', '...-....prof', '...-....prof',
+         'report.prof', 'report.txt']
+        >>> print open(os.path.join(directory, report, 'report.txt')).read()
+        Aggregated from 3 profiles
+        ...processAttachments...
+
+    A report is only written when there is something to report:
+
+        >>> profiler.report(force=True) is None
+        True
+
+    Profiles that can't be dumped are only logged:
+
+        >>> nous.mailpost.profiling.log_warning = log
+        >>> shutil.rmtree(directory)
+        >>> profiler.run(len, attachmentMail)
+        Could not dump profile to .../profiles: [Errno 2] No such file or directory: ...
+        536
+
+    Neither are errors writing the report, the exit code stays the one
+    the function exited with:
+
+        >>> def report(force=False):
+        ...     raise TypeError('bad profile')
+        >>> os.mkdir(directory)
+        >>> profiler.report = report
+        >>> profiler.report_every = 1
+        >>> def tempfail(mail):
+        ...     sys.exit(75)
+        >>> profiler.run(tempfail, attachmentMail)
+        Traceback (most recent call last):
+        ...
+        SystemExit: 75
+        >>> profiler.run(len, attachmentMail)
+        Could not dump profile to .../profiles: bad profile
+        536
+
+    """
+
+
+def log(msg):
+    print msg
+
+
+def setUp(test):
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+
+
+def tearDown(test):
+    nous.mailpost.profiling.log_warning = nous.mailpost.log_warning
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,70 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from zope.testing import doctest
+
+
+def doctest_DeliverySemaphore():
+    r"""Tests for DeliverySemaphore.
+
+        >>> from nous.mailpost import smtp2zope
+        >>> lockfile = os.path.join(tmpdir, 'smtp2zope.lock')
+        >>> first = smtp2zope.DeliverySemaphore(lockfile, 'http://a/', slots=1)
+        >>> first.acquire()
+
+    The only slot is taken, so others time out:
+
+        >>> smtp2zope.DeliverySemaphore(lockfile, 'http://a/',
+        ...                             slots=1).acquire(timeout=0.1)
+        Traceback (most recent call last):
+          ...
+        TimeOutError
+
+    Deliveries to another URL do not wait:
+
+        >>> other = smtp2zope.DeliverySemaphore(lockfile, 'http://b/', slots=1)
+        >>> other.acquire(timeout=0.1)
+        >>> other.release()
+
+    A waiter gets the slot as soon as it is given back:
+
+        >>> def release():
+        ...     time.sleep(0.2)
+        ...     first.release()
+        >>> thread = threading.Thread(target=release)
+        >>> thread.start()
+        >>> second = smtp2zope.DeliverySemaphore(lockfile, 'http://a/',
+        ...                                      slots=1)
+        >>> started = time.time()
+        >>> second.acquire(timeout=5)
+        >>> time.time() - started < 1
+        True
+        >>> thread.join()
+        >>> second.release()
+
+    """
+
+
+def setUp(test):
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+
+
+def tearDown(test):
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,258 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+from zope.testing import doctest
+
+import nous.mailpost
+
+
+def doctest_Spool():
+    r"""Tests for the spool.
+
+        >>> from nous.mailpost.spool import Spool, SpoolWorker
+        >>> spool = Spool(tmpdir)
+
+    Spooled messages are stored in sharded directories and journaled:
+
+        >>> first = spool.enqueue('http://localhost/first', 'First\n',
+        ...                       '/upload')
+        >>> path = spool.getPath(first.id)
+        >>> path == os.path.join(tmpdir, 'queue', first.id[:2], first.id)
+        True
+        >>> open(path).read()
+        'First\n'
+        >>> print open(os.path.join(tmpdir, 'journal')).read()
+        E	...	http%3A%2F%2Flocalhost%2Ffirst	%2Fupload	...
+
+    Another process appending to the spool does not need to read the
+    journal:
+
+        >>> other = Spool(tmpdir, replay=False)
+        >>> second = other.enqueue('http://localhost/second', 'Second\n',
+        ...                        '/upload')
+        >>> other.entries.keys() == [second.id]
+        True
+
+    Only one process may post the messages:
+
+        >>> spool.lockWorker()
+        True
+        >>> Spool(tmpdir).lockWorker()
+        False
+
+    The worker posts them, retrying the ones that fail temporarily:
+
+        >>> codes = {'http://localhost/first': nous.mailpost.EXIT_OK,
+        ...          'http://localhost/second': nous.mailpost.EXIT_TEMPFAIL}
+        >>> def deliver(entry):
+        ...     print 'posting %s' % open(spool.getPath(entry.id)).read(),
+        ...     return codes[entry.callURL]
+        >>> worker = SpoolWorker(spool, retry_delay=60, deliver=deliver)
+        >>> spool.compact()
+        >>> worker.drain()
+        posting First
+        posting Second
+
+        >>> os.path.exists(path)
+        False
+        >>> spool.entries.keys() == [second.id]
+        True
+        >>> entry = spool.entries[second.id]
+        >>> entry.attempts
+        1
+        >>> 55 < entry.next_try - time.time() <= 60
+        True
+
+    It is not posted again until the delay passes, and the delay doubles
+    with every attempt:
+
+        >>> worker.drain()
+        >>> entry.next_try = 0
+        >>> worker.drain()
+        posting Second
+        >>> entry.attempts
+        2
+        >>> 115 < entry.next_try - time.time() <= 120
+        True
+
+    The state survives a restart:
+
+        >>> spool.close()
+        >>> spool = Spool(tmpdir)
+        >>> spool.entries[second.id].attempts
+        2
+
+    Messages refused permanently are moved aside:
+
+        >>> codes['http://localhost/second'] = nous.mailpost.EXIT_NOUSER
+        >>> spool.entries[second.id].next_try = 0
+        >>> worker = SpoolWorker(spool, deliver=deliver)
+        >>> worker.drain()
+        posting Second
+        >>> spool.entries
+        {}
+        >>> os.listdir(os.path.join(tmpdir, 'failed')) == [second.id]
+        True
+
+    The directories of the messages are kept for the ones to come:
+
+        >>> (set(os.listdir(os.path.join(tmpdir, 'queue'))) ==
+        ...  set([first.id[:2], second.id[:2]]))
+        True
+
+    Compacting drops the records of messages that are gone:
+
+        >>> spool.compact()
+        >>> open(os.path.join(tmpdir, 'journal')).read()
+        ''
+
+        >>> spool.close()
+
+    """
+
+
+def doctest_Spool_legacy_layout():
+    r"""Tests for spools of older versions.
+
+    They sharded messages like attachments, into directories of 8
+    characters:
+
+        >>> from nous.mailpost.spool import Spool
+        >>> spool = Spool(tmpdir)
+        >>> entry = spool.enqueue('http://localhost/first', 'First\n',
+        ...                       '/upload')
+        >>> legacy_path = spool.getLegacyPath(entry.id)
+        >>> os.makedirs(os.path.dirname(legacy_path))
+        >>> os.rename(spool.getPath(entry.id), legacy_path)
+        >>> os.makedirs(os.path.join(tmpdir, 'queue', '0123abcd', '4567abcd'))
+
+    Compacting moves their messages into the current layout and removes
+    the directories left behind:
+
+        >>> spool.compact()
+        >>> open(spool.getPath(entry.id)).read()
+        'First\n'
+        >>> os.listdir(os.path.join(tmpdir, 'queue')) == [entry.id[:2]]
+        True
+        >>> spool.entries.keys() == [entry.id]
+        True
+
+        >>> spool.close()
+
+    """
+
+
+def doctest_SpoolWorker_compaction():
+    r"""Tests for compacting the journal while the worker runs.
+
+        >>> from nous.mailpost.spool import Spool, SpoolWorker
+        >>> spool = Spool(tmpdir)
+        >>> spool.lockWorker()
+        True
+        >>> worker = SpoolWorker(spool,
+        ...                      deliver=lambda entry: nous.mailpost.EXIT_OK)
+
+    Without compaction, every message posted would leave two records in
+    the journal.  It is compacted once it grows too big:
+
+        >>> spool.max_journal_size = 200
+        >>> journal = os.path.join(tmpdir, 'journal')
+        >>> sizes = []
+        >>> for i in range(20):
+        ...     entry = spool.enqueue('http://localhost/', 'Mail %d\n' % i,
+        ...                           '/upload')
+        ...     worker.drain()
+        ...     sizes.append(os.path.getsize(journal))
+        >>> max(sizes) <= 200, sizes.count(0) > 5
+        (True, True)
+
+    A journal kept big by pending messages is compacted again only once
+    it doubled:
+
+        >>> for i in range(5):
+        ...     entry = spool.enqueue('http://localhost/', 'Mail %d\n' % i,
+        ...                           '/upload')
+        >>> spool.compact()
+        >>> spool.compacted_size > spool.max_journal_size
+        True
+        >>> spool.compactIfLarge()
+        >>> os.path.getsize(journal) == spool.compacted_size
+        True
+
+    Records appended before a compaction are synced with it:
+
+        >>> spool.condition.acquire()
+        True
+        >>> seq = spool.append('D\t%s\n' % entry.id)
+        >>> spool.condition.release()
+        >>> spool.compact()
+        >>> spool.sync(seq)
+        >>> spool.synced == spool.written
+        True
+
+        >>> spool.close()
+
+    """
+
+
+def doctest_SpoolWorker_errors():
+    r"""Tests that one message can't stop the worker.
+
+        >>> from nous.mailpost.spool import Spool, SpoolWorker
+        >>> spool = Spool(tmpdir)
+        >>> first = spool.enqueue('http://localhost/first', 'First\n',
+        ...                       '/upload')
+        >>> second = spool.enqueue('http://localhost/second', 'Second\n',
+        ...                        '/upload')
+        >>> def done(entry):
+        ...     raise OSError('Disk full')
+        >>> spool.done = done
+        >>> def log(msg):
+        ...     print msg
+        >>> nous.mailpost.spool.log_error = log
+        >>> worker = SpoolWorker(spool,
+        ...                      deliver=lambda entry: nous.mailpost.EXIT_OK)
+        >>> worker.drain()
+        Unexpected error finishing spooled message ...: Disk full
+        Unexpected error finishing spooled message ...: Disk full
+
+    The messages stay in the spool, to be tried again later:
+
+        >>> sorted(spool.entries) == sorted([first.id, second.id])
+        True
+        >>> first.next_try > time.time() + 55
+        True
+        >>> worker.active
+        {}
+
+        >>> spool.close()
+
+    """
+
+
+def setUp(test):
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+    test.globs['saved_log_error'] = nous.mailpost.log_error
+    nous.mailpost.log_error = lambda msg: None
+
+
+def tearDown(test):
+    nous.mailpost.spool.log_error = nous.mailpost.log_error
+    nous.mailpost.log_error = test.globs['saved_log_error']
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from zope.testing import doctest
+
+import nous.mailpost
+from nous.mailpost.tests.test_mailpost import attachmentMail
+
+
+def doctest_PooledWriter():
+    r"""Tests for writing from the threads of the pool.
+
+        >>> from nous.mailpost.storepool import StorePool, PooledWriter
+        >>> pool = StorePool(threads=3, max_chunks=2, min_size=0)
+
+    Chunks are written in order, even if several threads write them:
+
+        >>> output = StringIO()
+        >>> writer = PooledWriter(pool, output, chunk_size=10)
+        >>> for i in range(1000):
+        ...     writer.write('%03d,' % i)
+        >>> writer.close()
+        >>> writer.wait()
+        >>> output.getvalue() == ''.join(['%03d,' % i for i in range(1000)])
+        True
+
+    Errors are raised by wait():
+
+        >>> class Full(object):
+        ...     def write(self, data):
+        ...         raise IOError(28, 'No space left on device')
+        >>> writer = PooledWriter(pool, Full(), chunk_size=10)
+        >>> writer.write('x' * 100)
+        >>> writer.close()
+        >>> writer.wait()
+        Traceback (most recent call last):
+        ...
+        IOError: [Errno 28] No space left on device
+
+        >>> pool.close()
+
+    """
+
+
+def doctest_processAttachments_pool():
+    r"""Tests for storing attachments in the store pool.
+
+        >>> from nous.mailpost import processAttachments, installStorePool
+        >>> from nous.mailpost.storepool import StorePool, StoreError
+        >>> expected = processAttachments(attachmentMail, tmpdir)
+        >>> expected_stream = processAttachments(StringIO(attachmentMail),
+        ...                                      tmpdir)
+
+        >>> pool = StorePool(threads=2, min_size=0)
+        >>> installStorePool(pool)
+
+    The result is the same, whether the mail is a string or read from a
+    file:
+
+        >>> processAttachments(attachmentMail, tmpdir) == expected
+        True
+        >>> (processAttachments(StringIO(attachmentMail), tmpdir)
+        ...  == expected_stream)
+        True
+
+    Attachments that can not be stored are reported together, once the
+    others are done:
+
+        >>> shutil.rmtree(os.path.join(tmpdir, 'ad3de96f'))
+        >>> open(os.path.join(tmpdir, 'ad3de96f'), 'w').close()
+        >>> processAttachments(attachmentMail, tmpdir)
+        Traceback (most recent call last):
+        ...
+        StoreError: doom.ics: [Errno 20] Not a directory: ...
+        >>> try:
+        ...     processAttachments(StringIO(attachmentMail), tmpdir)
+        ... except StoreError, e:
+        ...     print [(attachment.filename, error.errno)
+        ...            for attachment, error in e.errors]
+        [('doom.ics', 20)]
+
+    Nothing is left behind:
+
+        >>> sorted(os.listdir(tmpdir))
+        ['.index.log', 'ad3de96f']
+
+        >>> installStorePool(None)
+        >>> pool.close()
+
+    """
+
+
+def setUp(test):
+    test.globs['tmpdir'] = tempfile.mkdtemp()
+
+
+def tearDown(test):
+    shutil.rmtree(test.globs['tmpdir'])
+
+
+def test_suite():
+    return unittest.TestSuite([
+            doctest.DocTestSuite(setUp=setUp,
+                                 tearDown=tearDown,
+                                 optionflags=doctest.ELLIPSIS|
+                                             doctest.NORMALIZE_WHITESPACE),
+            ])
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='test_suite')
@@ -0,0 +1,269 @@
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+"""Tracing the stages of delivering a message.
+
+A Tracer installed with nous.mailpost.installTracer is told when the
+delivery of a message starts and ends, and when each stage of it does:
+
+    parse       reading the mail and decoding its parts
+    store       storing the attachments
+    attachment  decoding or storing one attachment
+    post        posting the mail
+
+The Trace of a message is kept per thread while it is delivered.  The
+events of every stage carry its timing and a dict of details, like
+sizes, that are filled in as they are known.
+
+SlowMessageLog is a tracer that writes a line of JSON for every message
+that took longer than a threshold to deliver:
+
+    mailpost --slow-log=/var/log/mailpost/slow --slow-threshold=5 ...
+"""
+import time
+import json
+import threading
+
+import nous.mailpost
+
+
+class Tracer(object):
+    """Receives the events of messages being delivered.
+
+    Subclasses override the events they are interested in.  Events are
+    sent from the threads delivering the messages.
+    """
+
+    def startMessage(self, trace):
+        pass
+
+    def start(self, trace, stage, info):
+        pass
+
+    def end(self, trace, stage, seconds, info):
+        pass
+
+    def endMessage(self, trace):
+        pass
+
+
+def notify(method, *args):
+    """Call an event method of a tracer.
+
+    Its errors are logged, so tracing never changes how a message is
+    delivered.
+    """
+    try:
+        method(*args)
+    except Exception, e:
+        nous.mailpost.log_warning('Tracer %s failed: %s'
+                                  % (method.__name__, e))
+
+
+def decode(value):
+    """Return value with its byte strings decoded, for dumping as JSON.
+
+    Names and headers taken from mails are not necessarily UTF-8:
+
+        >>> sorted(decode({'filename': 'caf\\xe9.bin',
+        ...                'sizes': [1, 'two']}).items())
+        [(u'filename', u'caf\\ufffd.bin'), (u'sizes', [1, u'two'])]
+
+    """
+    if isinstance(value, str):
+        return value.decode('utf-8', 'replace')
+    if isinstance(value, dict):
+        return dict([(decode(key), decode(item))
+                     for key, item in value.items()])
+    if isinstance(value, (list, tuple)):
+        return [decode(item) for item in value]
+    return value
+
+
+class Span(object):
+    """A stage of delivering a message, end() it when it is done."""
+
+    def __init__(self, trace, stage, info):
+        self.trace = trace
+        self.stage = stage
+        self.info = info
+        self.started = time.time()
+        notify(trace.tracer.start, trace, stage, info)
+
+    def end(self, **info):
+        """Note the end of the stage, with more details."""
+        seconds = time.time() - self.started
+        self.info.update(info)
+        self.trace.stages.append((self.stage, seconds, self.info))
+        notify(self.trace.tracer.end, self.trace, self.stage, seconds,
+               self.info)
+
+
+class NullSpan(object):
+    """The span of a stage of a message that is not traced."""
+
+    def end(self, **info):
+        pass
+
+NULL_SPAN = NullSpan()
+
+
+class Trace(object):
+    """The delivery of a message to one or more URLs.
+
+    Holds what is known about the message, its Message-ID, size and the
+    layout of its parts, and the stages that ended so far.  It ends when
+    an exit code was set for every URL.
+    """
+
+    def __init__(self, tracer, callURLs):
+        self.tracer = tracer
+        self.callURLs = list(callURLs)
+        self.exit_codes = {}
+        self.pending = len(self.callURLs)
+        self.message_id = None
+        self.size = None
+        self.parts = []
+        self.stages = []
+        self.started = time.time()
+        self.seconds = None
+        self.lock = threading.Lock()
+        notify(tracer.startMessage, self)
+
+    def start(self, stage, **info):
+        return Span(self, stage, info)
+
+    def setMail(self, mail):
+        """Note what the ParsedMail tells about the message."""
+        self.message_id = mail.headers.getheader('Message-ID')
+        self.parts = []
+        if mail.contentType:
+            self.parts.append({'type': mail.contentType.split(';')[0],
+                               'size': len(mail.textBody)})
+        for attachment in mail.attachments:
+            self.parts.append({'type': attachment.mime_type,
+                               'filename': attachment.filename,
+                               'size': attachment.size})
+
+    def setExitCode(self, callURL, code):
+        """Note the exit code of the delivery to callURL."""
+        self.lock.acquire()
+        try:
+            self.exit_codes[callURL] = code
+            self.pending -= 1
+            if self.pending:
+                return
+        finally:
+            self.lock.release()
+        self.seconds = time.time() - self.started
+        notify(self.tracer.endMessage, self)
+
+
+local = threading.local()
+
+
+def getTrace():
+    """Return the Trace of the message this thread delivers, or None."""
+    return getattr(local, 'trace', None)
+
+
+def setTrace(trace):
+    local.trace = trace
+
+
+def startStage(stage, **info):
+    """Start a stage of the message this thread delivers.
+
+    Returns the Span to end(), which does nothing if the message is not
+    traced.
+    """
+    trace = getattr(local, 'trace', None)
+    if trace is None:
+        return NULL_SPAN
+    return Span(trace, stage, info)
+
+
+def bindTrace(function):
+    """Return function, calling it with the trace of this thread set.
+
+    For handing work on a message to other threads.
+    """
+    trace = getTrace()
+    if trace is None:
+        return function
+    def traced(*args):
+        saved = getTrace()
+        setTrace(trace)
+        try:
+            return function(*args)
+        finally:
+            setTrace(saved)
+    return traced
+
+
+class SlowMessageLog(Tracer):
+    """Writes a line of JSON for every message slower than threshold
+    seconds to the file at path.
+
+        >>> import tempfile, os
+        >>> from nous.mailpost.mailboxer_tools import parseMail
+        >>> path = tempfile.mktemp()
+        >>> log = SlowMessageLog(path, threshold=0)
+        >>> trace = Trace(log, ['http://localhost/got_mail'])
+        >>> trace.setMail(parseMail('Message-ID: <1@example.com>\\n\\nHi\\n'))
+        >>> trace.start('post', url='http://localhost/got_mail').end(
+        ...     status=200)
+        >>> trace.setExitCode('http://localhost/got_mail', 0)
+        >>> record = json.loads(open(path).read())
+        >>> record['message_id'], record['exit_codes']
+        (u'<1@example.com>', {u'http://localhost/got_mail': 0})
+        >>> sorted(record['parts'][0].items())
+        [(u'size', 3), (u'type', u'text/plain')]
+        >>> stage = record['stages'][0]
+        >>> stage['stage'], stage['status'], stage['url']
+        (u'post', 200, u'http://localhost/got_mail')
+        >>> os.unlink(path)
+
+    """
+
+    def __init__(self, path, threshold=1.0):
+        self.path = path
+        self.threshold = threshold
+        self.lock = threading.Lock()
+
+    def endMessage(self, trace):
+        if trace.seconds < self.threshold:
+            return
+        stages = []
+        for stage, seconds, info in trace.stages:
+            record = dict(info)
+            record['stage'] = stage
+            record['seconds'] = round(seconds, 6)
+            stages.append(record)
+        line = json.dumps(decode({'time': round(trace.started, 3),
+                                  'seconds': round(trace.seconds, 6),
+                                  'message_id': trace.message_id,
+                                  'size': trace.size,
+                                  'exit_codes': trace.exit_codes,
+                                  'parts': trace.parts,
+                                  'stages': stages}), sort_keys=True)
+        self.lock.acquire()
+        try:
+            # opened every time, so the log can be rotated
+            f = open(self.path, 'a')
+            try:
+                f.write(line + '\n')
+            finally:
+                f.close()
+        finally:
+            self.lock.release()